@@ -1,15 +1,14 @@
 import os
 import os.path as osp
+import multiprocessing as mp
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 import heapq
 from graph.linear import bernoulli_lambda
 from graph.base import DisjointSetTree
-import matplotlib.pyplot as plt
-from matplotlib.pyplot import MultipleLocator
-from matplotlib.patches import Patch
-from utils import common
+from utils.store import ResultStore
+from graph.kernel import Points, load_arrays
 
 min_lam = float('inf')
 grade_label = ('Excellent', 'Good', 'Middle', 'Pass', 'Fail')
@@ -63,6 +62,18 @@ def read_od_type_data(time_idx):
     return pi_type
 
 
+def read_od_type_arrays(time_idx, arrays_dir='output/network_arrays'):
+    """
+    load the mapping (point => od type) and the od numbers from the array snapshot of the network
+    of the time index or label (see preprocess.save_network_arrays)
+    """
+    points = load_arrays(osp.join(arrays_dir, f'network_{time_idx}'), Points)
+    pi_type = {}
+    for uid, pi in zip(points.pt_uid.tolist(), map(tuple, points.pt_xy.tolist())):
+        pi_type[pi] = [True] * int(points.loc_o[uid]) + [False] * int(points.loc_d[uid])
+    return pi_type, int(points.loc_o.sum()), int(points.loc_d.sum())
+
+
 def get_od_count(time_idx):
     """
     read od number from network
@@ -71,10 +82,18 @@ def get_od_count(time_idx):
     return net.o_count, net.d_count
 
 
-def load_subareas(time_idx):
+def load_subareas(time_idx, epsilon=None):
     """
-    load subareas data in `output/subareas_split_time`
+    load subareas data from the result store (if epsilon is given) or in `output/subareas_split_time`
     """
+    store = ResultStore()
+    if epsilon is not None and store.has(time_idx, epsilon, 'hole'):
+        hole_sub, volcano_sub = {}, {}
+        for kind, sub in (('hole', hole_sub), ('volcano', volcano_sub)):
+            result = store.read(time_idx, epsilon, kind)
+            for pi, lam, nb in zip(result['seed_xy'].tolist(), result['lam'].tolist(), store.member_sets(result)):
+                sub[tuple(pi)] = (lam, nb)
+        return hole_sub, volcano_sub
     subareas_dir = 'output/subareas_split_time'
     subareas_path_hole = [osp.join(subareas_dir, fname) for fname in os.listdir(subareas_dir) if
                           fname.startswith(f'{time_idx}_hole')]
@@ -88,12 +107,12 @@ def load_subareas(time_idx):
     return hole_sub, volcano_sub
 
 
-def find_overlaps(subarea):
+def find_overlaps(subarea, progress=True):
     """
     Calculate the set of points whose neighbourhood intersects
     """
     overlap_map = {}
-    for p1, neighbour1 in tqdm(subarea.items(), desc="finding overlapping subareas"):
+    for p1, neighbour1 in tqdm(subarea.items(), desc="finding overlapping subareas", disable=not progress):
         overlap_map[p1] = []
         nb1 = neighbour1[1]
         for p2, neighbour2 in subarea.items():
@@ -105,7 +124,7 @@ def find_overlaps(subarea):
     return overlap_map
 
 
-def identify_hole_volcano(overlap_map, pi_type, subarea, o_cnt, d_cnt):
+def identify_hole_volcano(overlap_map, pi_type, subarea, o_cnt, d_cnt, progress=True):
     """
     Combining subareas and select the subarea with highest lambda value in overlapping subareas
     """
@@ -113,7 +132,8 @@ def identify_hole_volcano(overlap_map, pi_type, subarea, o_cnt, d_cnt):
     joint_set = DisjointSetTree()
     # Combining the first subarea in A-overlap with the candidate urban black hole and
     # calculating log lambda-new for the newly built urban black hole new
-    for pi, overs in tqdm(overlap_map.items(), desc="identify candidate urban black hole or volcano"):
+    for pi, overs in tqdm(overlap_map.items(), desc="identify candidate urban black hole or volcano",
+                          disable=not progress):
         lam_old, nb_old = subarea[pi]
         while overs:
             ov = heapq.heappop(overs)
@@ -125,8 +145,9 @@ def identify_hole_volcano(overlap_map, pi_type, subarea, o_cnt, d_cnt):
                 lam_old, nb_old = lam_new, nb_new
             else:
                 break
-        o_cnt, d_cnt = count_od_number(pi_type, nb_old)
-        result[pi] = (lam_old, nb_old, o_cnt, d_cnt)
+        # the od numbers of the whole network (o_cnt, d_cnt) are used by the next candidates
+        n_o, n_d = count_od_number(pi_type, nb_old)
+        result[pi] = (lam_old, nb_old, n_o, n_d)
         joint_set.make_set(pi)
 
     # Storage of minimum connected sets by joint set
@@ -142,48 +163,146 @@ def identify_hole_volcano(overlap_map, pi_type, subarea, o_cnt, d_cnt):
     # this urban black hole are deleted.
     determine = {}
     for pi_group in joint_set.group().values():
-        sorted(pi_group, key=lambda _p: result[_p][0], reverse=True)
-        max_pi = pi_group[0]
+        # ties are broken by the seed, so the result does not depend on the order of the subareas
+        max_pi = min(pi_group, key=lambda _p: (-result[_p][0], _p))
         determine[max_pi] = result[max_pi]
-    # sorted(determine, key=lambda _x: _x[0], reverse=True)
 
     # clean and sort result
     cleaned = []
     for data in determine.values():
-        lam, nb, o_cnt, d_cnt = data
-        cleaned.append((o_cnt / (o_cnt + d_cnt), nb))
-    sorted(cleaned, key=lambda _x: _x[0])
+        lam, nb, n_o, n_d = data
+        cleaned.append((n_o / (n_o + n_d), nb, lam, n_o, n_d))
+    cleaned.sort(key=lambda _x: (_x[0], -_x[2]))
 
     return cleaned
 
 
-def multi_scale_hole_volcano(time_id):
+def overlap_components(subarea):
+    """
+    Split the subareas into the connected components of their overlap graph (subareas sharing points),
+    the greedy merges of identify_hole_volcano() never cross two components
+
+    Returns
+    ----------
+    components : list
+        {pi => (lambda, neighbour)} of each component, in the order of their first subarea
+    """
+    joint_set = DisjointSetTree()
+    owner = {}  # point => the first subarea holding it
+    for pi, (_, nb) in subarea.items():
+        joint_set.make_set(pi)
+        for p in nb:
+            if p in owner:
+                joint_set.union(pi, owner[p])
+            else:
+                owner[p] = pi
+    return [{pi: subarea[pi] for pi in group} for group in joint_set.group().values()]
+
+
+def combine_component(subarea, pi_type, o_cnt, d_cnt):
+    """
+    Combine the subareas of one component of the overlap graph (see identify_hole_volcano())
+    """
+    return identify_hole_volcano(find_overlaps(subarea, progress=False), pi_type, subarea, o_cnt, d_cnt,
+                                 progress=False)
+
+
+def combine_components(subareas, pi_type, o_cnt, d_cnt, worker=1):
+    """
+    identify_hole_volcano() of several groups of subareas (e.g. the holes and the volcanoes), component
+    by component in 'worker' processes, the results do not depend on the number of workers
+    """
+    jobs, kinds = [], []
+    for kind, subarea in enumerate(subareas):
+        for comp in overlap_components(subarea):
+            points = set().union(*(nb for _, nb in comp.values()))
+            jobs.append((comp, {p: pi_type[p] for p in points}, o_cnt, d_cnt))
+            kinds.append(kind)
+    # the largest components first, so that a busy hour keeps all the workers busy
+    order = sorted(range(len(jobs)), key=lambda j: -len(jobs[j][0]))
+    if worker > 1 and len(jobs) > 1:
+        # a fresh server process forks the workers (spawned where there is no fork server, e.g. Windows),
+        # as the parent may have started the threading layer of the parallel kernels (forking it is not safe,
+        # see graph.kernel.warm_up)
+        method = 'forkserver' if 'forkserver' in mp.get_all_start_methods() else 'spawn'
+        pool = mp.get_context(method).Pool(min(worker, len(jobs)))
+        try:
+            results = pool.starmap(combine_component, [jobs[j] for j in order], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [combine_component(*jobs[j]) for j in tqdm(order, desc='combining subareas', mininterval=30)]
+    combined = [[] for _ in subareas]
+    for j, res in zip(order, results):
+        combined[kinds[j]].extend(res)
+    for res in combined:
+        res.sort(key=lambda _x: (_x[0], -_x[2]))
+    return combined
+
+
+def multi_scale_hole_volcano(time_id, epsilon=None, arrays_dir=None, worker=1):
     """
     Multi directional optimization method for detecting arbitrarily shaped urban black holes and volcanoes
+    the od points are read from the array snapshots in 'arrays_dir' if given (any time label),
+    otherwise from the od data and the saved network of the hour
+    the components of overlapping subareas are combined independently by 'worker' processes
     """
-    pi2od = read_od_type_data(time_id)
-    ori_cnt, des_cnt = get_od_count(time_id)
-    hole_sub, volcano_sub = load_subareas(time_id)
-    over_hole, over_volcano = find_overlaps(hole_sub), find_overlaps(volcano_sub)
-    hole = identify_hole_volcano(over_hole, pi2od, hole_sub, ori_cnt, des_cnt)
-    volcano = identify_hole_volcano(over_volcano, pi2od, volcano_sub, ori_cnt, des_cnt)
+    if arrays_dir is not None:
+        pi2od, ori_cnt, des_cnt = read_od_type_arrays(time_id, arrays_dir)
+    else:
+        pi2od = read_od_type_data(time_id)
+        ori_cnt, des_cnt = get_od_count(time_id)
+    hole_sub, volcano_sub = load_subareas(time_id, epsilon)
+    hole, volcano = combine_components((hole_sub, volcano_sub), pi2od, ori_cnt, des_cnt, worker=worker)
     return hole, volcano
 
 
-def save_identified_result(time_id, hole, volcano):
+def save_identified_result(time_id, hole, volcano, epsilon=None):
     """
     save results of the combined black hole and volcano in the directory `output/hole_volcano/`
+    and in the result store (if epsilon is given)
     """
     np.save(f'output/hole_volcano/{time_id}_hole.npy', [hole], allow_pickle=True)
     print(f'result saved to "output/hole_volcano/{time_id}_hole.npy"')
     np.save(f'output/hole_volcano/{time_id}_volcano.npy', [volcano], allow_pickle=True)
     print(f'result saved to "output/hole_volcano/{time_id}_volcano.npy"')
+    if epsilon is None:
+        return
+    store = ResultStore()
+    for kind, result in (('hole_merged', hole), ('volcano_merged', volcano)):
+        # results cached by earlier versions only hold (ratio, neighbour)
+        store.write(time_id, epsilon, kind, [r[1] for r in result],
+                    ratio=np.asarray([r[0] for r in result], dtype=np.float32),
+                    lam=np.asarray([r[2] if len(r) > 2 else np.nan for r in result], dtype=np.float32),
+                    o_cnt=np.asarray([r[3] if len(r) > 2 else -1 for r in result], dtype=np.int32),
+                    d_cnt=np.asarray([r[4] if len(r) > 2 else -1 for r in result], dtype=np.int32))
+    print(f'result saved to "{store.partition_dir(time_id, epsilon)}"')
+
+
+def has_identified_result(time_id, epsilon=None) -> bool:
+    """
+    Whether the results of the combined black hole and volcano are cached (see load_identified_result)
+    """
+    if epsilon is not None and ResultStore().has(time_id, epsilon, 'hole_merged'):
+        return True
+    return osp.exists(f'output/hole_volcano/{time_id}_hole.npy') and \
+        osp.exists(f'output/hole_volcano/{time_id}_volcano.npy')
 
 
-def load_identified_result(time_id):
+def load_identified_result(time_id, epsilon=None):
     """
-    Load the cached results of the combined black hole and volcano in the directory `output/hole_volcano/`
+    Load the cached results of the combined black hole and volcano from the result store (if epsilon is given)
+    or in the directory `output/hole_volcano/`
     """
+    store = ResultStore()
+    if epsilon is not None and store.has(time_id, epsilon, 'hole_merged'):
+        hole, volcano = [], []
+        for kind, res in (('hole_merged', hole), ('volcano_merged', volcano)):
+            result = store.read(time_id, epsilon, kind)
+            res.extend(zip(result['ratio'].tolist(), store.member_sets(result), result['lam'].tolist(),
+                           result['o_cnt'].tolist(), result['d_cnt'].tolist()))
+        return hole, volcano
     hole = np.load(f'output/hole_volcano/{time_id}_hole.npy', allow_pickle=True)[0]
     volcano = np.load(f'output/hole_volcano/{time_id}_volcano.npy', allow_pickle=True)[0]
     return hole, volcano
@@ -193,6 +312,11 @@ def plot_determine_hole_volcano(time_id, hole, volcano):
     """
     Plotting images of black holes and volcanoes for each time period
     """
+    # plotting modules are only imported when plotting (headless runs never load them)
+    import matplotlib.pyplot as plt
+    from matplotlib.pyplot import MultipleLocator
+    from matplotlib.patches import Patch
+    from utils import common
     plt.cla()
     for _, data in pd.read_csv('output/wuchangroad_network.csv', index_col=None).iterrows():
         x1, y1, x2, y2 = data['XCoord_0'], data['YCoord_0'], data['XCoord_1'], data['YCoord_1']
@@ -251,18 +375,24 @@ if __name__ == '__main__':
     """
     Combination of subareas of urban black holes and volcanoes based on multi directional optimization
     based on a 1 hour division (total 24hours)
+    (pipeline.py runs all the stages and recomputes only the stale results)
     """
+    import matplotlib.pyplot as plt
+
+    epsilon = 1200  # the neighbourhood cutoff radius used by identify_subareas.py
+    recompute = False  # combine the subareas again instead of reading the cached results
+    worker = 8  # processes combining the components of overlapping subareas
     plt.figure(figsize=(5, 5))
     _hole_score, _volcano_score = {}, {}
     for _i in range(5):
         _hole_score[_i] = _volcano_score[_i] = 0
     for _id in range(24):
-        # _result = multi_scale_hole_volcano(_id)
-        # NOTE: The local cache is read by default, if you need to re-run the program,
-        # comment out next line(228) and switch to the previous line(225)
-        _result = load_identified_result(_id)
+        if recompute or not has_identified_result(_id, epsilon):
+            _result = multi_scale_hole_volcano(_id, epsilon, worker=worker)
+        else:
+            _result = load_identified_result(_id, epsilon)
         plot_determine_hole_volcano(_id, *_result)
-        save_identified_result(_id, *_result)
+        save_identified_result(_id, *_result, epsilon=epsilon)
         analyse_result(*_result, _hole_score, _volcano_score)
     print('====== five-grade marking ======')
     print('hole:')
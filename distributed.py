@@ -0,0 +1,191 @@
+import os
+import os.path as osp
+import argparse
+import random
+import socket
+import threading
+import multiprocessing as mp
+from collections import defaultdict
+import numpy as np
+from utils.store import ResultStore
+from utils.taskqueue import TaskQueue
+from utils.common import parse_hours, simulations_path
+from graph.kernel import warm_up
+from identify_subareas import detect_subareas, save_subareas, save_point_stats, load_array_networks, arrays_dir
+
+
+def time_labels(dates, hours, load_dir):
+    """
+    Time labels of the (date, hour) networks: the hour itself for the saved hourly networks,
+    '{%Y%m%d}_{hour}' for the hours of the given dates (their snapshots are saved if missing)
+    """
+    if not dates:
+        return list(hours)
+    import pandas as pd
+    from preprocess import save_day_network_arrays
+    labels = []
+    for date in dates:
+        day_labels = set(save_day_network_arrays(date, arrays_dir=load_dir))
+        labels.extend(label for label in ('{}_{}'.format(pd.Timestamp(date).strftime('%Y%m%d'), h) for h in hours)
+                      if label in day_labels)
+    return labels
+
+
+def submit(queue: TaskQueue, labels, epsilons, chunk, r_time, alpha, sequential, prune, load_dir):
+    """
+    Shard the detection of every (time label, epsilon) into tasks of 'chunk' od locations
+    """
+    n_submitted = 0
+    for label in labels:
+        n_points = len(load_array_networks(label, load_dir)[0].all_matches())
+        for epsilon in epsilons:
+            for st in range(0, n_points, chunk):
+                ed = min(st + chunk, n_points)
+                payload = {'time': label, 'epsilon': epsilon, 'start': st, 'end': ed, 'n_points': n_points,
+                           'r_time': r_time, 'alpha': alpha, 'sequential': sequential, 'prune': prune,
+                           'arrays_dir': load_dir}
+                n_submitted += queue.submit(f'{label}_{epsilon}_{st}_{ed}', payload)
+    return n_submitted
+
+
+def run_task(task, save_dir):
+    """
+    Detect the subareas of the point range of a task and save them in 'save_dir' (a result store)
+    """
+    job = task['payload']
+    net, ran_net = load_array_networks(job['time'], job['arrays_dir'])
+    random.seed(task['id'])  # a retried task draws the same simulations
+    subareas, n_sims, stats, pruned = {'hole': [], 'volcano': []}, {}, [], {}
+    for pi, flag, lambda_obs, neighbour, p_value, o_cnt, d_cnt in detect_subareas(
+            net, ran_net, job['r_time'], job['alpha'], job['epsilon'], sequential=job['sequential'],
+            n_sims=n_sims, prune=job['prune'], point_range=(job['start'], job['end']), stats=stats, pruned=pruned):
+        members = np.asarray(list(neighbour), dtype=np.float64).reshape(-1, 2)
+        subareas['hole' if flag else 'volcano'].append((pi, lambda_obs, members, p_value, o_cnt, d_cnt))
+    if job['prune']:
+        print(f'{task["id"]}: pruned {sum(pruned.values())} points: {pruned}')
+    store = ResultStore(save_dir)
+    save_subareas(store, job['time'], job['epsilon'], subareas)
+    save_point_stats(store, job['time'], job['epsilon'], stats, job['r_time'], job['alpha'], job['sequential'],
+                     job['prune'])
+    np.save(osp.join(save_dir, 'simulations.npy'), [n_sims], allow_pickle=True)
+
+
+def work(queue_root, lease_seconds, max_attempts, wait=False):
+    """
+    Lease and run tasks until the queue is drained (or forever if 'wait')
+    the lease of the running task is renewed in the background, so only a lost worker lets it expire
+    """
+    queue = TaskQueue(queue_root, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    while True:
+        task = queue.lease(worker)
+        if task is None:
+            status = queue.status()
+            if not wait and status['pending'] == 0 and status['leased'] == 0:
+                return
+            threading.Event().wait(min(lease_seconds / 4, 30))
+            continue
+        stop = threading.Event()
+
+        def renew(task_id=task['id']):
+            while not stop.wait(lease_seconds / 3):
+                queue.renew(task_id)
+
+        threading.Thread(target=renew, daemon=True).start()
+        try:
+            committed = queue.complete(task, lambda save_dir: run_task(task, save_dir))
+            print(f'[{worker}] {task["id"]} ' + ('committed' if committed else 'already committed'))
+        except Exception as e:
+            queue.fail(task, repr(e))
+            print(f'[{worker}] {task["id"]} failed: {e!r}')
+        finally:
+            stop.set()
+
+
+def merge(queue: TaskQueue, store: ResultStore):
+    """
+    Assemble the subareas of the tasks of every (time label, epsilon) in the result store,
+    once all the tasks of a (time label, epsilon) are done
+    """
+    groups = defaultdict(list)
+    for task_id, task in queue.tasks().items():
+        groups[(task['payload']['time'], task['payload']['epsilon'])].append(task)
+    for (label, epsilon), tasks in sorted(groups.items(), key=lambda kv: str(kv[0])):
+        missing = [t['id'] for t in tasks if t['state'] != 'done']
+        if missing:
+            print(f'skip {label} (epsilon = {epsilon}): {len(missing)} of {len(tasks)} tasks not done, '
+                  f'e.g. {missing[0]}')
+            continue
+        subareas, n_sims, stats, no_stats = {'hole': [], 'volcano': []}, {}, defaultdict(list), []
+        for task in sorted(tasks, key=lambda t: t['payload']['start']):
+            part = ResultStore(queue.results_dir(task['id']))
+            for kind in subareas:
+                if not part.has(label, epsilon, kind):
+                    continue
+                res = part.read(label, epsilon, kind)
+                members = [part.members(res, i) for i in range(len(res['member_indptr']) - 1)]
+                subareas[kind].extend(zip(map(tuple, res['seed_xy'].tolist()), res['lam'], members,
+                                          res['p_value'], res['o_cnt'], res['d_cnt']))
+            if part.has_table(label, epsilon):
+                for field, value in part.read_summary(label, epsilon, 'stats').items():
+                    stats[field].append(value)
+            else:
+                no_stats.append(task['id'])
+            n_sims.update(np.load(osp.join(queue.results_dir(task['id']), 'simulations.npy'), allow_pickle=True)[0])
+        save_subareas(store, label, epsilon, subareas)
+        # a table missing the points of some tasks would look complete to select_subareas()
+        if no_stats:
+            print(f'skip the stats table of {label} (epsilon = {epsilon}): {len(no_stats)} of {len(tasks)} tasks '
+                  f'have none, e.g. {no_stats[0]}')
+        else:
+            params = {k: tasks[0]['payload'][k] for k in ('r_time', 'alpha', 'sequential', 'prune')}
+            store.write_table(label, epsilon, 'stats', params=params,
+                              **{field: np.concatenate(values) for field, values in stats.items()})
+        os.makedirs('output/subareas_split_time', exist_ok=True)
+        np.save(simulations_path(label, epsilon), [n_sims], allow_pickle=True)
+        print(f'merged {label} (epsilon = {epsilon}): {len(subareas["hole"])} holes, '
+              f'{len(subareas["volcano"])} volcanoes from {len(tasks)} tasks')
+    store.catalog()
+
+
+if __name__ == '__main__':
+    """
+    Sharded identification of subareas over several nodes sharing a directory (file-based task queue)
+        coordinator:  python distributed.py submit --queue /shared/queue --dates 2014-05-07,2014-05-08
+        every node:   python distributed.py work --queue /shared/queue --processes 8
+        coordinator:  python distributed.py status --queue /shared/queue
+        coordinator:  python distributed.py merge --queue /shared/queue
+    a task is a (date, hour, epsilon, point range), a lost worker only costs the task it had leased
+    """
+    parser = argparse.ArgumentParser(description='distributed identification of subareas')
+    parser.add_argument('command', choices=('submit', 'work', 'status', 'merge'))
+    parser.add_argument('--queue', default='output/task_queue', help='the (shared) directory of the task queue')
+    parser.add_argument('--arrays-dir', default=arrays_dir, help='the (shared) directory of the network snapshots')
+    parser.add_argument('--dates', default='', help='comma separated dates, default = the saved hourly networks')
+    parser.add_argument('--hours', default='0-23')
+    parser.add_argument('--epsilon', default='1200', help='comma separated neighbourhood cutoff radii')
+    parser.add_argument('--chunk', type=int, default=2000, help='the number of od locations of each task')
+    parser.add_argument('--r-time', type=int, default=99)
+    parser.add_argument('--alpha', type=float, default=0.05)
+    parser.add_argument('--processes', type=int, default=1, help='the number of workers on this node')
+    parser.add_argument('--lease', type=float, default=600, help='seconds before the lease of a lost worker expires')
+    parser.add_argument('--max-attempts', type=int, default=3)
+    parser.add_argument('--wait', action='store_true', help='keep waiting for new tasks')
+    args = parser.parse_args()
+    _queue = TaskQueue(args.queue, lease_seconds=args.lease, max_attempts=args.max_attempts)
+    if args.command == 'submit':
+        _labels = time_labels([d for d in args.dates.split(',') if d], parse_hours(args.hours), args.arrays_dir)
+        _epsilons = [float(e) if '.' in e else int(e) for e in args.epsilon.split(',')]
+        print('submitted', submit(_queue, _labels, _epsilons, args.chunk, args.r_time, args.alpha,
+                                  sequential=True, prune=True, load_dir=args.arrays_dir), 'tasks')
+    elif args.command == 'work':
+        warm_up()  # the forked workers inherit the compiled kernels
+        _workers = [mp.Process(target=work, args=(args.queue, args.lease, args.max_attempts, args.wait))
+                    for _ in range(args.processes)]
+        for _w in _workers:
+            _w.start()
+        for _w in _workers:
+            _w.join()
+    elif args.command == 'merge':
+        merge(_queue, ResultStore())
+    print(_queue.status())
@@ -0,0 +1,362 @@
+from typing import Dict, NamedTuple, Optional, Tuple
+import math
+import numpy as np
+from numba import njit, prange
+from graph.linear import bernoulli_lambda_array
+from graph.kernel import ArrayNetWork
+
+
+class ApproxResult(NamedTuple):
+    """
+    Approximate test statistics of sampled seed points, with bounds (arrays, one entry per seed)
+    """
+    seeds: np.ndarray  # int64, indices of the seed points on the network
+    o_cnt: np.ndarray  # float64, estimated numbers of origins in the neighbourhoods
+    d_cnt: np.ndarray  # float64, estimated numbers of destinations in the neighbourhoods
+    o_bounds: np.ndarray  # float64 [n, 2], lower and upper bounds of the numbers of origins
+    d_bounds: np.ndarray  # float64 [n, 2], lower and upper bounds of the numbers of destinations
+    lam: np.ndarray  # float64, estimated lambda (nan if undefined)
+    lam_bounds: np.ndarray  # float64 [n, 2], bounds of lambda over the bounds of the counts
+    p_value: np.ndarray  # float64, p-value of the estimated lambda
+    p_bounds: np.ndarray  # float64 [n, 2], confidence bounds of the p-value
+    flag: np.ndarray  # bool, True for a black hole (more destinations), False for a volcano
+    significant: np.ndarray  # bool, p_value <= alpha and o_cnt != d_cnt
+    certain: np.ndarray  # bool, the classification holds for all the counts and p-values within the bounds
+
+
+def edge_histograms(net: ArrayNetWork, n_bins) -> np.ndarray:
+    """
+    Cumulative numbers of origin and destination records along each edge, float64 [n_edge, n_bins + 1, 2]:
+    the records within k / n_bins of the length of the edge from its first node (the records of a location
+    matched to several edges are split between them by their od ratio)
+    """
+    topo, pts = net.topology, net.points
+    offset = point_offsets(net, np.arange(len(pts.pt_xy)))
+    frac = np.divide(offset, topo.edge_len[pts.pt_edge], out=np.zeros(len(offset)),
+                     where=topo.edge_len[pts.pt_edge] > 0)
+    return cumulative_histograms(net, pts.pt_edge, frac, len(topo.edge_len), n_bins)
+
+
+def cumulative_histograms(net: ArrayNetWork, edge, frac, n_edge, n_bins) -> np.ndarray:
+    """
+    Cumulative histograms of the od points of a network placed at the fractions 'frac' of the edges 'edge'
+    (e.g. the super-edges of graph.contract), see edge_histograms()
+    """
+    pts = net.points
+    loc_n = (pts.loc_o + pts.loc_d).astype(np.float64)
+    ratio = np.divide(pts.loc_o, loc_n, out=np.zeros(len(loc_n)), where=loc_n > 0)[pts.pt_uid]
+    # bin k + 1 holds the records in (k / n_bins, (k + 1) / n_bins], the records on the first node are in bin 0
+    k = histogram_bins(frac, n_bins)
+    hist = np.zeros((n_edge, n_bins + 1, 2))
+    np.add.at(hist, (edge, k, 0), pts.pt_cnt * ratio)
+    np.add.at(hist, (edge, k, 1), pts.pt_cnt * (1.0 - ratio))
+    return np.cumsum(hist, axis=1)
+
+
+def histogram_bins(frac, n_bins) -> np.ndarray:
+    """
+    Bin of the histograms of the edges holding each fraction of an edge, see cumulative_histograms()
+    """
+    return np.minimum(np.ceil(np.asarray(frac) * n_bins).astype(np.int64), n_bins)
+
+
+def point_offsets(net: ArrayNetWork, idx) -> np.ndarray:
+    """
+    Distance from the first node of its edge of each od point
+    """
+    topo, pts = net.topology, net.points
+    edge = pts.pt_edge[idx]
+    n1 = topo.node_xy[topo.edge_nodes[edge, 0]]
+    return np.minimum(np.sqrt(((pts.pt_xy[idx] - n1) ** 2).sum(axis=1)), topo.edge_len[edge])
+
+
+@njit(cache=True, nogil=True)
+def _cumulative(cum, x, c):
+    """
+    Records up to x (in bins) of a cumulative histogram, spread uniformly within the bins
+    """
+    k = int(np.floor(x))
+    if k >= cum.shape[0] - 1:
+        return cum[-1, c]
+    return cum[k, c] + (x - k) * (cum[k + 1, c] - cum[k, c])
+
+
+@njit(cache=True, nogil=True)
+def _interval_counts(cum, st, ed, est, low, high):
+    """
+    Add the records within the fractions [st, ed] of an edge (cumulative histogram 'cum', see edge_histograms()):
+    the bins inside the interval to low, the bins it touches to high and the covered share of them to est
+    """
+    n_bins = cum.shape[0] - 1
+    st, ed = max(st, 0.0) * n_bins, min(ed, 1.0) * n_bins
+    if ed < st:
+        return
+    a, b = int(np.ceil(st)), int(np.ceil(ed))
+    for c in range(2):
+        before = cum[a - 1, c] if a > 0 else 0.0  # the bins ending before the interval
+        high[c] += cum[b, c] - before
+        low[c] += max(cum[int(np.floor(ed)), c] - (cum[a, c] if st > 0 else 0.0), 0.0)
+        est[c] += _cumulative(cum, ed, c) - (_cumulative(cum, st, c) if st > 0 else 0.0)
+
+
+@njit(cache=True, nogil=True)
+def approx_neighbor_counts(e0, offset, epsilon, node_indptr, node_edges, edge_nodes, edge_len, edge_cum):
+    """
+    Od counts of a neighbourhood estimated from the cumulative histograms of the edges (the same
+    edge-expansion as graph.kernel.expand_neighbors, without visiting any od point)
+
+    The edges fully covered by the neighbourhood count all their records. An edge partly covered counts
+    the records of the bins it covers, and of the bins it cuts between none and all of them (estimated
+    as if they were spread uniformly within the bin).
+
+    Returns
+    ----------
+    est : np.ndarray
+        estimated numbers of origins and destinations
+    low, high : np.ndarray
+        lower and upper bounds of the numbers of origins and destinations
+    """
+    n_edge = edge_nodes.shape[0]
+    est, low, high = np.zeros(2), np.zeros(2), np.zeros(2)
+    cover = np.zeros(2 * n_edge)  # length covered from each end of the partial edges
+    touched = np.empty(n_edge + 1, dtype=np.int64)
+    n_touched = 0
+    explored = np.zeros(n_edge, dtype=np.bool_)
+    explored[e0] = True
+    queue_n = np.empty(n_edge + 2, dtype=np.int64)
+    queue_d = np.empty(n_edge + 2, dtype=np.float64)
+    queue_n[0], queue_d[0] = edge_nodes[e0, 0], epsilon - offset
+    queue_n[1], queue_d[1] = edge_nodes[e0, 1], epsilon - (edge_len[e0] - offset)
+    head, tail = 0, 2
+    while head < tail:
+        n, d = queue_n[head], queue_d[head]
+        head += 1
+        if d <= 0:
+            continue
+        for a in range(node_indptr[n], node_indptr[n + 1]):
+            r = node_edges[a]
+            side = 0 if edge_nodes[r, 0] == n else 1
+            if r == e0:
+                # the seed's edge reached around through its nodes (only shorter on a chain, see graph.contract)
+                cover[2 * r + side] = max(cover[2 * r + side], d)
+                continue
+            if explored[r]:
+                continue
+            dis = d - edge_len[r]
+            if dis >= 0:
+                explored[r] = True
+                for c in range(2):
+                    est[c] += edge_cum[r, -1, c]
+                    low[c] += edge_cum[r, -1, c]
+                    high[c] += edge_cum[r, -1, c]
+                queue_n[tail] = edge_nodes[r, 1 - side]
+                queue_d[tail] = dis
+                tail += 1
+            else:
+                if cover[2 * r] == 0 and cover[2 * r + 1] == 0:
+                    touched[n_touched] = r
+                    n_touched += 1
+                cover[2 * r + side] = max(cover[2 * r + side], d)
+                if edge_nodes[r, 0] == edge_nodes[r, 1]:
+                    cover[2 * r + 1 - side] = max(cover[2 * r + 1 - side], d)  # a loop is entered from both ends
+    for i in range(n_touched):
+        r = touched[i]
+        if explored[r]:
+            continue  # fully covered later on
+        length = max(edge_len[r], 1e-9)
+        st, ed = cover[2 * r] / length, 1.0 - cover[2 * r + 1] / length
+        if st >= ed:
+            _interval_counts(edge_cum[r], 0.0, 1.0, est, low, high)
+            continue
+        if cover[2 * r] > 0:
+            _interval_counts(edge_cum[r], 0.0, st, est, low, high)
+        if cover[2 * r + 1] > 0:
+            _interval_counts(edge_cum[r], ed, 1.0, est, low, high)
+    # the part of the seed's edge within epsilon, merged with the parts covered from its nodes
+    length = max(edge_len[e0], 1e-9)
+    st, ed = max(offset - epsilon, 0.0), min(offset + epsilon, length)
+    head_cover, tail_cover = cover[2 * e0], length - cover[2 * e0 + 1]
+    if head_cover >= st:
+        st, ed = 0.0, max(ed, head_cover)
+    if tail_cover <= ed:
+        st, ed = min(st, tail_cover), length
+    _interval_counts(edge_cum[e0], st / length, ed / length, est, low, high)
+    if 0 < head_cover < st:
+        _interval_counts(edge_cum[e0], 0.0, head_cover / length, est, low, high)
+    if ed < tail_cover < length:
+        _interval_counts(edge_cum[e0], tail_cover / length, 1.0, est, low, high)
+    return est, low, high
+
+
+@njit(parallel=True, cache=True)
+def batch_approx_counts(edges, offsets, epsilon, node_indptr, node_edges, edge_nodes, edge_len, edge_cum):
+    """
+    approx_neighbor_counts() of many seeds (in parallel), arrays [n, 2] of (origins, destinations)
+    """
+    n = edges.shape[0]
+    est, low, high = np.zeros((n, 2)), np.zeros((n, 2)), np.zeros((n, 2))
+    for i in prange(n):
+        est[i], low[i], high[i] = approx_neighbor_counts(edges[i], offsets[i], epsilon, node_indptr, node_edges,
+                                                         edge_nodes, edge_len, edge_cum)
+    return est, low, high
+
+
+def approx_counts(net: ArrayNetWork, epsilon, seeds, n_bins=16) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Estimated od counts of the neighbourhoods of the seed points and their bounds, arrays [n, 2]
+    the records of the seed location are not counted (as graph.kernel.expand_neighbors), except for lixels
+    the edges are summarized by cumulative histograms of 'n_bins' (see edge_histograms())
+    """
+    seeds = np.asarray(seeds, dtype=np.int64)
+    topo = net.topology
+    est, low, high = batch_approx_counts(net.points.pt_edge[seeds].astype(np.int64), point_offsets(net, seeds),
+                                         float(epsilon), topo.node_indptr, topo.node_edges, topo.edge_nodes,
+                                         topo.edge_len, edge_histograms(net, n_bins))
+    if not net.include_seed:
+        uid = net.points.pt_uid[seeds]
+        own = np.stack((net.points.loc_o[uid], net.points.loc_d[uid]), axis=1).astype(np.float64)
+        est, low, high = np.maximum(est - own, 0), np.maximum(low - own, 0), np.maximum(high - own, 0)
+    return est, low, high
+
+
+def lambda_bounds(low, high, o_all, d_all) -> np.ndarray:
+    """
+    Bounds of lambda over the boxes of od counts [low, high] ([n, 2] arrays of origins and destinations)
+
+    Lambda grows with the origins and falls with the destinations of a region whose origin ratio is
+    above the one of the whole network (and the other way round below it), and it is 0 on that ratio,
+    so its bounds over a box are at its corners (or 0 if the box crosses the ratio).
+    """
+    # the corners with most origins / most destinations
+    lam_o = bernoulli_lambda_array(high[:, 0], low[:, 1], o_all, d_all)
+    lam_d = bernoulli_lambda_array(low[:, 0], high[:, 1], o_all, d_all)
+    ratio = o_all / float(o_all + d_all)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        above = low[:, 0] / (low[:, 0] + high[:, 1]) > ratio  # the whole box above the ratio
+        below = high[:, 0] / (high[:, 0] + low[:, 1]) < ratio  # the whole box below the ratio
+    lam_low = np.where(above, lam_d, np.where(below, lam_o, 0.0))
+    lam_high = np.fmax(lam_o, lam_d)
+    return np.stack((lam_low, lam_high), axis=1)
+
+
+def stratified_seeds(net: ArrayNetWork, sample_rate, rng: np.random.Generator) -> np.ndarray:
+    """
+    Sample the seed points stratified by road: ceil(sample_rate * n) of the n distinct locations of each edge
+    (the locations are counted on the edge of their first point, as in all_matches())
+    """
+    _, first = np.unique(net.points.pt_uid, return_index=True)
+    first = np.sort(first)
+    edge = net.points.pt_edge[first]
+    order = np.lexsort((rng.random(len(first)), edge))  # shuffled within each edge
+    edge_sorted = edge[order]
+    rank = np.arange(len(order)) - np.searchsorted(edge_sorted, edge_sorted, side='left')
+    n_edge = np.bincount(edge, minlength=len(net.topology.edge_len))[edge_sorted]
+    keep = rank < np.ceil(sample_rate * n_edge)
+    return np.sort(first[order[keep]])
+
+
+def approximate_test(net: ArrayNetWork, ran_net: ArrayNetWork, alpha, epsilon, sample_rate=0.25, n_bins=16,
+                     n_null=2000, delta=0.05, seed=None) -> ApproxResult:
+    """
+    Approximate identification of subareas for high volumes of od data (e.g. months of them)
+
+    The seed points are sampled by road (see stratified_seeds()) and the od counts of their neighbourhoods
+    are estimated from histograms of the records along the edges (see approx_neighbor_counts()), so no od
+    point is visited.
+    The p-values are estimated from the lambdas of 'n_null' random seeds on the random network
+    (estimated in the same way) instead of r_time simulations for every seed.
+
+    Bounds are reported for each seed:
+        counts   the records of the bins cut by the neighbourhood are all inside or all outside it
+        lambda   its range over the bounds of the counts (see lambda_bounds())
+        p-value  from the bounds of lambda, widened by a Hoeffding margin for the finite null sample
+                 (confidence 1 - delta)
+    and the classification is 'certain' if the flag (more destinations or origins) holds over the bounds
+    of the counts and the upper bound of the p-value is still below alpha.
+
+    Parameters
+    ----------
+    net : ArrayNetWork
+        the observed road network
+    ran_net : ArrayNetWork
+        the random road network
+    alpha : float
+        a significance level
+    epsilon : int or float
+        the neighbourhood cutoff radius
+    sample_rate : float, optional
+        the share of the locations of each road tested (the speed / accuracy knob), default = 0.25
+    n_bins : int, optional
+        the number of bins of the histograms of the edges (the width of the bounds), default = 16
+    n_null : int, optional
+        the number of simulated lambdas estimating the null distribution, default = 2000
+    delta : float, optional
+        1 - confidence of the bounds of the p-values, default = 0.05
+    seed : int, optional
+        random seed of the sampling
+
+    Returns
+    ----------
+    result : ApproxResult
+    """
+    rng = np.random.default_rng(seed)
+    seeds = stratified_seeds(net, sample_rate, rng)
+    est, low, high = approx_counts(net, epsilon, seeds, n_bins)
+    lam = bernoulli_lambda_array(est[:, 0], est[:, 1], net.o_count, net.d_count)
+    lam_bounds = lambda_bounds(low, high, net.o_count, net.d_count)
+    # null distribution: random od records drawn as ran_net.random_match() (uniform road, then record)
+    roads = np.nonzero(np.diff(ran_net.points.pt_indptr) > 0)[0]
+    cum_cnt = np.concatenate(([0], np.cumsum(ran_net.points.pt_cnt))).astype(np.int64)
+    edge = roads[rng.integers(len(roads), size=n_null)]
+    lo, hi = cum_cnt[ran_net.points.pt_indptr[edge]], cum_cnt[ran_net.points.pt_indptr[edge + 1]]
+    null_seeds = np.searchsorted(cum_cnt, lo + (rng.random(n_null) * (hi - lo)).astype(np.int64), side='right') - 1
+    null_est, _, _ = approx_counts(ran_net, epsilon, null_seeds, n_bins)
+    null_lam = bernoulli_lambda_array(null_est[:, 0], null_est[:, 1], ran_net.o_count, ran_net.d_count)
+    null_lam = np.sort(null_lam[~np.isnan(null_lam)])
+
+    def p_of(values):
+        exceed = len(null_lam) - np.searchsorted(null_lam, np.nan_to_num(values, nan=np.inf), side='right')
+        return (exceed + 1.0) / (n_null + 1.0)
+
+    margin = math.sqrt(math.log(2.0 / delta) / (2.0 * n_null))
+    p_value = np.where(np.isnan(lam), 1.0, p_of(lam))
+    p_bounds = np.stack((np.maximum(p_of(lam_bounds[:, 1]) - margin, 0.0),
+                         np.minimum(p_of(lam_bounds[:, 0]) + margin, 1.0)), axis=1)
+    flag = est[:, 1] > est[:, 0]
+    significant = (p_value <= alpha) & (est[:, 0] != est[:, 1])
+    sure_flag = np.where(flag, low[:, 1] > high[:, 0], low[:, 0] > high[:, 1])
+    certain = np.where(significant, sure_flag & (p_bounds[:, 1] <= alpha), p_bounds[:, 0] > alpha)
+    return ApproxResult(seeds, est[:, 0], est[:, 1], np.stack((low[:, 0], high[:, 0]), axis=1),
+                        np.stack((low[:, 1], high[:, 1]), axis=1), lam, lam_bounds, p_value, p_bounds, flag,
+                        significant, certain)
+
+
+def classification_agreement(result: ApproxResult, exact: Dict[int, Optional[bool]]) -> Dict[str, float]:
+    """
+    Agreement of the approximate classification of the seeds with the exact one
+
+    Parameters
+    ----------
+    result : ApproxResult
+        the approximate result
+    exact : dict
+        {seed index => True (black hole), False (volcano) or None (not significant)} of the exact path
+
+    Returns
+    ----------
+    agreement : dict
+        'accuracy' share of the seeds with the same class (hole, volcano or none),
+        'precision' / 'recall' of the significant seeds (with the same flag),
+        'certain' share of the seeds classified with certainty and 'certain_accuracy' the accuracy among them
+    """
+    approx = [bool(f) if s else None for f, s in zip(result.flag, result.significant)]
+    truth = [exact.get(int(i)) for i in result.seeds]
+    same = np.asarray([a == t for a, t in zip(approx, truth)])
+    n_approx = sum(a is not None for a in approx)
+    n_truth = sum(t is not None for t in truth)
+    n_both = sum(a is not None and a == t for a, t in zip(approx, truth))
+    return {'accuracy': float(same.mean()) if len(same) else float('nan'),
+            'precision': n_both / n_approx if n_approx else float('nan'),
+            'recall': n_both / n_truth if n_truth else float('nan'),
+            'certain': float(result.certain.mean()) if len(same) else float('nan'),
+            'certain_accuracy': float(same[result.certain].mean()) if result.certain.any() else float('nan')}
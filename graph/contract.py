@@ -0,0 +1,192 @@
+from typing import Dict, List, NamedTuple, Tuple
+import numpy as np
+from numba import njit
+from graph.kernel import ArrayNetWork, Topology
+from graph.linear import bernoulli_lambda_array
+from graph.approx import batch_approx_counts, cumulative_histograms, histogram_bins, point_offsets
+from graph.prune import simulate_null_lambdas
+
+
+class Contraction(NamedTuple):
+    """
+    Position of each edge of a road network on the super-edges of its contracted network (see contract_chains())
+    """
+    edge_super: np.ndarray  # int64 [m], super-edge holding each edge
+    edge_start: np.ndarray  # float64 [m], distance along the super-edge from its first node to the edge
+    edge_flip: np.ndarray  # bool [m], whether the edge runs backwards along its super-edge
+
+
+@njit(cache=True)
+def walk_chains(node_indptr, node_edges, edge_nodes, edge_len):
+    """
+    Walk the chains of edges joined by nodes of degree 2, from a junction (or a dead end) to the next one,
+    then the closed chains without any junction (from the first node of their first edge)
+
+    Returns
+    ----------
+    edge_super, edge_start, edge_flip : np.ndarray
+        see Contraction
+    super_nodes : np.ndarray
+        int64 [k, 2], nodes of both ends of each super-edge
+    super_len : np.ndarray
+        float64 [k], length of each super-edge
+    """
+    n_node, n_edge = node_indptr.shape[0] - 1, edge_nodes.shape[0]
+    inner = np.zeros(n_node, dtype=np.bool_)
+    for n in range(n_node):
+        if node_indptr[n + 1] - node_indptr[n] == 2:
+            inner[n] = node_edges[node_indptr[n]] != node_edges[node_indptr[n] + 1]
+    edge_super = np.full(n_edge, -1, dtype=np.int64)
+    edge_start = np.zeros(n_edge)
+    edge_flip = np.zeros(n_edge, dtype=np.bool_)
+    super_nodes = np.empty((n_edge, 2), dtype=np.int64)
+    super_len = np.empty(n_edge)
+    k = 0
+    for closed in range(2):
+        for e in range(n_edge):
+            if edge_super[e] >= 0:
+                continue
+            n0 = edge_nodes[e, 0]
+            if inner[n0] and closed == 0:
+                n0 = edge_nodes[e, 1]
+                if inner[n0]:
+                    continue  # inside a chain, walked from one of its ends
+            n, r, length = n0, e, 0.0
+            while True:
+                edge_super[r] = k
+                edge_start[r] = length
+                edge_flip[r] = edge_nodes[r, 0] != n
+                length += edge_len[r]
+                n = edge_nodes[r, 1] if edge_nodes[r, 0] == n else edge_nodes[r, 0]
+                if not inner[n] or n == n0:
+                    break
+                a = node_indptr[n]
+                r = node_edges[a] if node_edges[a] != r else node_edges[a + 1]
+            super_nodes[k, 0], super_nodes[k, 1] = n0, n
+            super_len[k] = length
+            k += 1
+    return edge_super, edge_start, edge_flip, super_nodes[:k], super_len[:k]
+
+
+def contract_chains(topology: Topology) -> Tuple[Topology, Contraction]:
+    """
+    Contract a road network: every chain of edges joined by nodes of degree 2 becomes one super-edge
+    (its length is the length of the chain), only the junctions and dead ends are kept as nodes
+
+    The network distances between the points of the super-edges (measured along them) are the ones of
+    the road network, while the coarse graph has far fewer edges and nodes to expand.
+    The super-edges keep the road id of their first edge.
+
+    Returns
+    ----------
+    contracted : Topology
+        the contracted network (the coordinates of the nodes are kept, a super-edge is not straight)
+    contraction : Contraction
+        the super-edge of each edge of the road network
+    """
+    edge_super, edge_start, edge_flip, super_nodes, super_len = walk_chains(
+        topology.node_indptr, topology.node_edges, topology.edge_nodes, topology.edge_len)
+    nodes, ends = np.unique(super_nodes, return_inverse=True)
+    ends = ends.reshape(-1, 2)
+    n_super = len(super_len)
+    adj_node = np.concatenate((ends[:, 0], ends[:, 1]))
+    order = np.argsort(adj_node, kind='stable')
+    node_indptr = np.concatenate(([0], np.cumsum(np.bincount(adj_node, minlength=len(nodes))))).astype(np.int64)
+    first = np.lexsort((edge_start, edge_super))
+    first = first[np.searchsorted(edge_super[first], np.arange(n_super))]
+    contracted = Topology(topology.node_xy[nodes], node_indptr,
+                          np.tile(np.arange(n_super), 2)[order].astype(np.int32), ends.astype(np.int32),
+                          super_len, topology.road_ids[first])
+    return contracted, Contraction(edge_super, edge_start, edge_flip)
+
+
+def chain_cells(net: ArrayNetWork, contraction: Contraction, super_len,
+                n_bins) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Super-edge, fraction of its length and cell (bin of its histogram, see graph.approx.cumulative_histograms)
+    of each od point of a network
+    """
+    edge = net.points.pt_edge
+    offset = point_offsets(net, np.arange(len(edge)))
+    offset = contraction.edge_start[edge] + np.where(contraction.edge_flip[edge],
+                                                     net.topology.edge_len[edge] - offset, offset)
+    super_edge = contraction.edge_super[edge]
+    frac = np.clip(np.divide(offset, super_len[super_edge], out=np.zeros(len(edge)),
+                             where=super_len[super_edge] > 0), 0.0, 1.0)
+    return super_edge, frac, histogram_bins(frac, n_bins)
+
+
+def coarse_screen(net: ArrayNetWork, ran_net: ArrayNetWork, alpha, epsilon, screen_alpha=None, n_bins=64,
+                  n_null=2000, points=None) -> Tuple[List[Tuple[float, float]], Dict[str, int]]:
+    """
+    Coarse pass of the hierarchical detection: the od locations in the candidate regions of subareas,
+    detected on the contracted network (see contract_chains()) from aggregated counts, without searching
+    any location
+
+    The super-edges are cut into 'n_bins' cells and the od records are counted by cell (cumulative
+    histograms, see graph.approx.cumulative_histograms). The od counts of the neighbourhood of the middle
+    of each cell holding records are estimated from them (graph.approx.approx_neighbor_counts, the records
+    of one location of the cell are not counted, except for lixels), and its lambda is tested against
+    'n_null' lambdas simulated on the random network (see graph.prune.simulate_null_lambdas).
+    The locations of a cell are candidates if its p-value is at most 'screen_alpha', looser than alpha
+    since the neighbourhoods of the locations of a cell differ a little from the one of its middle.
+    The cells whose neighbourhoods hold less than one origin or destination (lambda undefined but extreme
+    in the exact test) are always candidates.
+
+    Parameters
+    ----------
+    net : ArrayNetWork
+        the observed road network
+    ran_net : ArrayNetWork
+        the random road network
+    alpha : float
+        a significance level
+    epsilon : int or float
+        the neighbourhood cutoff radius
+    screen_alpha : float, optional
+        the significance level of the cells, default = 4 * alpha
+    n_bins : int, optional
+        the number of cells of each super-edge, default = 64
+    n_null : int, optional
+        the number of simulated lambdas estimating the null distribution, default = 2000
+    points : list, optional
+        the od locations to be screened, default = all the distinct locations on 'net'
+
+    Returns
+    ----------
+    points : list
+        the candidate od locations
+    screened : dict
+        the numbers of super-edges, cells (holding od records) and candidate cells
+    """
+    if points is None:
+        points = net.all_matches()
+    if screen_alpha is None:
+        screen_alpha = min(4 * alpha, 1.0)
+    contracted, contraction = contract_chains(net.topology)
+    super_len = contracted.edge_len
+    super_edge, frac, cell = chain_cells(net, contraction, super_len, n_bins)
+    edge_cum = cumulative_histograms(net, super_edge, frac, len(super_len), n_bins)
+    # the cells holding od records
+    cells, inverse = np.unique(super_edge * (n_bins + 1) + cell, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    edge, k = cells // (n_bins + 1), cells % (n_bins + 1)
+    middle = np.maximum(k - 0.5, 0.0) * super_len[edge] / n_bins
+    est, _, _ = batch_approx_counts(edge.astype(np.int64), middle, float(epsilon), contracted.node_indptr,
+                                    contracted.node_edges, contracted.edge_nodes, super_len, edge_cum)
+    if not net.include_seed:
+        # the average records of a location of the cell
+        uid, n_loc = net.points.pt_uid, np.bincount(inverse, minlength=len(cells))
+        own = np.stack((np.bincount(inverse, weights=net.points.loc_o[uid], minlength=len(cells)),
+                        np.bincount(inverse, weights=net.points.loc_d[uid], minlength=len(cells))), axis=1)
+        est = np.maximum(est - own / n_loc[:, None], 0.0)
+    lam = bernoulli_lambda_array(est[:, 0], est[:, 1], net.o_count, net.d_count)
+    null_lambdas = simulate_null_lambdas(ran_net, epsilon, n_null)
+    exceed = len(null_lambdas) - np.searchsorted(null_lambdas, np.nan_to_num(lam, nan=np.inf), side='right')
+    keep = (exceed / (1.0 + n_null) <= screen_alpha) | (est < 1.0).any(axis=1)
+    # the locations are screened by the cell of their first point (as all_matches())
+    _, first = np.unique(net.points.pt_uid, return_index=True)
+    loc_keep = np.zeros(len(net.points.loc_o), dtype=np.bool_)
+    loc_keep[net.points.pt_uid[first]] = keep[inverse[first]]
+    screened = {'super_edges': len(super_len), 'cells': len(cells), 'candidate_cells': int(keep.sum())}
+    return [pi for pi in points if loc_keep[net.points.pt_uid[net.index_of(pi)]]], screened
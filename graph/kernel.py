@@ -0,0 +1,355 @@
+from typing import NamedTuple, Optional, Set, Tuple
+import os
+import os.path as osp
+import random
+import numpy as np
+from numba import njit, prange
+from graph.linear import euclidean_distance, bernoulli_lambda
+from graph.roadnet import RoadNetWork
+
+
+class Topology(NamedTuple):
+    """
+    Array-backed topology of a road network (shared by all the od point sets on it)
+    """
+    node_xy: np.ndarray  # float64 [n, 2], coordinates of nodes
+    node_indptr: np.ndarray  # int64 [n + 1], node -> edges (CSR)
+    node_edges: np.ndarray  # int32 [2 * m], edge indices adjacent to each node
+    edge_nodes: np.ndarray  # int32 [m, 2], node indices of both ends of each edge
+    edge_len: np.ndarray  # float64 [m], length of each edge
+    road_ids: np.ndarray  # int32 [m], road id of each edge
+
+
+class Points(NamedTuple):
+    """
+    Array-backed od points on a road network, grouped by edge (CSR)
+
+    The records at the same location are stored once (per edge) with their origin and destination
+    multiplicities, so the neighbourhood counts are exact while each location is searched only once.
+    """
+    pt_indptr: np.ndarray  # int64 [m + 1], edge -> od points
+    pt_xy: np.ndarray  # float64 [p, 2], coordinates of od points
+    pt_edge: np.ndarray  # int32 [p], edge index of each od point
+    pt_uid: np.ndarray  # int32 [p], id of the location (points with the same coordinates share the id)
+    pt_cnt: np.ndarray  # int32 [p], number of records of each od point on its edge
+    loc_o: np.ndarray  # int32 [u], number of origin records at each location
+    loc_d: np.ndarray  # int32 [u], number of destination records at each location
+
+
+def build_topology(net: RoadNetWork) -> Topology:
+    """
+    Convert the topology of a RoadNetWork to arrays (node and edge orders are kept)
+    """
+    node_index = {node: i for i, node in enumerate(net.adjacency.keys())}
+    road_index = {road_id: i for i, road_id in enumerate(net.edges.keys())}
+    node_xy = np.asarray(list(net.adjacency.keys()), dtype=np.float64).reshape(-1, 2)
+    degree = np.asarray([len(roads) for roads in net.adjacency.values()], dtype=np.int64)
+    node_indptr = np.concatenate(([0], np.cumsum(degree))).astype(np.int64)
+    node_edges = np.asarray([road_index[r] for roads in net.adjacency.values() for r in roads], dtype=np.int32)
+    edge_nodes = np.asarray([(node_index[n1], node_index[n2]) for n1, n2 in net.edges.values()],
+                            dtype=np.int32).reshape(-1, 2)
+    # keep the single precision lengths used by the edge-expansion of RoadNetWork
+    edge_len = np.asarray([euclidean_distance(n1, n2) for n1, n2 in net.edges.values()], dtype=np.float64)
+    road_ids = np.asarray(list(net.edges.keys()), dtype=np.int32)
+    return Topology(node_xy, node_indptr, node_edges, edge_nodes, edge_len, road_ids)
+
+
+def build_points(net: RoadNetWork, topology: Topology) -> Points:
+    """
+    Convert the od points of a RoadNetWork (on the given topology) to arrays, one per location and edge
+    """
+    road_index = {int(road_id): i for i, road_id in enumerate(topology.road_ids)}
+    n_edge = len(topology.road_ids)
+    xy, flags, edges = [], [], []
+    for road_id, matches in net.matches.items():
+        xy.append(np.asarray(matches, dtype=np.float64).reshape(-1, 2))
+        flags.append(np.asarray(net.od_flags[road_id], dtype=np.bool_))
+        edges.append(np.full(len(matches), road_index[int(road_id)], dtype=np.int64))
+    xy = np.concatenate(xy) if xy else np.zeros((0, 2), dtype=np.float64)
+    flags = np.concatenate(flags) if flags else np.zeros(0, dtype=np.bool_)
+    edges = np.concatenate(edges) if edges else np.zeros(0, dtype=np.int64)
+    loc_xy, uid = np.unique(xy, axis=0, return_inverse=True)
+    uid = uid.reshape(-1)
+    if getattr(net, 'od_weights', None):
+        # the matches are cleaned already, the multiplicities are kept by the network
+        weights = np.asarray([net.od_weights[pi] for pi in map(tuple, loc_xy.tolist())], dtype=np.int64)
+        loc_o, loc_d = weights.reshape(-1, 2)[:, 0], weights.reshape(-1, 2)[:, 1]
+    else:
+        loc_o = np.bincount(uid, weights=flags, minlength=len(loc_xy))
+        loc_d = np.bincount(uid, weights=~flags, minlength=len(loc_xy))
+    # one point per (edge, location), grouped by edge
+    entries, pt_cnt = np.unique(np.stack((edges, uid), axis=1), axis=0, return_counts=True)
+    entries = entries.reshape(-1, 2)
+    pt_indptr = np.concatenate(([0], np.cumsum(np.bincount(entries[:, 0], minlength=n_edge)))).astype(np.int64)
+    return Points(pt_indptr, loc_xy[entries[:, 1]], entries[:, 0].astype(np.int32), entries[:, 1].astype(np.int32),
+                  pt_cnt.astype(np.int32), loc_o.astype(np.int32), loc_d.astype(np.int32))
+
+
+def save_arrays(save_dir, arrays) -> None:
+    """
+    Save each array of a Topology or Points as a npy file in 'save_dir' (to be mapped by load_arrays())
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    for name, arr in arrays._asdict().items():
+        np.save(osp.join(save_dir, f'{name}.npy'), arr)
+
+
+def load_arrays(load_dir, cls, mmap_mode='r'):
+    """
+    Load a Topology or Points (cls) saved by save_arrays()
+    the files are memory-mapped by default, so all the processes loading them share the same
+    physical pages (zero-copy) instead of holding their own copy
+    """
+    return cls(**{name: np.asarray(np.load(osp.join(load_dir, f'{name}.npy'), mmap_mode=mmap_mode))
+                  for name in cls._fields})
+
+
+def has_arrays(load_dir, cls) -> bool:
+    """
+    Whether all the arrays of a Topology or Points (cls) are saved in 'load_dir'
+    """
+    return all(osp.exists(osp.join(load_dir, f'{name}.npy')) for name in cls._fields)
+
+
+@njit(cache=True)
+def _distance_32(x1, y1, x2, y2):
+    """
+    single precision Euclidean distance (the same as graph.linear.euclidean_distance)
+    """
+    dx = np.float32(np.float32(x1) - np.float32(x2))
+    dy = np.float32(np.float32(y1) - np.float32(y2))
+    return np.float64(np.float32(np.sqrt(np.float32(dx * dx + dy * dy))))
+
+
+@njit(cache=True, nogil=True)
+def expand_neighbors(seed, epsilon, node_xy, node_indptr, node_edges, edge_nodes, edge_len,
+                     pt_indptr, pt_xy, pt_edge, pt_uid, pt_cnt, loc_o, loc_d, include_seed):
+    """
+    Edge-expansion of RoadNetWork.network_constrained_neighbors over the array-backed network
+
+    Parameters
+    ----------
+    seed : int
+        index of the od point specified to search for
+    epsilon : float
+        the neighbourhood cutoff radius
+    others : np.ndarray
+        arrays of Topology and Points
+    include_seed : bool
+        whether the location of the seed is in its own neighbourhood (e.g. a lixel, see graph.lixel)
+
+    Returns
+    ----------
+    members : np.ndarray
+        indices of the od points in the neighbourhood (one per location)
+    ori_cnt : int
+        number of origin records inside region (weighted by the multiplicities of the locations)
+    des_cnt : int
+        number of destination records inside region
+    """
+    n_edge = edge_nodes.shape[0]
+    seen = np.zeros(loc_o.shape[0], dtype=np.bool_)
+    members = np.empty(pt_xy.shape[0], dtype=np.int64)
+    k, ori_cnt, des_cnt = 0, 0, 0
+    sx, sy = pt_xy[seed, 0], pt_xy[seed, 1]
+    e0 = pt_edge[seed]
+    # search the matches on the matched road of the seed firstly
+    for j in range(pt_indptr[e0], pt_indptr[e0 + 1]):
+        u = pt_uid[j]
+        if (u == pt_uid[seed] and not include_seed) or seen[u]:
+            continue
+        if np.sqrt((pt_xy[j, 0] - sx) ** 2 + (pt_xy[j, 1] - sy) ** 2) <= epsilon:
+            seen[u] = True
+            members[k] = j
+            k += 1
+            ori_cnt += loc_o[u]
+            des_cnt += loc_d[u]
+    # then, expand the edges (bfs with an array queue, each edge is fully explored at most once)
+    explored = np.zeros(n_edge, dtype=np.bool_)
+    explored[e0] = True
+    queue_n = np.empty(n_edge + 2, dtype=np.int64)
+    queue_d = np.empty(n_edge + 2, dtype=np.float64)
+    head, tail = 0, 0
+    for t in range(2):
+        n = edge_nodes[e0, t]
+        queue_n[tail] = n
+        queue_d[tail] = epsilon - _distance_32(sx, sy, node_xy[n, 0], node_xy[n, 1])
+        tail += 1
+    while head < tail:
+        n, d = queue_n[head], queue_d[head]
+        head += 1
+        if d <= 0:
+            continue
+        nx, ny = node_xy[n, 0], node_xy[n, 1]
+        for a in range(node_indptr[n], node_indptr[n + 1]):
+            r = node_edges[a]
+            if explored[r]:
+                continue
+            n2 = edge_nodes[r, 1] if edge_nodes[r, 0] == n else edge_nodes[r, 0]
+            dis = d - edge_len[r]
+            full = dis >= 0
+            for j in range(pt_indptr[r], pt_indptr[r + 1]):
+                u = pt_uid[j]
+                if seen[u]:
+                    continue
+                # partial edges only keep the points within the remaining distance from the node
+                if full or np.sqrt((pt_xy[j, 0] - nx) ** 2 + (pt_xy[j, 1] - ny) ** 2) <= d:
+                    seen[u] = True
+                    members[k] = j
+                    k += 1
+                    ori_cnt += loc_o[u]
+                    des_cnt += loc_d[u]
+            if full:
+                explored[r] = True
+                queue_n[tail] = n2
+                queue_d[tail] = dis
+                tail += 1
+    return members[:k], ori_cnt, des_cnt
+
+
+@njit(parallel=True, cache=True)
+def batch_neighbor_counts(seeds, epsilon, node_xy, node_indptr, node_edges, edge_nodes, edge_len,
+                          pt_indptr, pt_xy, pt_edge, pt_uid, pt_cnt, loc_o, loc_d, include_seed):
+    """
+    Od counts of the neighbourhoods of many seed points (in parallel)
+    """
+    ori_cnt = np.zeros(seeds.shape[0], dtype=np.int64)
+    des_cnt = np.zeros(seeds.shape[0], dtype=np.int64)
+    for i in prange(seeds.shape[0]):
+        _, ori_cnt[i], des_cnt[i] = expand_neighbors(seeds[i], epsilon, node_xy, node_indptr, node_edges,
+                                                     edge_nodes, edge_len, pt_indptr, pt_xy, pt_edge,
+                                                     pt_uid, pt_cnt, loc_o, loc_d, include_seed)
+    return ori_cnt, des_cnt
+
+
+class ArrayNetWork:
+    """
+    Read-only road network backed by arrays, a drop-in replacement of RoadNetWork for
+    neighbourhood searches and test statistics running in compiled kernels
+    """
+
+    def __init__(self, topology: Topology, points: Points, totals: Optional[Tuple[int, int]] = None,
+                 include_seed=False) -> None:
+        """
+        'totals' are the (origin, destination) counts of the whole network if the points are only a part
+        of it, e.g. a tile (see graph.partition), default = the counts of 'points'
+        the records at the location of a seed are counted in its neighbourhood if 'include_seed'
+        (the points are lixels holding many records, see graph.lixel)
+        """
+        self.topology = topology
+        self.points = points
+        self.include_seed = bool(include_seed)
+        if totals is None:
+            totals = (points.loc_o.sum(), points.loc_d.sum())
+        self.o_count = int(totals[0])
+        self.d_count = int(totals[1])
+        self.od_count = self.o_count + self.d_count
+        self.__point_index = None
+        self.__nonempty = np.nonzero(np.diff(points.pt_indptr) > 0)[0]
+        self.__cum_cnt = np.concatenate(([0], np.cumsum(points.pt_cnt))).astype(np.int64)
+
+    @staticmethod
+    def from_network(net: RoadNetWork, topology: Optional[Topology] = None):
+        """
+        Build from a RoadNetWork (the topology can be shared by networks on the same roads)
+        """
+        if topology is None:
+            topology = build_topology(net)
+        return ArrayNetWork(topology, build_points(net, topology))
+
+    def index_of(self, pi) -> int:
+        """
+        Index of the given od point (an index or coordinates)
+        """
+        if isinstance(pi, (int, np.integer)):
+            return int(pi)
+        if self.__point_index is None:
+            self.__point_index = {}
+            for idx in range(len(self.points.pt_xy) - 1, -1, -1):
+                self.__point_index[self.point(idx)] = idx
+        assert pi in self.__point_index and pi is not None, 'pi should be on the network'
+        return self.__point_index[pi]
+
+    def point(self, idx) -> Tuple[float, float]:
+        return float(self.points.pt_xy[idx, 0]), float(self.points.pt_xy[idx, 1])
+
+    def all_matches(self):
+        """
+        Returns all the distinct od locations on the network (list of coordinates)
+        """
+        _, first = np.unique(self.points.pt_uid, return_index=True)
+        return [self.point(idx) for idx in np.sort(first)]
+
+    def random_match(self, rng=random) -> int:
+        """
+        Sample a road with matches uniformly and then an od record on it uniformly (drawn by 'rng')
+        """
+        edge = rng.choice(self.__nonempty)
+        lo, hi = self.points.pt_indptr[edge], self.points.pt_indptr[edge + 1]
+        k = self.__cum_cnt[lo] + rng.randrange(self.__cum_cnt[hi] - self.__cum_cnt[lo])
+        return int(np.searchsorted(self.__cum_cnt, k, side='right')) - 1
+
+    def neighbor_indices(self, epsilon, pi) -> Tuple[np.ndarray, int, int]:
+        """
+        Same as network_constrained_neighbors() but returns the indices of the od points
+        """
+        members, ori_cnt, des_cnt = expand_neighbors(self.index_of(pi), float(epsilon), *self.topology[:5],
+                                                     *self.points, self.include_seed)
+        return members, int(ori_cnt), int(des_cnt)
+
+    def network_constrained_neighbors(self, epsilon, pi) -> Tuple[Set, int, int]:
+        """
+        See docs in RoadNetWork.network_constrained_neighbors()
+        """
+        members, ori_cnt, des_cnt = self.neighbor_indices(epsilon, pi)
+        return {self.point(idx) for idx in members}, ori_cnt, des_cnt
+
+    def neighbor_counts(self, epsilon, seeds) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Od counts of the neighbourhoods of many seed points (indices), computed in parallel
+        """
+        seeds = np.asarray(seeds, dtype=np.int64)
+        return batch_neighbor_counts(seeds, float(epsilon), *self.topology[:5], *self.points, self.include_seed)
+
+    def lambda_from_counts(self, n_o_r, n_d_r) -> Optional[float]:
+        """
+        Lambda value of a region with the given od counts (None if undefined)
+        """
+        n_o, n_d = self.o_count, self.d_count
+        if n_o_r + n_d_r == 0 or n_o + n_d == 0 or n_o + n_d - n_o_r - n_d_r == 0:
+            return None
+        return bernoulli_lambda(n_o_r, n_d_r, n_o, n_d)
+
+    def calc_lambda(self, epsilon, pi) -> Optional[float]:
+        """
+        Lambda value only (without building the neighbourhood set), see docs in calc_test_statistics()
+        """
+        _, n_o_r, n_d_r = self.neighbor_indices(epsilon, pi)
+        return self.lambda_from_counts(n_o_r, n_d_r)
+
+    def calc_test_statistics(self, epsilon, pi) -> Optional[Tuple[float, int, int, Set]]:
+        """
+        See docs in RoadNetWork.calc_test_statistics()
+        """
+        neighbour, n_o_r, n_d_r = self.network_constrained_neighbors(epsilon, pi)
+        lam = self.lambda_from_counts(n_o_r, n_d_r)
+        if lam is None:
+            return None
+        return lam, n_o_r, n_d_r, neighbour
+
+
+def warm_up() -> None:
+    """
+    Compile (or load from the cache) the serial kernels on a tiny network, e.g. in a parent process before
+    forking its workers, so that the workers inherit them instead of compiling them again
+    the parallel kernels are not warmed up (the threading layers are not safe to fork once started)
+    """
+    for writeable in (False, True):  # memory-mapped snapshots are read-only, networks built in memory are not
+        arrays = [np.zeros((2, 2)), np.asarray([0, 1, 2], np.int64), np.zeros(2, np.int32),
+                  np.asarray([[0, 1]], np.int32), np.ones(1), np.zeros(1, np.int32),
+                  np.asarray([0, 1], np.int64), np.zeros((1, 2)), np.zeros(1, np.int32), np.zeros(1, np.int32),
+                  np.ones(1, np.int32), np.ones(1, np.int32), np.zeros(1, np.int32)]
+        for arr in arrays:
+            arr.flags.writeable = writeable
+        ArrayNetWork(Topology(*arrays[:6]), Points(*arrays[6:])).neighbor_indices(1.0, 0)
+    bernoulli_lambda(1, 1, 2, 2)
@@ -0,0 +1,134 @@
+from typing import List, NamedTuple, Tuple
+import numpy as np
+from numba import njit, prange
+from graph.kernel import ArrayNetWork, Topology, Points, expand_neighbors
+from graph.linear import bernoulli_lambda_array
+from graph.prune import simulate_null_lambdas
+
+
+class Layers(NamedTuple):
+    """
+    Od counts of the locations of a network in several layers (e.g. the hours of the day)
+    """
+    layer_o: np.ndarray  # int32 [u, h], number of origin records at each location in each layer
+    layer_d: np.ndarray  # int32 [u, h], number of destination records at each location in each layer
+
+
+def stack_layers(topology: Topology, layers: List[Points]) -> Tuple[Points, Layers]:
+    """
+    Stack the od points of several networks on the same topology (e.g. the hours of the day) into one network
+    holding every location once, with its od counts in each layer
+
+    One search per location then serves all the layers holding it. The locations of lixels (see graph.lixel)
+    are the same in every hour, while raw gps locations hardly ever repeat, so stacking their hours only makes
+    each search visit the points of all of them.
+
+    Returns
+    ----------
+    points : Points
+        the locations of all the layers (their od counts are the sums over the layers)
+    layers : Layers
+        the od counts of each location in each layer
+    """
+    rows = np.concatenate([np.column_stack((p.pt_edge, p.pt_xy)) for p in layers])
+    # one point per (edge, location), grouped by edge
+    keys, inverse = np.unique(rows, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    pt_edge = keys[:, 0].astype(np.int32)
+    pt_xy = np.ascontiguousarray(keys[:, 1:])
+    pt_cnt = np.bincount(inverse, weights=np.concatenate([p.pt_cnt for p in layers]), minlength=len(keys))
+    _, pt_uid = np.unique(pt_xy, axis=0, return_inverse=True)
+    pt_uid = pt_uid.reshape(-1)
+    n_loc = pt_uid.max() + 1 if len(pt_uid) > 0 else 0
+    layer_o = np.zeros((n_loc, len(layers)), dtype=np.int32)
+    layer_d = np.zeros((n_loc, len(layers)), dtype=np.int32)
+    st = 0
+    for h, p in enumerate(layers):
+        uid = pt_uid[inverse[st:st + len(p.pt_xy)]]
+        layer_o[uid, h] = p.loc_o[p.pt_uid]
+        layer_d[uid, h] = p.loc_d[p.pt_uid]
+        st += len(p.pt_xy)
+    pt_indptr = np.concatenate(([0], np.cumsum(np.bincount(pt_edge, minlength=len(topology.edge_len)))))
+    points = Points(pt_indptr.astype(np.int64), pt_xy, pt_edge, pt_uid.astype(np.int32), pt_cnt.astype(np.int32),
+                    layer_o.sum(axis=1).astype(np.int32), layer_d.sum(axis=1).astype(np.int32))
+    return points, Layers(layer_o, layer_d)
+
+
+@njit(parallel=True, cache=True)
+def batch_layer_counts(seeds, epsilon, node_xy, node_indptr, node_edges, edge_nodes, edge_len,
+                       pt_indptr, pt_xy, pt_edge, pt_uid, pt_cnt, loc_o, loc_d, include_seed, layer_o, layer_d):
+    """
+    Od counts of the neighbourhoods of many seed points in every layer (in parallel), int64 [n, h]:
+    one edge-expansion per seed, the counts of its members are summed layer by layer
+    """
+    n, n_layer = seeds.shape[0], layer_o.shape[1]
+    ori_cnt = np.zeros((n, n_layer), dtype=np.int64)
+    des_cnt = np.zeros((n, n_layer), dtype=np.int64)
+    for i in prange(n):
+        members, _, _ = expand_neighbors(seeds[i], epsilon, node_xy, node_indptr, node_edges, edge_nodes, edge_len,
+                                         pt_indptr, pt_xy, pt_edge, pt_uid, pt_cnt, loc_o, loc_d, include_seed)
+        for j in members:
+            u = pt_uid[j]
+            for h in range(n_layer):
+                ori_cnt[i, h] += layer_o[u, h]
+                des_cnt[i, h] += layer_d[u, h]
+    return ori_cnt, des_cnt
+
+
+def layer_counts(net: ArrayNetWork, layers: Layers, epsilon, seeds) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Od counts of the neighbourhoods of the seed points (indices on the stacked network) in every layer
+    """
+    seeds = np.asarray(seeds, dtype=np.int64)
+    return batch_layer_counts(seeds, float(epsilon), *net.topology[:5], *net.points, net.include_seed,
+                              layers.layer_o, layers.layer_d)
+
+
+def layered_test(net: ArrayNetWork, layers: Layers, ran_nets: List[ArrayNetWork], epsilon, n_null=2000):
+    """
+    Test statistics of every location in every layer where it holds od records, with one neighbourhood search
+    per location for all the layers (instead of one per location and per layer)
+
+    The lambdas of all the layers are scored together, each against the od counts of its own network, and
+    the p-value of a layer is estimated from 'n_null' lambdas simulated on its random network (the same draws
+    as graph.roadnet.monte_carlo_test, but shared by all the locations of the layer).
+
+    Parameters
+    ----------
+    net : ArrayNetWork
+        the stacked network (see stack_layers())
+    layers : Layers
+        the od counts of its locations in each layer
+    ran_nets : list
+        the random network of each layer
+    epsilon : int or float
+        the neighbourhood cutoff radius
+    n_null : int, optional
+        the number of simulated lambdas of each layer, default = 2000
+
+    Returns
+    ----------
+    seeds : np.ndarray
+        indices of the tested locations on the stacked network (the first point of each location)
+    tested : np.ndarray
+        bool [n, h], whether the location holds records in the layer (is tested in it)
+    o_cnt, d_cnt : np.ndarray
+        int64 [n, h], the od counts of the neighbourhoods
+    lam : np.ndarray
+        float64 [n, h], lambda of the neighbourhoods (nan if undefined)
+    p_value : np.ndarray
+        float64 [n, h], p-values of the lambdas
+    """
+    _, seeds = np.unique(net.points.pt_uid, return_index=True)
+    seeds = np.sort(seeds)
+    uid = net.points.pt_uid[seeds]
+    tested = (layers.layer_o[uid] + layers.layer_d[uid]) > 0
+    o_cnt, d_cnt = layer_counts(net, layers, epsilon, seeds)
+    o_all, d_all = layers.layer_o.sum(axis=0), layers.layer_d.sum(axis=0)
+    lam = bernoulli_lambda_array(o_cnt, d_cnt, o_all, d_all)
+    p_value = np.full(lam.shape, np.nan)
+    for h, ran_net in enumerate(ran_nets):
+        null_lambdas = simulate_null_lambdas(ran_net, epsilon, n_null)
+        exceed = len(null_lambdas) - np.searchsorted(null_lambdas, lam[:, h], side='right')
+        p_value[:, h] = np.where(np.isnan(lam[:, h]), np.nan, exceed / (1.0 + n_null))
+    return seeds, tested, o_cnt, d_cnt, lam, p_value
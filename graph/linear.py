@@ -1,50 +1,47 @@
 import math
-from numba import njit, float32
+import numpy as np
+from numba import njit
 
 
-@njit([float32(float32, float32)], cache=True)
+# All the statistics are computed in single precision: every operation rounds its result to float32.
+# The kernels are compiled lazily on their first call (and cached on disk), so importing this module
+# does not compile anything, and each statistic is one kernel instead of a chain of one-operation kernels.
+f32 = np.float32
+
+
+@njit(cache=True)
 def add(a, b):
-    return a + b
+    return f32(f32(a) + f32(b))
 
 
-@njit([float32(float32, float32)], cache=True)
+@njit(cache=True)
 def sub(a, b):
-    return a - b
+    return f32(f32(a) - f32(b))
 
 
-@njit([float32(float32, float32)], cache=True)
+@njit(cache=True)
 def mul(a, b):
-    return a * b
+    return f32(f32(a) * f32(b))
 
 
-@njit([float32(float32, float32)], cache=True)
+@njit(cache=True)
 def div(a, b):
-    return a / b
+    return f32(f32(a) / f32(b))
 
 
-@njit([float32(float32)], cache=True)
+@njit(cache=True)
 def power(a):
-    return a ** 2
+    return f32(f32(a) * f32(a))
 
 
-@njit([float32(float32)], cache=True)
+@njit(cache=True)
 def sqrt(a):
-    return math.sqrt(a)
+    return f32(math.sqrt(f32(a)))
 
 
-@njit([float32(float32)], cache=True)
+@njit(cache=True)
 def log(a):
-    return math.log(a)
-
-
-@njit([float32(float32, float32, float32, float32, float32, float32)], cache=True)
-def __expression_1(v1, v2, v3, v4, v5, v6):
-    return v1 + v2 + v3 + v4 - v5 - v6
-
-
-@njit([float32(float32, float32, float32, float32)], cache=True)
-def __expression_2(v1, v2, v3, v4):
-    return v1 + v2 - v3 - v4
+    return f32(math.log(f32(a)))
 
 
 @njit(cache=True)
@@ -52,18 +49,39 @@ def euclidean_distance(point1, point2):
     """
     return the Euclidean distance between point1 and point2
     """
-    return sqrt(add(power(sub(point1[0], point2[0])), power(sub(point1[1], point2[1]))))
+    dx = f32(f32(point1[0]) - f32(point2[0]))
+    dy = f32(f32(point1[1]) - f32(point2[1]))
+    return f32(math.sqrt(f32(f32(dx * dx) + f32(dy * dy))))
 
 
-@njit([float32(float32, float32, float32, float32)], cache=True)
+@njit(cache=True)
 def bernoulli_lambda(N_O_r, N_D_r, N_O, N_D):
     """
     return the Bernoulli-based log-likelihood ratio test statistic
     """
-    item_1 = mul(N_O_r, log(div(N_O_r, add(N_O_r, N_D_r))))
-    item_2 = mul(N_D_r, log(div(N_D_r, add(N_O_r, N_D_r))))
-    item_3 = mul(sub(N_O, N_O_r), log(div(sub(N_O, N_O_r), __expression_2(N_O, N_D, N_O_r, N_D_r))))
-    item_4 = mul(sub(N_D, N_D_r), log(div(sub(N_D, N_D_r), __expression_2(N_O, N_D, N_O_r, N_D_r))))
-    item_5 = mul(N_O, log(div(N_O, add(N_O, N_D))))
-    item_6 = mul(N_D, log(div(N_D, add(N_O, N_D))))
-    return __expression_1(item_1, item_2, item_3, item_4, item_5, item_6)
+    n_o_r, n_d_r, n_o, n_d = f32(N_O_r), f32(N_D_r), f32(N_O), f32(N_D)
+    n_r = f32(n_o_r + n_d_r)
+    n_rest = f32(f32(f32(n_o + n_d) - n_o_r) - n_d_r)
+    n_o_rest, n_d_rest, n_all = f32(n_o - n_o_r), f32(n_d - n_d_r), f32(n_o + n_d)
+    item_1 = f32(n_o_r * f32(math.log(f32(n_o_r / n_r))))
+    item_2 = f32(n_d_r * f32(math.log(f32(n_d_r / n_r))))
+    item_3 = f32(n_o_rest * f32(math.log(f32(n_o_rest / n_rest))))
+    item_4 = f32(n_d_rest * f32(math.log(f32(n_d_rest / n_rest))))
+    item_5 = f32(n_o * f32(math.log(f32(n_o / n_all))))
+    item_6 = f32(n_d * f32(math.log(f32(n_d / n_all))))
+    return f32(f32(f32(f32(f32(item_1 + item_2) + item_3) + item_4) - item_5) - item_6)
+
+
+def bernoulli_lambda_array(N_O_r, N_D_r, N_O, N_D):
+    """
+    Vectorized bernoulli_lambda over arrays of region counts (nan where the statistic is undefined)
+    """
+    n_o_r, n_d_r = np.asarray(N_O_r, dtype=np.float64), np.asarray(N_D_r, dtype=np.float64)
+    n_o, n_d = np.float64(N_O), np.float64(N_D)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n_r, n_rest = n_o_r + n_d_r, n_o + n_d - n_o_r - n_d_r
+        lam = np.nan_to_num(n_o_r * np.log(n_o_r / n_r)) + np.nan_to_num(n_d_r * np.log(n_d_r / n_r)) \
+            + np.nan_to_num((n_o - n_o_r) * np.log((n_o - n_o_r) / n_rest)) \
+            + np.nan_to_num((n_d - n_d_r) * np.log((n_d - n_d_r) / n_rest)) \
+            - np.nan_to_num(n_o * np.log(n_o / (n_o + n_d))) - np.nan_to_num(n_d * np.log(n_d / (n_o + n_d)))
+    return np.where((n_r == 0) | (n_rest == 0), np.nan, lam)
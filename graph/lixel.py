@@ -0,0 +1,134 @@
+from typing import Optional
+import numpy as np
+from graph.kernel import Topology, Points
+
+
+def is_lixel_label(label) -> bool:
+    """
+    Whether a time label is the one of lixel networks (see preprocess.save_lixel_network_arrays)
+    """
+    return '_lixel' in str(label)
+
+
+def lixel_length_of(label) -> Optional[float]:
+    """
+    The length of the lixels of a time label '{label}_lixel{lixel_length}' (None if not a lixel label)
+    """
+    return float(str(label).rsplit('_lixel', 1)[1]) if is_lixel_label(label) else None
+
+
+def lixel_offsets(topology: Topology, lixel_length) -> np.ndarray:
+    """
+    Offsets of the lixels of each edge (CSR): every edge is split from its first node into lixels
+    of 'lixel_length', the last one holding the remainder (an edge shorter than a lixel is one lixel)
+    """
+    n_lixel = np.maximum(np.ceil(topology.edge_len / lixel_length), 1).astype(np.int64)
+    return np.concatenate(([0], np.cumsum(n_lixel))).astype(np.int64)
+
+
+def project_to_edges(topology: Topology, edge, xy) -> np.ndarray:
+    """
+    Distance from the first node of its edge of each point (projected onto the edge)
+    """
+    n1 = topology.node_xy[topology.edge_nodes[edge, 0]]
+    n2 = topology.node_xy[topology.edge_nodes[edge, 1]]
+    dxy = n2 - n1
+    length2 = (dxy ** 2).sum(axis=1)
+    t = np.divide(((xy - n1) * dxy).sum(axis=1), length2, out=np.zeros(len(edge)), where=length2 > 0)
+    return np.clip(t, 0.0, 1.0) * topology.edge_len[edge]
+
+
+def aggregate_lixels(topology: Topology, edge, offset, o_cnt, d_cnt, lixel_length) -> Points:
+    """
+    Aggregate weighted od records into lixels (linear pixels) of 'lixel_length'
+
+    Each non-empty lixel becomes one od location at its middle, with the origin and destination counts
+    of the records on it, so the kernels of graph.kernel search, count and sample lixels instead of points
+    (the networks of lixels count the records of the seed lixel in its neighbourhood, see ArrayNetWork).
+
+    Parameters
+    ----------
+    topology : Topology
+        the road network
+    edge : np.ndarray
+        edge index of each record (or group of records)
+    offset : np.ndarray
+        distance from the first node of the edge of each record, see project_to_edges()
+    o_cnt, d_cnt : np.ndarray
+        numbers of origins and destinations of each record
+    lixel_length : float
+        the length of a lixel
+
+    Returns
+    ----------
+    lixels : Points
+        one point per non-empty lixel, grouped by edge
+    """
+    edge = np.asarray(edge, dtype=np.int64)
+    indptr = lixel_offsets(topology, lixel_length)
+    k = np.minimum((np.asarray(offset) // lixel_length).astype(np.int64), np.diff(indptr)[edge] - 1)
+    lixel = indptr[edge] + k
+    o = np.bincount(lixel, weights=o_cnt, minlength=indptr[-1]).astype(np.int64)
+    d = np.bincount(lixel, weights=d_cnt, minlength=indptr[-1]).astype(np.int64)
+    lixel = np.nonzero(o + d > 0)[0]
+    lixel_edge = np.searchsorted(indptr, lixel, side='right') - 1
+    k = lixel - indptr[lixel_edge]
+    edge_len = topology.edge_len[lixel_edge]
+    middle = (k * lixel_length + np.minimum((k + 1) * lixel_length, edge_len)) / 2
+    t = np.divide(middle, edge_len, out=np.zeros(len(lixel)), where=edge_len > 0)
+    n1 = topology.node_xy[topology.edge_nodes[lixel_edge, 0]]
+    n2 = topology.node_xy[topology.edge_nodes[lixel_edge, 1]]
+    pt_indptr = np.concatenate(([0], np.cumsum(np.bincount(lixel_edge, minlength=len(topology.edge_len)))))
+    return Points(pt_indptr.astype(np.int64), n1 + t[:, None] * (n2 - n1), lixel_edge.astype(np.int32),
+                  np.arange(len(lixel), dtype=np.int32), (o + d)[lixel].astype(np.int32),
+                  o[lixel].astype(np.int32), d[lixel].astype(np.int32))
+
+
+def lixel_points(topology: Topology, points: Points, lixel_length) -> Points:
+    """
+    Aggregate the od points of a network (see graph.kernel.build_points) into lixels,
+    the records of a location are counted on the edge of its first point
+    """
+    _, first = np.unique(points.pt_uid, return_index=True)
+    edge = points.pt_edge[first]
+    return aggregate_lixels(topology, edge, project_to_edges(topology, edge, points.pt_xy[first]),
+                            points.loc_o[points.pt_uid[first]], points.loc_d[points.pt_uid[first]], lixel_length)
+
+
+def lixel_points_from_events(topology: Topology, road_ids, xs, ys, flags, lixel_length) -> Points:
+    """
+    Aggregate od events (e.g. a month of them, see preprocess.read_od_events) into lixels directly,
+    without building the network of their points
+    """
+    order = np.argsort(topology.road_ids)
+    pos = np.searchsorted(topology.road_ids[order], road_ids)
+    edge = order[np.minimum(pos, len(order) - 1)]
+    assert np.all(topology.road_ids[edge] == road_ids), 'the od events should be matched to the roads'
+    flags = np.asarray(flags, dtype=np.bool_)
+    offset = project_to_edges(topology, edge, np.stack((xs, ys), axis=1).astype(np.float64))
+    return aggregate_lixels(topology, edge, offset, flags, ~flags, lixel_length)
+
+
+def random_lixel_points(topology: Topology, lixels: Points, lixel_length, seed=2021) -> Points:
+    """
+    Lixels of a random network with the same numbers of origins and destinations (complete spatial
+    randomness as graph.roadnet.generate_random_network: a road with od points, then a position on it,
+    both uniformly), drawn in chunks so that the records are never held at once
+    """
+    rng = np.random.default_rng(seed)
+    roads = np.unique(lixels.pt_edge).astype(np.int64)
+    o_count, d_count = int(lixels.loc_o.sum()), int(lixels.loc_d.sum())
+    indptr = lixel_offsets(topology, lixel_length)
+    o = np.zeros(indptr[-1], dtype=np.int64)
+    d = np.zeros(indptr[-1], dtype=np.int64)
+    for counts, n in ((o, o_count), (d, d_count)):
+        for st in range(0, n, 1 << 20):
+            edge = roads[rng.integers(len(roads), size=min(n - st, 1 << 20))]
+            offset = rng.random(len(edge)) * topology.edge_len[edge]
+            k = np.minimum((offset // lixel_length).astype(np.int64), np.diff(indptr)[edge] - 1)
+            counts += np.bincount(indptr[edge] + k, minlength=indptr[-1])
+    lixel = np.nonzero(o + d > 0)[0]
+    lixel_edge = np.searchsorted(indptr, lixel, side='right') - 1
+    # one record per lixel with the counts as weights, aggregated again to get the middles of the lixels
+    return aggregate_lixels(topology, lixel_edge, (lixel - indptr[lixel_edge] + 0.5) * lixel_length,
+                            o[lixel], d[lixel], lixel_length)
@@ -0,0 +1,147 @@
+from typing import NamedTuple
+import numpy as np
+from numba import njit, prange
+from graph.kernel import Topology
+
+
+class SegmentGrid(NamedTuple):
+    """
+    Uniform grid index of the road segments (edges) of a network: every segment is listed in all the cells
+    its bounding box overlaps (CSR)
+    """
+    cell_indptr: np.ndarray  # int64 [nx * ny + 1], cell (ix * ny + iy) -> segments
+    cell_edges: np.ndarray  # int32 [k], edge indices of the segments overlapping each cell
+    origin: np.ndarray  # float64 [2], lower left corner of the grid
+    cell_size: np.ndarray  # float64 [1], side of a cell
+    shape: np.ndarray  # int64 [2], numbers of cells along x and y
+
+
+class Matches(NamedTuple):
+    """
+    Od points snapped onto their nearest road segments
+    """
+    edge: np.ndarray  # int64 [n], edge index of the nearest segment (-1 if none within the largest distance)
+    xy: np.ndarray  # float64 [n, 2], projection of each point onto its segment (nan if unmatched)
+    dist: np.ndarray  # float64 [n], distance from each point to its segment (inf if unmatched)
+
+
+def build_segment_grid(topology: Topology, cell_size=None) -> SegmentGrid:
+    """
+    Index the edges of a network (e.g. build_topology() of RoadNetWork.edges) in a uniform grid of 'cell_size',
+    default = the median length of the edges, so a cell holds a few segments
+    """
+    a = topology.node_xy[topology.edge_nodes[:, 0]]
+    b = topology.node_xy[topology.edge_nodes[:, 1]]
+    if cell_size is None:
+        cell_size = max(float(np.median(topology.edge_len)), 1.0) if len(topology.edge_len) else 1.0
+    origin = np.minimum(a, b).min(axis=0) if len(a) else np.zeros(2)
+    lo = np.floor((np.minimum(a, b) - origin) / cell_size).astype(np.int64)
+    hi = np.floor((np.maximum(a, b) - origin) / cell_size).astype(np.int64)
+    shape = (hi.max(axis=0) + 1) if len(a) else np.ones(2, dtype=np.int64)
+    # one entry per (segment, overlapped cell)
+    span = (hi - lo + 1).prod(axis=1)
+    edge = np.repeat(np.arange(len(a)), span)
+    k = np.arange(len(edge)) - np.repeat(np.cumsum(span) - span, span)
+    width = (hi - lo + 1)[edge, 1]
+    cell = (lo[edge, 0] + k // width) * shape[1] + lo[edge, 1] + k % width
+    order = np.argsort(cell, kind='stable')
+    cell_indptr = np.concatenate(([0], np.cumsum(np.bincount(cell, minlength=shape.prod())))).astype(np.int64)
+    return SegmentGrid(cell_indptr, edge[order].astype(np.int32), origin.astype(np.float64),
+                       np.asarray([cell_size], dtype=np.float64), shape.astype(np.int64))
+
+
+@njit(cache=True, nogil=True)
+def _project(px, py, ax, ay, bx, by):
+    """
+    Projection of the point p onto the segment ab, and its squared distance to p
+    """
+    dx, dy = bx - ax, by - ay
+    length2 = dx * dx + dy * dy
+    t = 0.0
+    if length2 > 0:
+        t = min(max(((px - ax) * dx + (py - ay) * dy) / length2, 0.0), 1.0)
+    qx, qy = ax + t * dx, ay + t * dy
+    return qx, qy, (px - qx) ** 2 + (py - qy) ** 2
+
+
+@njit(parallel=True, cache=True)
+def batch_nearest_segments(xy, max_dist, node_xy, edge_nodes, cell_indptr, cell_edges, origin, cell_size, shape):
+    """
+    Nearest segment of many points (in parallel): the rings of cells around the cell of a point are searched
+    outwards until the nearest segment found is closer than any cell left (or 'max_dist' is passed),
+    ties go to the lowest edge index
+    """
+    n = xy.shape[0]
+    nx, ny = shape[0], shape[1]
+    edge = np.full(n, -1, dtype=np.int64)
+    proj = np.full((n, 2), np.nan)
+    dist = np.full(n, np.inf)
+    for i in prange(n):
+        px, py = xy[i, 0], xy[i, 1]
+        if not (np.isfinite(px) and np.isfinite(py)):
+            continue
+        cx = int(np.floor((px - origin[0]) / cell_size))
+        cy = int(np.floor((py - origin[1]) / cell_size))
+        best, best_e, bx, by = max_dist * max_dist, -1, np.nan, np.nan
+        # the rings closer than the grid are empty (the point is outside of it)
+        r0 = max(0, -cx, cx - nx + 1, -cy, cy - ny + 1)
+        for r in range(r0, r0 + max(nx, ny) + 1):
+            # the segments left are at least r - 1 cells away once the rings up to r - 1 are searched
+            gap = max(r - 1, 0) * cell_size
+            if gap * gap > best:
+                break
+            for ix in range(max(cx - r, 0), min(cx + r, nx - 1) + 1):
+                # the side columns of the ring are searched whole, the other columns at their two ends only
+                step = 1 if ix == cx - r or ix == cx + r else 2 * r
+                for iy in range(cy - r, cy + r + 1, step):
+                    if iy < 0 or iy >= ny:
+                        continue
+                    cell = ix * ny + iy
+                    for a in range(cell_indptr[cell], cell_indptr[cell + 1]):
+                        e = cell_edges[a]
+                        n1, n2 = edge_nodes[e, 0], edge_nodes[e, 1]
+                        qx, qy, d2 = _project(px, py, node_xy[n1, 0], node_xy[n1, 1], node_xy[n2, 0], node_xy[n2, 1])
+                        if d2 < best or (d2 == best and e < best_e):
+                            best, best_e, bx, by = d2, e, qx, qy
+        if best_e >= 0:
+            edge[i] = best_e
+            proj[i, 0], proj[i, 1] = bx, by
+            dist[i] = np.sqrt(best)
+    return edge, proj, dist
+
+
+def match_points(topology: Topology, xy, grid=None, max_dist=np.inf, batch_size=1 << 20) -> Matches:
+    """
+    Snap raw gps points onto their nearest road segments in batches of 'batch_size', the points are moved
+    to their projections on the segments (the coordinates on the roads expected by RoadNetWork.add_matches)
+
+    Parameters
+    ----------
+    topology : Topology
+        the road network (see graph.kernel.build_topology)
+    xy : np.ndarray
+        float64 [n, 2], coordinates of the points (in the projected coordinate system of the network)
+    grid : SegmentGrid, optional
+        the index of the segments, default = build_segment_grid(topology)
+    max_dist : float, optional
+        the points farther than 'max_dist' from any segment are left unmatched, default = inf
+    batch_size : int, optional
+        the number of points matched at once, default = 2 ** 20
+
+    Returns
+    ----------
+    matches : Matches
+        the edge index, projected coordinates and distance of each point
+    """
+    if grid is None:
+        grid = build_segment_grid(topology)
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    edge = np.empty(len(xy), dtype=np.int64)
+    proj = np.empty((len(xy), 2), dtype=np.float64)
+    dist = np.empty(len(xy), dtype=np.float64)
+    for st in range(0, len(xy), batch_size):
+        ed = min(st + batch_size, len(xy))
+        edge[st:ed], proj[st:ed], dist[st:ed] = batch_nearest_segments(
+            np.ascontiguousarray(xy[st:ed]), float(max_dist), topology.node_xy, topology.edge_nodes,
+            grid.cell_indptr, grid.cell_edges, grid.origin, float(grid.cell_size[0]), grid.shape)
+    return Matches(edge, proj, dist)
@@ -0,0 +1,229 @@
+from typing import List, NamedTuple, Optional, Tuple
+import heapq
+import os.path as osp
+import random
+import shutil
+import numpy as np
+from numba import njit
+from graph.kernel import ArrayNetWork, Topology, Points, save_arrays, load_arrays
+
+
+class TileIndex(NamedTuple):
+    """
+    Position of a tile in the whole network (saved next to the array snapshots of the tile)
+    """
+    edges: np.ndarray  # int64 [k], global indices of the edges of the tile (core and halo, increasing)
+    core: np.ndarray  # bool [k], whether the edge is in the core of the tile
+    net_pts: np.ndarray  # int64 [p], global indices of the od points of the observed network on the tile
+    ran_pts: np.ndarray  # int64 [q], global indices of the od points of the random network on the tile
+    owned: np.ndarray  # int64 [s], tile indices of the od points seeding the locations owned by the tile
+    owned_order: np.ndarray  # int64 [s], positions of the owned locations in all_matches() of the whole network
+    totals: np.ndarray  # int64 [4], origin and destination counts of the whole observed and random networks
+    include_seed: np.ndarray  # bool [1], see ArrayNetWork
+
+
+def tile_edges(topology: Topology, tile_size) -> np.ndarray:
+    """
+    Core tile of each edge: the square cells of a grid of 'tile_size' (by the middle of the edge),
+    the empty cells are dropped, so the tiles are numbered 0..n_tiles - 1
+    """
+    mid = topology.node_xy[topology.edge_nodes].mean(axis=1)
+    cell = np.floor((mid - mid.min(axis=0)) / tile_size).astype(np.int64)
+    _, tile = np.unique(cell[:, 0] * (cell[:, 1].max() + 1) + cell[:, 1], return_inverse=True)
+    return tile.reshape(-1)
+
+
+@njit(cache=True)
+def reachable_nodes(sources, limit, node_indptr, node_edges, edge_nodes, edge_len):
+    """
+    Nodes within network distance 'limit' of any of the source nodes (multi-source Dijkstra)
+    """
+    dist = np.full(node_indptr.shape[0] - 1, np.inf)
+    heap = [(0.0, np.int64(0)) for _ in range(0)]
+    for s in sources:
+        dist[s] = 0.0
+        heap.append((0.0, np.int64(s)))
+    heapq.heapify(heap)
+    while len(heap) > 0:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        for a in range(node_indptr[u], node_indptr[u + 1]):
+            r = node_edges[a]
+            v = edge_nodes[r, 1] if edge_nodes[r, 0] == u else edge_nodes[r, 0]
+            nd = d + edge_len[r]
+            if nd < dist[v] and nd < limit:
+                dist[v] = nd
+                heapq.heappush(heap, (nd, np.int64(v)))
+    return dist < limit
+
+
+def halo_edges(topology: Topology, core: np.ndarray, epsilon) -> np.ndarray:
+    """
+    Mask of the edges an edge-expansion of radius epsilon from any point on the core edges can touch:
+    the core edges and all the edges adjacent to a node closer than epsilon to the core (network distance)
+    the seed of a search is on a core edge, so its distance to a node is at least the one of the core
+    """
+    sources = np.unique(topology.edge_nodes[core])
+    # a little slack over epsilon keeps the nodes reached with the float32 distances of the search
+    near = reachable_nodes(sources.astype(np.int64), float(epsilon) * (1 + 1e-6) + 1e-6, topology.node_indptr,
+                           topology.node_edges, topology.edge_nodes, topology.edge_len)
+    mask = core.copy()
+    mask[topology.node_edges[np.repeat(near, np.diff(topology.node_indptr))]] = True
+    return mask
+
+
+def subset_topology(topology: Topology, edges: np.ndarray) -> Topology:
+    """
+    Topology of the given edges (increasing global indices), the orders of nodes and adjacency are kept
+    so that an edge-expansion visits the edges in the same order as on the whole network
+    """
+    edge_map = np.full(len(topology.edge_len), -1, dtype=np.int64)
+    edge_map[edges] = np.arange(len(edges))
+    nodes = np.unique(topology.edge_nodes[edges])
+    node_map = np.full(len(topology.node_xy), -1, dtype=np.int64)
+    node_map[nodes] = np.arange(len(nodes))
+    adj_node = np.repeat(np.arange(len(topology.node_xy)), np.diff(topology.node_indptr))
+    keep = (node_map[adj_node] >= 0) & (edge_map[topology.node_edges] >= 0)
+    degree = np.bincount(node_map[adj_node[keep]], minlength=len(nodes))
+    return Topology(topology.node_xy[nodes], np.concatenate(([0], np.cumsum(degree))).astype(np.int64),
+                    edge_map[topology.node_edges[keep]].astype(np.int32),
+                    node_map[topology.edge_nodes[edges]].astype(np.int32), topology.edge_len[edges],
+                    topology.road_ids[edges])
+
+
+def subset_points(points: Points, edges: np.ndarray, n_edge) -> Tuple[Points, np.ndarray]:
+    """
+    Od points on the given edges (increasing global indices) and their global indices
+    """
+    edge_map = np.full(n_edge, -1, dtype=np.int64)
+    edge_map[edges] = np.arange(len(edges))
+    pts = np.nonzero(edge_map[points.pt_edge] >= 0)[0]
+    locs, uid = np.unique(points.pt_uid[pts], return_inverse=True)
+    pt_edge = edge_map[points.pt_edge[pts]]
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(pt_edge, minlength=len(edges))))).astype(np.int64)
+    return Points(indptr, points.pt_xy[pts], pt_edge.astype(np.int32), uid.reshape(-1).astype(np.int32),
+                  points.pt_cnt[pts], points.loc_o[locs], points.loc_d[locs]), pts
+
+
+def partition_network(net: ArrayNetWork, ran_net: ArrayNetWork, epsilon, tile_size, save_dir) -> List[str]:
+    """
+    Cut the observed and random networks into spatial tiles with a halo of network distance epsilon
+    and save the array snapshots of each tile in '{save_dir}/tile_{i}'
+
+    Every edge is in the core of exactly one tile, and a distinct od location is owned (tested) by the tile
+    holding the edge of its first point, as in all_matches() of the whole network. The halo holds all the
+    edges the neighbourhood search of an owned location can touch, and the edges keep their global order,
+    so the neighbourhoods and od counts searched on a tile are the same as on the whole network.
+
+    Returns
+    ----------
+    tile_dirs : list
+        the directories of the tiles holding od points in their cores
+    """
+    topology, n_edge = net.topology, len(net.topology.edge_len)
+    tile = tile_edges(topology, tile_size)
+    _, first = np.unique(net.points.pt_uid, return_index=True)
+    first = np.sort(first)  # the seeds of all_matches(), in its order
+    owner = tile[net.points.pt_edge[first]]
+    totals = np.asarray([net.o_count, net.d_count, ran_net.o_count, ran_net.d_count], dtype=np.int64)
+    # the tiles without any od point in their core (observed or random) are dropped
+    occupied = np.zeros(tile.max() + 1, dtype=np.bool_)
+    occupied[tile[net.points.pt_edge]] = True
+    occupied[tile[ran_net.points.pt_edge]] = True
+    tile_dirs = []
+    for t in np.nonzero(occupied)[0]:
+        mask = halo_edges(topology, tile == t, epsilon)
+        edges = np.nonzero(mask)[0]
+        net_points, net_pts = subset_points(net.points, edges, n_edge)
+        ran_points, ran_pts = subset_points(ran_net.points, edges, n_edge)
+        owned_order = np.nonzero(owner == t)[0]
+        owned = np.searchsorted(net_pts, first[owned_order])
+        tile_dir = osp.join(save_dir, f'tile_{t}')
+        save_arrays(osp.join(tile_dir, 'topology'), subset_topology(topology, edges))
+        save_arrays(osp.join(tile_dir, 'network'), net_points)
+        save_arrays(osp.join(tile_dir, 'network_random'), ran_points)
+        save_arrays(osp.join(tile_dir, 'index'), TileIndex(edges, tile[edges] == t, net_pts, ran_pts, owned,
+                                                           owned_order, totals, np.asarray([net.include_seed])))
+        tile_dirs.append(tile_dir)
+    return tile_dirs
+
+
+def load_tile(tile_dir) -> Tuple[ArrayNetWork, ArrayNetWork, TileIndex]:
+    """
+    Map the observed and random networks of a tile (with the od counts of the whole networks)
+    """
+    topology = load_arrays(osp.join(tile_dir, 'topology'), Topology)
+    index = load_arrays(osp.join(tile_dir, 'index'), TileIndex)
+    net = ArrayNetWork(topology, load_arrays(osp.join(tile_dir, 'network'), Points), totals=index.totals[:2],
+                       include_seed=index.include_seed[0])
+    ran_net = ArrayNetWork(topology, load_arrays(osp.join(tile_dir, 'network_random'), Points),
+                           totals=index.totals[2:], include_seed=index.include_seed[0])
+    return net, ran_net, index
+
+
+def tile_null_lambdas(tile_dir, seeds, epsilon) -> np.ndarray:
+    """
+    Lambda values of the neighbourhoods of random od points (global indices on the random network)
+    lying in the core of the tile, searched on the random network of the tile (nan if undefined)
+    """
+    _, ran_net, index = load_tile(tile_dir)
+    o_cnt, d_cnt = ran_net.neighbor_counts(epsilon, np.searchsorted(index.ran_pts, seeds))
+    lam = [ran_net.lambda_from_counts(o, d) for o, d in zip(o_cnt.tolist(), d_cnt.tolist())]
+    return np.asarray([np.nan if v is None else v for v in lam], dtype=np.float64)
+
+
+class NullPool:
+    """
+    Pool of lambda values simulated on the random network, a stand-in of the random network
+    in the Monte Carlo tests of the tiles (see graph.roadnet.monte_carlo_test)
+
+    A tile only holds its part of the random network, while the random points of the simulations lie
+    anywhere, so their lambdas are simulated once for the whole network (each one searched on the tile
+    owning it) and every simulation of a test draws one of them uniformly.
+    """
+
+    def __init__(self, lambdas: np.ndarray, rng: Optional[random.Random] = None) -> None:
+        self.lambdas = np.asarray(lambdas, dtype=np.float64)
+        self.rng = random if rng is None else rng
+
+    def random_match(self) -> int:
+        return self.rng.randrange(len(self.lambdas))
+
+    def calc_lambda(self, epsilon, pi) -> Optional[float]:
+        lam = self.lambdas[pi]
+        return None if np.isnan(lam) else float(lam)
+
+    def sample(self, n) -> np.ndarray:
+        """
+        'n' simulated lambdas (sorted, the undefined ones dropped), see graph.prune.simulate_null_lambdas
+        """
+        lam = self.lambdas[[self.random_match() for _ in range(n)]]
+        return np.sort(lam[~np.isnan(lam)])
+
+
+def simulate_null_pool(ran_net: ArrayNetWork, tile_dirs, epsilon, n_null, pool=None) -> np.ndarray:
+    """
+    Simulate 'n_null' lambdas on the random network: the random points are drawn on the whole network
+    (as ran_net.random_match()) and searched on the tiles owning them, in a process pool if given
+    """
+    seeds = np.asarray([ran_net.random_match() for _ in range(n_null)], dtype=np.int64)
+    owner = np.full(len(ran_net.points.pt_xy), -1, dtype=np.int64)
+    jobs = []
+    for t, tile_dir in enumerate(tile_dirs):
+        index = load_arrays(osp.join(tile_dir, 'index'), TileIndex)
+        core_pts = index.ran_pts[index.core[load_arrays(osp.join(tile_dir, 'network_random'), Points).pt_edge]]
+        owner[core_pts] = t
+    for t, tile_dir in enumerate(tile_dirs):
+        jobs.append((tile_dir, seeds[owner[seeds] == t], epsilon))
+    assert np.all(owner[seeds] >= 0), 'random points should lie in a tile'
+    results = pool.starmap(tile_null_lambdas, jobs) if pool is not None else [tile_null_lambdas(*j) for j in jobs]
+    lambdas = np.empty(n_null, dtype=np.float64)
+    for t, lam in enumerate(results):
+        lambdas[owner[seeds] == t] = lam
+    return lambdas
+
+
+def remove_tiles(tile_dirs) -> None:
+    for tile_dir in tile_dirs:
+        shutil.rmtree(tile_dir, ignore_errors=True)
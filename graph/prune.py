@@ -0,0 +1,97 @@
+from typing import Dict, List, Tuple
+import math
+import numpy as np
+from graph.linear import bernoulli_lambda_array
+from graph.kernel import ArrayNetWork
+
+
+def binomial_cdf(k, n, q) -> np.ndarray:
+    """
+    P(X <= k) for X ~ Binomial(n, q), for an array of q (small k, no need to import scipy.stats)
+    """
+    q = np.asarray(q, dtype=np.float64)[..., None]
+    i = np.arange(k + 1)
+    comb = np.asarray([math.comb(n, j) for j in i], dtype=np.float64)
+    return (comb * q ** i * (1.0 - q) ** (n - i)).sum(axis=-1)
+
+
+def simulate_null_lambdas(ran_net: ArrayNetWork, epsilon, n_null) -> np.ndarray:
+    """
+    Lambda values of the neighbourhoods of 'n_null' random od records on the random network (sorted),
+    the same draws as monte_carlo_test() but searched in one parallel batch
+    the regions without origins or destinations (lambda undefined) are dropped, they never beat any lambda
+    a pool of lambdas simulated beforehand (see graph.partition.NullPool) is sampled instead of searched
+    """
+    if hasattr(ran_net, 'sample'):
+        return ran_net.sample(n_null)
+    seeds = [ran_net.random_match() for __ in range(n_null)]
+    o_cnt, d_cnt = ran_net.neighbor_counts(epsilon, seeds)
+    lam = bernoulli_lambda_array(o_cnt, d_cnt, ran_net.o_count, ran_net.d_count)
+    return np.sort(lam[(o_cnt > 0) & (d_cnt > 0) & ~np.isnan(lam)])
+
+
+def prune_points(net: ArrayNetWork, ran_net: ArrayNetWork, r_time, alpha, epsilon, probabilistic=False, n_null=2000,
+                 tol=1e-6, points=None) -> Tuple[List[Tuple[float, float]], Dict[str, int]]:
+    """
+    Pre-filter of the od locations which cannot become subareas, before their Monte Carlo tests
+
+    The od counts of all the neighbourhoods are computed in one parallel batch of the compiled search,
+    then a location is skipped if
+        'empty'          its neighbourhood is empty or covers all the od points (lambda undefined, never tested)
+        'balanced'       its neighbourhood has o_cnt == d_cnt (neither a black hole nor a volcano)
+    These follow from the exact counts: the skipped locations are not significant at any alpha.
+    Only if 'probabilistic', a location is skipped as well if
+        'probably_null'  lambda_obs is so far below the null critical value that a Monte Carlo test of
+                         'r_time' simulations would be significant with a probability below 'tol'
+    For 'probably_null', the probability q that a simulated lambda beats lambda_obs is estimated from 'n_null'
+    simulated lambdas and lowered by a Hoeffding margin, and the test is significant only if at most
+    floor(alpha * (1 + r_time)) of the r_time simulations beat lambda_obs (binomial tail). These locations are
+    only known not to be significant at this alpha, and each may be a wrongly skipped one with probability 'tol'.
+    The regions without origins or destinations (lambda undefined but extreme) are never skipped.
+
+    Parameters
+    ----------
+    net : ArrayNetWork
+        the observed road network
+    ran_net : ArrayNetWork
+        the random road network
+    r_time : int
+        the number of repetitions of Monte Carlo simulation
+    alpha : float
+        a significance level
+    epsilon : int or float
+        the neighbourhood cutoff radius
+    probabilistic : bool, optional
+        skip the locations which are probably not significant as well, default = False
+    n_null : int, optional
+        the number of simulated lambdas estimating the null distribution, default = 2000
+    tol : float, optional
+        the largest probability of skipping a location that would be significant, default = 1e-6
+    points : list, optional
+        the od locations to be filtered, default = all the distinct locations on 'net'
+
+    Returns
+    ----------
+    points : list
+        the od locations to be tested
+    pruned : dict
+        the number of locations skipped for each reason
+    """
+    if points is None:
+        points = net.all_matches()
+    o_cnt, d_cnt = net.neighbor_counts(epsilon, [net.index_of(pi) for pi in points])
+    n_r, n_rest = o_cnt + d_cnt, net.od_count - o_cnt - d_cnt
+    empty = (n_r == 0) | (n_rest == 0)
+    balanced = ~empty & (o_cnt == d_cnt)
+    keep = ~(empty | balanced)
+    pruned = {'empty': int(empty.sum()), 'balanced': int(balanced.sum())}
+    if probabilistic:
+        lam = bernoulli_lambda_array(o_cnt, d_cnt, net.o_count, net.d_count)
+        null_lambdas = simulate_null_lambdas(ran_net, epsilon, n_null)
+        exceed = len(null_lambdas) - np.searchsorted(null_lambdas, lam, side='right')
+        q_low = np.maximum(exceed / n_null - math.sqrt(math.log(1.0 / tol) / (2.0 * n_null)), 0.0)
+        max_exceed = math.floor(alpha * (1.0 + r_time) + 1e-9)
+        null = keep & (o_cnt > 0) & (d_cnt > 0) & (binomial_cdf(max_exceed, r_time, q_low) < tol)
+        keep &= ~null
+        pruned['probably_null'] = int(null.sum())
+    return [pi for pi, k in zip(points, keep) if k], pruned
@@ -0,0 +1,128 @@
+from typing import NamedTuple, Optional, Tuple
+from functools import lru_cache
+import multiprocessing as mp
+import random
+import numpy as np
+from graph.kernel import ArrayNetWork, Topology, Points
+from graph.lixel import aggregate_lixels
+
+
+class Realizations(NamedTuple):
+    """
+    Independent random realizations of the od records of a network (complete spatial randomness on its roads),
+    only the positions of the records are stored, one row per realization grouped by edge (CSR):
+    a realization is turned into od points on the shared topology when it is searched
+    """
+    edge_indptr: np.ndarray  # int64 [r, m + 1], edge -> records of each realization
+    offset: np.ndarray  # float32 [r, n], position of each record along its edge (fraction from its first node)
+    is_o: np.ndarray  # bool [r, n], whether each record is an origin
+
+
+def random_realization(roads, n_edge, o_count, d_count, seed_seq) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    One realization as graph.roadnet.generate_random_network: every record on a road with od points
+    (uniformly), then at a uniform position along the road
+
+    Returns
+    ----------
+    edge_indptr, offset, is_o : np.ndarray
+        one row of Realizations
+    """
+    rng = np.random.default_rng(seed_seq)
+    n = o_count + d_count
+    edge = roads[rng.integers(len(roads), size=n)]
+    offset = rng.random(n, dtype=np.float32)
+    order = np.argsort(edge, kind='stable')
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(edge, minlength=n_edge))))
+    return indptr.astype(np.int64), offset[order], order < o_count
+
+
+def generate_realizations(topology: Topology, points: Points, n_real, seed=2021, worker=1) -> Realizations:
+    """
+    Generate 'n_real' independent random realizations of the od records of a network, in 'worker' processes
+
+    Each realization draws from its own stream spawned by a SeedSequence of 'seed' (an int or a sequence of
+    ints), so the realizations are independent and do not depend on the number of workers.
+    """
+    roads = np.unique(points.pt_edge).astype(np.int64)
+    jobs = [(roads, len(topology.edge_len), int(points.loc_o.sum()), int(points.loc_d.sum()), seed_seq)
+            for seed_seq in np.random.SeedSequence(seed).spawn(n_real)]
+    if worker > 1 and n_real > 1:
+        with mp.Pool(min(worker, n_real)) as pool:
+            rows = pool.starmap(random_realization, jobs)
+    else:
+        rows = [random_realization(*job) for job in jobs]
+    return Realizations(*(np.stack(arrays) for arrays in zip(*rows)))
+
+
+def realization_points(topology: Topology, realizations: Realizations, r, lixel_length=None) -> Points:
+    """
+    Od points of the r-th realization (every record is a location of its own),
+    or its records aggregated into lixels of 'lixel_length' if given (see graph.lixel.aggregate_lixels)
+    """
+    indptr = np.asarray(realizations.edge_indptr[r])
+    edge = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    is_o = np.asarray(realizations.is_o[r])
+    if lixel_length is not None:
+        offset = np.asarray(realizations.offset[r], dtype=np.float64) * topology.edge_len[edge]
+        return aggregate_lixels(topology, edge, offset, is_o, ~is_o, lixel_length)
+    n1 = topology.node_xy[topology.edge_nodes[edge, 0]]
+    n2 = topology.node_xy[topology.edge_nodes[edge, 1]]
+    xy = n1 + np.asarray(realizations.offset[r], dtype=np.float64)[:, None] * (n2 - n1)
+    return Points(indptr, xy, edge.astype(np.int32), np.arange(len(edge), dtype=np.int32),
+                  np.ones(len(edge), dtype=np.int32), is_o.astype(np.int32), (~is_o).astype(np.int32))
+
+
+class RealizationNetWork:
+    """
+    Many random realizations standing in for the random network in the Monte Carlo tests
+    (see graph.roadnet.monte_carlo_test): every simulation draws a realization uniformly, then a record on it
+    as ArrayNetWork.random_match(), so the simulations of a test are spread over independent realizations
+    the records of each realization are aggregated into lixels of 'lixel_length' for the networks of lixels
+
+    The draws are made by a random.Random of its own seeded by 'seed'. The networks of the realizations are
+    built on use and only the 'cache_size' most recently used are kept (a rebuild takes about 1 ms on hour 8),
+    so the memory is bounded however many realizations are saved.
+    """
+
+    def __init__(self, topology: Topology, realizations: Realizations, include_seed=False,
+                 lixel_length=None, seed=None, cache_size=128) -> None:
+        self.topology = topology
+        self.realizations = realizations
+        self.include_seed = include_seed
+        self.lixel_length = lixel_length
+        self.n_real = len(realizations.edge_indptr)
+        # all the realizations hold the same numbers of origins and destinations
+        self.o_count = int(realizations.is_o[0].sum()) if self.n_real > 0 else 0
+        self.d_count = int((~realizations.is_o[0]).sum()) if self.n_real > 0 else 0
+        self.od_count = self.o_count + self.d_count
+        self.rng = random.Random(seed)
+        self.network = lru_cache(maxsize=cache_size)(self.__network)
+
+    def __network(self, r) -> ArrayNetWork:
+        """
+        The r-th realization as an array network, cached by r
+        """
+        points = realization_points(self.topology, self.realizations, r, lixel_length=self.lixel_length)
+        return ArrayNetWork(self.topology, points, include_seed=self.include_seed)
+
+    def random_match(self) -> Tuple[int, int]:
+        r = self.rng.randrange(self.n_real)
+        return r, self.network(r).random_match(rng=self.rng)
+
+    def calc_lambda(self, epsilon, pi) -> Optional[float]:
+        r, idx = pi
+        return self.network(r).calc_lambda(epsilon, idx)
+
+    def neighbor_counts(self, epsilon, seeds) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Od counts of the neighbourhoods of many draws (realization, index), the draws of each realization
+        are searched in one parallel batch (e.g. by graph.prune.simulate_null_lambdas)
+        """
+        real = np.asarray([r for r, _ in seeds], dtype=np.int64)
+        idx = np.asarray([i for _, i in seeds], dtype=np.int64)
+        ori_cnt, des_cnt = np.zeros(len(real), dtype=np.int64), np.zeros(len(real), dtype=np.int64)
+        for r in np.unique(real).tolist():
+            mask = real == r
+            ori_cnt[mask], des_cnt[mask] = self.network(r).neighbor_counts(epsilon, idx[mask])
+        return ori_cnt, des_cnt
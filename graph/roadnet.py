@@ -1,6 +1,5 @@
 from typing import Dict, List, Tuple, Set, Optional
 import numpy as np
-from sklearn.neighbors import KDTree
 from graph.linear import euclidean_distance, bernoulli_lambda, add, sub
 import random
 
@@ -52,6 +51,8 @@ class RoadNetWork:
         self.od_flags: Dict[int_, List[bool_]] = {}  # road id -> od flag (origin 1, dest 0)
         self.road_mark: Dict[(float_, float_), int_] = {}  # od point -> road id
         self.kd_trees = {}  # kd trees base on matches
+        self.od_weights: Dict[(float_, float_), List[int]] = {}  # od point -> [origin, dest] counts (once cleaned)
+        self.record_weights = None  # od point -> [origin, dest] counts of the uncleaned matches (built lazily)
         self.od_count, self.o_count, self.d_count = 0, 0, 0  # od points count
 
     def __add_node(self, x, y) -> (float_, float_):
@@ -63,24 +64,66 @@ class RoadNetWork:
             self.adjacency[new_n] = []
         return new_n
 
-    def build_kd_trees(self) -> None:
+    def build_kd_trees(self, road_ids=None) -> None:
         """
-        Build knn tree for each road
+        Build knn tree for each road (or only for the given roads)
         """
-        for road_id, points in self.matches.items():
+        from sklearn.neighbors import KDTree  # only the networks searched with kd trees need sklearn
+        if road_ids is None:
+            road_ids = self.matches.keys()
+        for road_id in road_ids:
+            points = self.matches.get(road_id, [])
             if len(points) > 0:
                 self.kd_trees[road_id] = KDTree(points)
+            else:
+                self.kd_trees.pop(road_id, None)
         return
 
+    def location_weights(self) -> Dict[Tuple[float_, float_], List[int]]:
+        """
+        Returns the numbers of origin and destination records at each od point {point => [origin, dest]}
+        """
+        if getattr(self, 'od_weights', None):  # networks pickled before the weights existed have none
+            return self.od_weights
+        weights = {}
+        for road_id, matches in self.matches.items():
+            for point, flag in zip(matches, self.od_flags[road_id]):
+                weights.setdefault(point, [0, 0])[0 if flag else 1] += 1
+        return weights
+
     def clean_matches(self) -> None:
         """
         Clear repeated matches on the same road
+        the records at the same point are kept as their multiplicities (see 'od_weights') instead, so every
+        record is counted exactly once by the neighbourhoods (should be called once all the matches are added)
         """
-        # the same results can be guaranteed for the same points
+        if getattr(self, 'od_weights', None):
+            return
+        weights = self.location_weights()
         for road_id, matches in self.matches.items():
-            self.matches[road_id] = list(set(matches))
+            # the same results can be guaranteed for the same points (the flags are kept aligned)
+            first = {}
+            for point, flag in zip(matches, self.od_flags[road_id]):
+                first.setdefault(point, flag)
+            self.matches[road_id] = list(first.keys())
+            self.od_flags[road_id] = list(first.values())
+        self.od_weights = weights
+        self.build_kd_trees()
         return
 
+    def __weight(self, point) -> Tuple[int, int]:
+        """
+        origin and destination counts of a match: the multiplicities of its point, so the cleaned and
+        uncleaned networks (and graph.kernel.ArrayNetWork) count every record at a point exactly once
+        """
+        weights = getattr(self, 'od_weights', None)
+        if not weights:
+            if getattr(self, 'record_weights', None) is None:  # dropped whenever the matches change
+                self.record_weights = self.location_weights()
+            weights = self.record_weights
+        weight = weights[point]
+        return weight[0], weight[1]
+
     def add_edge(self, road_id, x1, y1, x2, y2) -> None:
         """
         Add a new edge on the network
@@ -106,12 +149,55 @@ class RoadNetWork:
         self.matches[road_id].append(new_n)
         self.od_flags[road_id].append(o_d)
         self.road_mark[new_n] = road_id
+        self.record_weights = None
         self.od_count += 1
         if o_d:
             self.o_count += 1
         else:
             self.d_count += 1
 
+    def remove_matches(self, road_id, x, y, o_d) -> None:
+        """
+        Remove an existing match from the network (the kd tree of the road should be rebuilt afterwards)
+        """
+        road_id = int_(road_id)
+        o_d = bool_(o_d)
+        new_n = (x, y)
+        matches, flags = self.matches.get(road_id, []), self.od_flags.get(road_id, [])
+        idx = len(matches) - 1
+        while idx >= 0 and (matches[idx] != new_n or flags[idx] != o_d):
+            idx -= 1
+        assert idx >= 0, 'match should be on the network'
+        matches.pop(idx)
+        flags.pop(idx)
+        if new_n not in matches and self.road_mark.get(new_n) == road_id:
+            del self.road_mark[new_n]
+        if len(matches) == 0:
+            del self.matches[road_id]
+            del self.od_flags[road_id]
+        self.record_weights = None
+        self.od_count -= 1
+        if o_d:
+            self.o_count -= 1
+        else:
+            self.d_count -= 1
+
+    def all_matches(self) -> List[Tuple[float_, float_]]:
+        """
+        Returns all od points on the network (list of coordinates)
+        """
+        all_matches = []
+        for val in self.matches.values():
+            all_matches.extend(val)
+        return all_matches
+
+    def random_match(self) -> Tuple[float_, float_]:
+        """
+        Sample a road with matches uniformly and then an od point on it uniformly
+        """
+        road = random.sample(list(self.matches.keys()), 1)[0]
+        return random.sample(self.matches[road], 1)[0]
+
     def network_constrained_neighbors(self, epsilon, pi) -> Tuple[Set, int, int]:
         """
         Construct a network constrained neighborhood based on the edge-expansion method
@@ -144,16 +230,14 @@ class RoadNetWork:
         neighborhood = set()
         ori_cnt, des_cnt = 0, 0
         # search the matches on the matched road of pi firstly
-        matches, flags, kd_tree = self.matches[road_id], self.od_flags[road_id], self.kd_trees[road_id]
+        matches, kd_tree = self.matches[road_id], self.kd_trees[road_id]
         idxes = kd_tree.query_radius([point], epsilon)
         idxes = idxes[0] if len(idxes) > 0 else []
         for idx in idxes:
             if matches[idx] != point and matches[idx] not in neighborhood:
                 neighborhood.add(matches[idx])
-                if flags[idx]:
-                    ori_cnt += 1
-                else:
-                    des_cnt += 1
+                o_w, d_w = self.__weight(matches[idx])
+                ori_cnt, des_cnt = ori_cnt + o_w, des_cnt + d_w
         # then, expand the edges base on edge-expansion (using bfs)
         explored = {road_id}
         queue = [(st_node, epsilon - dist_st), (ed_node, epsilon - dist_ed)]
@@ -167,19 +251,14 @@ class RoadNetWork:
                 ed = self.edges[r_id]
                 n2 = ed[0] if n != ed[0] else ed[1]
                 dis = d - euclidean_distance(n, n2)
-                if r_id in self.matches:
-                    matches, flags = self.matches[r_id], self.od_flags[r_id]
-                else:
-                    matches, flags = [], []
+                matches = self.matches.get(r_id, [])
                 if dis >= 0:
                     # add all matches on the searching road if dis >= 0
-                    for idx, mat in enumerate(matches):
+                    for mat in matches:
                         if mat not in neighborhood:
                             neighborhood.add(mat)
-                            if flags[idx]:
-                                ori_cnt += 1
-                            else:
-                                des_cnt += 1
+                            o_w, d_w = self.__weight(mat)
+                            ori_cnt, des_cnt = ori_cnt + o_w, des_cnt + d_w
                     explored.add(r_id)  # possible circuits on road: to be optimised
                     queue.append((n2, dis))  # append to searching queue
                 elif r_id in self.kd_trees:
@@ -189,10 +268,8 @@ class RoadNetWork:
                     for idx in idxes:
                         if matches[idx] not in neighborhood:
                             neighborhood.add(matches[idx])
-                            if flags[idx]:
-                                ori_cnt += 1
-                            else:
-                                des_cnt += 1
+                            o_w, d_w = self.__weight(matches[idx])
+                            ori_cnt, des_cnt = ori_cnt + o_w, des_cnt + d_w
                 # if dis < 0 and none matched point existed, continue
         return neighborhood, ori_cnt, des_cnt
 
@@ -226,6 +303,35 @@ class RoadNetWork:
             return None
         return bernoulli_lambda(n_o_r, n_d_r, n_o, n_d), n_o_r, n_d_r, neighbour
 
+    def calc_lambda(self, epsilon, pi) -> Optional[float]:
+        """
+        Lambda value only, see docs in calc_test_statistics()
+        """
+        res = self.calc_test_statistics(epsilon, pi)
+        return None if res is None else res[0]
+
+
+def random_matches(net: RoadNetWork, rng=random):
+    """
+    Draw the same numbers of OD points as the observed dataset randomly on the road network
+    following complete spatial randomness with 'rng' (a random.Random, default = the global random module),
+    yield the (road id, x, y, od flag) of the points one by one
+    """
+    edges = net.edges
+    o_cnt = net.o_count
+    roads = list(net.matches.keys())
+    for i in range(net.od_count):
+        road_id = rng.sample(roads, 1)[0]
+        edge = edges[road_id]
+        p1, p2 = edge[0], edge[1]
+        p_x = p1[0] + rng.random() * (p2[0] - p1[0])
+        diff_y, diff_x = p2[1] - p1[1], p2[0] - p1[0]
+        not_ver = diff_x != 0
+        a = diff_y / diff_x if not_ver else np.inf
+        b = p1[1] - a * p1[0] if not_ver else (p1[1] + p2[1]) / 2
+        p_y = (a * p_x if not_ver else 0) + b
+        yield road_id, p_x, p_y, True if i < o_cnt else False
+
 
 def generate_random_network(net: RoadNetWork, seed=2021) -> RoadNetWork:
     """
@@ -248,33 +354,96 @@ def generate_random_network(net: RoadNetWork, seed=2021) -> RoadNetWork:
     random_net = RoadNetWork()
     random_net.edges = net.edges
     random_net.adjacency = net.adjacency
-    edges = net.edges
-    o_cnt = net.o_count
-    for i in range(net.od_count):
-        road_id = random.sample(net.matches.keys(), 1)[0]
-        edge = edges[road_id]
-        p1, p2 = edge[0], edge[1]
-        p_x = p1[0] + random.random() * (p2[0] - p1[0])
-        diff_y, diff_x = p2[1] - p1[1], p2[0] - p1[0]
-        not_ver = diff_x != 0
-        a = diff_y / diff_x if not_ver else np.inf
-        b = p1[1] - a * p1[0] if not_ver else (p1[1] + p2[1]) / 2
-        p_y = (a * p_x if not_ver else 0) + b
-        random_net.add_matches(road_id, p_x, p_y, True if i < o_cnt else False)
+    for road_id, p_x, p_y, o_d in random_matches(net):
+        random_net.add_matches(road_id, p_x, p_y, o_d)
     random_net.build_kd_trees()
     return random_net
 
 
-def identify_subareas(net: RoadNetWork, ran_net: RoadNetWork, test_pi, r_time, alpha, epsilon) \
+def monte_carlo_test(ran_net: RoadNetWork, lambda_obs, r_time, epsilon, alpha=None) -> Tuple[float, int]:
+    """
+    Estimate the p-value of lambda_obs by Monte Carlo simulation on the random road network
+
+    If 'alpha' is given, the simulation is sequential (Besag and Clifford, 1991): it stops as soon as
+    the decision 'p_value > alpha' can no longer change, i.e. once enough simulated lambdas have beaten
+    lambda_obs (not significant), or once the remaining simulations can no longer make it so (significant).
+    The decision is the same as the one of the full simulation with the same random draws.
+
+    Parameters
+    ----------
+    ran_net : RoadNetWork or ArrayNetWork
+        the random road network
+    lambda_obs : float
+        lambda value of observed road network
+    r_time : int
+        the number of repetitions of Monte Carlo simulation
+    epsilon : int or float
+        the neighbourhood cutoff radius
+    alpha : float, optional
+        a significance level, default = None (run all the simulations)
+
+    Returns
+    ----------
+    p_value : float
+        p-value of lambda_obs, h / (1 + r_time) for h exceedances in all the simulations
+        (for an early stop with h exceedances in l < r_time simulations, h / l if not significant)
+    n_sim : int
+        the number of simulations actually used
+    """
+    exceed = 0
+    for j in range(r_time):
+        lambda_j = ran_net.calc_lambda(epsilon, pi=ran_net.random_match())
+        if lambda_j is not None and lambda_j > lambda_obs:
+            exceed += 1
+        if alpha is None or j + 1 == r_time:  # a complete run returns the p-value of all the simulations
+            continue
+        if exceed / (1.0 + r_time) > alpha:
+            return exceed / (j + 1.0), j + 1
+        if (exceed + r_time - j - 1) / (1.0 + r_time) <= alpha:
+            return exceed / (1.0 + r_time), j + 1
+    return exceed / (1.0 + r_time), r_time
+
+
+def test_subarea(net: RoadNetWork, ran_net: RoadNetWork, test_pi, r_time, alpha, epsilon, sequential=False) \
+        -> Optional[Tuple[float, int, int, Set, float, int]]:
+    """
+    Test the neighbourhood of test_pi, see docs in identify_subareas() and monte_carlo_test()
+
+    Returns
+    ----------
+    None : If unreachable
+    lambda_obs : float
+        lambda value of observed road network
+    o_cnt, d_cnt : int
+        the number of origin and destination points in the neighbourhood
+    neighbour : set
+        a neighbourhood set for the given point test_pi
+    p_value : float
+        p-value of lambda_obs (nan if the simulation is skipped)
+    n_sim : int
+        the number of simulations actually used
+    """
+    res_obs = net.calc_test_statistics(epsilon, pi=test_pi)
+    if res_obs is None:
+        return None
+    lambda_obs, o_cnt, d_cnt, neighbour = res_obs
+    if sequential and o_cnt == d_cnt:
+        # neither a black hole nor a volcano whatever the p-value is
+        return lambda_obs, o_cnt, d_cnt, neighbour, float('nan'), 0
+    p_value, n_sim = monte_carlo_test(ran_net, lambda_obs, r_time, epsilon, alpha=alpha if sequential else None)
+    return lambda_obs, o_cnt, d_cnt, neighbour, p_value, n_sim
+
+
+def identify_subareas(net: RoadNetWork, ran_net: RoadNetWork, test_pi, r_time, alpha, epsilon, sequential=False) \
         -> Optional[Tuple[bool, float, Set]]:
     """
     Identification of subareas of urban black holes and volcanoes
 
     Parameters
     ----------
-    net : RoadNetWork
+    net : RoadNetWork or ArrayNetWork
         the observed road network
-    ran_net : RoadNetWork
+    ran_net : RoadNetWork or ArrayNetWork
         the random road network
     test_pi : tuple
         a OD point on 'net'
@@ -284,6 +453,8 @@ def identify_subareas(net: RoadNetWork, ran_net: RoadNetWork, test_pi, r_time, a
         a significance level
     epsilon : int or float
         the neighbourhood cutoff radius
+    sequential : bool, optional
+        stop the Monte Carlo simulation once the decision is settled, default = False
 
     Returns
     ----------
@@ -295,21 +466,10 @@ def identify_subareas(net: RoadNetWork, ran_net: RoadNetWork, test_pi, r_time, a
     neighbour : set
         a neighbourhood set for the given point test_pi
     """
-    res_obs = net.calc_test_statistics(epsilon, pi=test_pi)
-    if res_obs is None:
+    res = test_subarea(net, ran_net, test_pi, r_time, alpha, epsilon, sequential=sequential)
+    if res is None:
         return None
-    lambda_obs, o_cnt, d_cnt, neighbour = res_obs
-    p_value = 0
-    for __ in range(r_time):
-        road = random.sample(ran_net.matches.keys(), 1)[0]
-        ran_pi = random.sample(ran_net.matches[road], 1)[0]
-        res = ran_net.calc_test_statistics(epsilon, pi=ran_pi)
-        if res is None:
-            continue
-        lambda_j, _, _, _ = res
-        if lambda_j > lambda_obs:
-            p_value += 1
-    p_value /= (1.0 + r_time)
-    if p_value > alpha or o_cnt == d_cnt:
+    lambda_obs, o_cnt, d_cnt, neighbour, p_value, _ = res
+    if not p_value <= alpha or o_cnt == d_cnt:
         return None
     return d_cnt > o_cnt, lambda_obs, neighbour
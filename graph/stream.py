@@ -0,0 +1,307 @@
+from typing import Dict, List, Set, Tuple
+from collections import deque
+import time
+import random
+import numpy as np
+from graph.roadnet import RoadNetWork, random_matches
+from graph.linear import bernoulli_lambda_array
+
+
+class StreamingDetector:
+    """
+    Online detection of the subareas of urban black holes and volcanoes for a stream of OD events
+
+    For every OD location the network constrained neighbourhood and its od counts are cached.
+    A location counts all its records in the neighbourhoods (its origin and destination multiplicities
+    are kept in the 'od_weights' of the network, see RoadNetWork.clean_matches).
+    When an OD point arrives (or expires), only the locations within epsilon network distance
+    of it are updated, so the work per event is bounded by the size of one neighbourhood.
+    The neighbourhoods holding each location are indexed, so the counts follow the records of a location
+    exactly. The edge-expansion is not exactly symmetric at the border of a neighbourhood though: a new
+    location joins the neighbourhoods of its own neighbours, which may differ from the ones whose search would
+    reach it. These counts are corrected by searching the cached neighbourhoods again in a round robin
+    ('resync' locations per event), count_drift() measures the locations left with stale counts.
+    The Monte Carlo null distribution of lambda and the lambda values of untouched locations
+    (which only drift with the global od totals) are refreshed every 'refresh' events: the new null is built
+    and the locations are scored again a few steps per event (spread over the next 'refresh' events),
+    and the old null is used until the new one is complete.
+    """
+
+    SCORE_CHUNK = 1000  # locations scored again in one step of a refresh
+
+    def __init__(self, net: RoadNetWork, epsilon, alpha=0.05, r_time=99, refresh=500, resync=2,
+                 seed=2021) -> None:
+        """
+        Parameters
+        ----------
+        net : RoadNetWork
+            the road network (it may already contain od points)
+        epsilon : int or float
+            the neighbourhood cutoff radius
+        alpha : float
+            a significance level
+        r_time : int
+            the number of repetitions of Monte Carlo simulation
+        refresh : int
+            the number of events between two refreshes of the null distribution
+        resync : int
+            the number of cached neighbourhoods searched again after each event
+        seed : int, optional
+            random seed of the Monte Carlo simulation
+        """
+        self.net = net
+        self.epsilon, self.alpha, self.r_time, self.refresh, self.resync = epsilon, alpha, r_time, refresh, resync
+        self.rng = random.Random(seed)
+        self.pi_type: Dict[Tuple, List[bool]] = {}  # location -> od flags of the records on it
+        self.weights: Dict[Tuple, List[int]] = net.location_weights()  # location -> [origin, dest] records
+        net.od_weights = self.weights  # the searches count the multiplicities of the locations
+        self.neighbours: Dict[Tuple, Set] = {}  # location -> network constrained neighbourhood
+        self.counts: Dict[Tuple, List[int]] = {}  # location -> [ori_cnt, des_cnt] of the neighbourhood
+        self.holders: Dict[Tuple, Set] = {}  # location -> locations whose neighbourhood holds it
+        self.significant: Dict[Tuple, Tuple[bool, float, Set]] = {}  # location -> (flag, lambda, neighbour)
+        self.null_lambdas = np.zeros(0)
+        self.latency = deque(maxlen=10000)  # seconds spent on each of the latest events
+        self.version = 0  # increased when a significant location is added, removed or changes flag or neighbourhood
+        self.changed: Set = set()  # significant locations changed (as counted by 'version') since on_change
+        self.on_change = None  # called with 'changed' at the end of an event (counted in its latency)
+        self.__pending = 0
+        self.__job = None  # steps of the refresh in progress
+        self.__rate = 1  # steps of the refresh run after each event
+        self.__rounds = deque()  # round robin of the locations to be searched again
+        for pi, (o_w, d_w) in self.weights.items():
+            self.pi_type[pi] = [True] * o_w + [False] * d_w
+        for pi in self.pi_type:
+            self.__search(pi)
+            self.__rounds.append(pi)
+        self.refresh_all()
+
+    def __search(self, pi) -> Set:
+        """
+        Search the neighbourhood of location pi (again) and update the index of the holders,
+        returns the locations which joined or left it
+        """
+        neighbour, o_cnt, d_cnt = self.net.network_constrained_neighbors(self.epsilon, pi)
+        old = self.neighbours.get(pi, set())
+        for p in old - neighbour:
+            self.holders[p].discard(pi)
+        for p in neighbour - old:
+            self.holders.setdefault(p, set()).add(pi)
+        self.neighbours[pi] = neighbour
+        self.counts[pi] = [o_cnt, d_cnt]
+        return neighbour ^ old
+
+    def __changed(self, pi) -> None:
+        self.version += 1
+        self.changed.add(pi)
+
+    def __null_steps(self):
+        """
+        Re-simulate the null distribution of lambda on a random network with the current od totals,
+        one random point, kd tree or simulation per step, the new null replaces the old one once complete
+        """
+        if self.net.o_count == 0 or self.net.d_count == 0:
+            self.null_lambdas = np.zeros(0)
+            return
+        ran_net = RoadNetWork()
+        ran_net.edges = self.net.edges
+        ran_net.adjacency = self.net.adjacency
+        for road_id, p_x, p_y, o_d in random_matches(self.net, rng=self.rng):
+            ran_net.add_matches(road_id, p_x, p_y, o_d)
+            yield
+        roads = list(ran_net.matches.keys())
+        for road_id in roads:
+            ran_net.build_kd_trees([road_id])
+            yield
+        null = []
+        for __ in range(self.r_time):
+            road = self.rng.choice(roads)
+            res = ran_net.calc_test_statistics(self.epsilon, pi=self.rng.choice(ran_net.matches[road]))
+            if res is not None:
+                null.append(res[0])
+            yield
+        self.null_lambdas = np.sort(np.asarray(null, dtype=np.float64))
+
+    def __refresh_steps(self):
+        """
+        Steps of a refresh: the null distribution, then every location scored again ('SCORE_CHUNK' per step)
+        """
+        yield from self.__null_steps()
+        points = list(self.counts.keys())
+        for st in range(0, len(points), self.SCORE_CHUNK):
+            self.__score(points[st:st + self.SCORE_CHUNK])
+            yield
+
+    def refresh_null(self) -> None:
+        """
+        Re-simulate the null distribution of lambda on a random network with the current od totals
+        """
+        for __ in self.__null_steps():
+            pass
+
+    def __score(self, points) -> None:
+        """
+        Re-evaluate lambda and the significance of the given locations
+        """
+        points = [pi for pi in points if pi in self.counts]
+        if len(points) == 0:
+            return
+        cnt = np.asarray([self.counts[pi] for pi in points]).reshape(-1, 2)
+        lam = bernoulli_lambda_array(cnt[:, 0], cnt[:, 1], self.net.o_count, self.net.d_count)
+        # number of simulated lambdas larger than the observed one
+        exceed = len(self.null_lambdas) - np.searchsorted(self.null_lambdas, lam, side='right')
+        p_value = exceed / (1.0 + self.r_time)
+        keep = ~np.isnan(lam) & (p_value <= self.alpha) & (cnt[:, 0] != cnt[:, 1])
+        for pi, k, lam_pi, (o_cnt, d_cnt) in zip(points, keep, lam, cnt):
+            if k:
+                old = self.significant.get(pi)
+                flag = bool(d_cnt > o_cnt)
+                if old is None or old[0] != flag:
+                    self.__changed(pi)
+                self.significant[pi] = (flag, float(lam_pi), self.neighbours[pi])
+            elif pi in self.significant:
+                del self.significant[pi]
+                self.__changed(pi)
+
+    def refresh_all(self) -> None:
+        """
+        Refresh the null distribution and re-evaluate every location
+        """
+        self.__job = None
+        for __ in self.__refresh_steps():
+            pass
+        self.__pending = 0
+
+    def __shift(self, pi, old_w, new_w) -> Set:
+        """
+        Move the contribution (origin and destination records) of location pi in the neighbourhoods holding it
+        (new_w is None if pi leaves, old_w is None if pi joins the neighbourhoods of its neighbours),
+        returns the locations whose counts changed
+        """
+        holders = self.holders.setdefault(pi, set())
+        if old_w is None:
+            for q in self.neighbours[pi]:
+                if q in self.neighbours and pi not in self.neighbours[q]:
+                    self.neighbours[q].add(pi)
+                    holders.add(q)
+                    if q in self.significant:
+                        self.__changed(q)  # the neighbourhood of a significant location changed
+        for q in holders:
+            cnt = self.counts[q]
+            if old_w is not None:
+                cnt[0], cnt[1] = cnt[0] - old_w[0], cnt[1] - old_w[1]
+            if new_w is not None:
+                cnt[0], cnt[1] = cnt[0] + new_w[0], cnt[1] + new_w[1]
+        if new_w is None:
+            del self.holders[pi]
+            for q in holders:
+                self.neighbours[q].discard(pi)
+                if q in self.significant:
+                    self.__changed(q)
+            for p in self.neighbours[pi]:
+                self.holders[p].discard(pi)
+        return holders
+
+    def __resync(self, dirty: Set) -> None:
+        """
+        Search the neighbourhoods of the next locations in the round robin again
+        """
+        for __ in range(min(self.resync, len(self.__rounds))):
+            pi = self.__rounds.popleft()
+            if pi not in self.pi_type:
+                continue
+            if self.__search(pi) and pi in self.significant:
+                self.__changed(pi)
+            self.__rounds.append(pi)
+            dirty.add(pi)
+
+    def count_drift(self, n_sample=None) -> Dict[str, float]:
+        """
+        Search the neighbourhoods of (a sample of 'n_sample' of) the locations again, without updating them,
+        and compare their od counts with the cached ones: the number of locations checked, the number of them
+        with stale counts and the largest error of a count
+        """
+        points = list(self.counts.keys())
+        if n_sample is not None and n_sample < len(points):
+            points = self.rng.sample(points, n_sample)
+        stale, max_err = 0, 0
+        for pi in points:
+            _, o_cnt, d_cnt = self.net.network_constrained_neighbors(self.epsilon, pi)
+            err = max(abs(self.counts[pi][0] - o_cnt), abs(self.counts[pi][1] - d_cnt))
+            stale, max_err = stale + (err > 0), max(max_err, err)
+        return {'checked': len(points), 'stale': stale, 'max_error': max_err}
+
+    def __finish(self, dirty, t0) -> None:
+        self.__resync(dirty)
+        if len(self.null_lambdas) == 0:
+            self.refresh_all()
+        else:
+            self.__score(dirty)
+            self.__pending += 1
+            if self.__job is None and self.__pending >= self.refresh:
+                # the refresh is spread over the next 'refresh' events
+                steps = (self.net.od_count + len(self.net.matches) + self.r_time
+                         + len(self.counts) // self.SCORE_CHUNK + 1)
+                self.__job, self.__rate = self.__refresh_steps(), -(-steps // self.refresh)
+                self.__pending = 0
+            for __ in range(self.__rate if self.__job is not None else 0):
+                if next(self.__job, StopIteration) is StopIteration:
+                    self.__job = None
+                    break
+        if self.on_change is not None and self.changed:
+            changed, self.changed = self.changed, set()
+            self.on_change(changed)
+        self.latency.append(time.perf_counter() - t0)
+
+    def add_event(self, road_id, x, y, o_d) -> None:
+        """
+        Add an OD point (the start or the end of a trip) to the network and update the detection
+        """
+        t0 = time.perf_counter()
+        pi = (x, y)
+        self.net.add_matches(road_id, x, y, o_d)
+        self.net.build_kd_trees([road_id])
+        if pi not in self.pi_type:
+            # a new location: its neighbourhood is searched once and it joins the neighbours' neighbourhoods
+            self.pi_type[pi] = [bool(o_d)]
+            self.weights[pi] = [1, 0] if o_d else [0, 1]
+            self.__search(pi)
+            self.__rounds.append(pi)
+            dirty = self.__shift(pi, None, tuple(self.weights[pi]))
+        else:
+            self.pi_type[pi].append(bool(o_d))
+            weight = self.weights[pi]
+            old_w = tuple(weight)
+            weight[0 if o_d else 1] += 1
+            dirty = self.__shift(pi, old_w, tuple(weight))
+        self.__finish(dirty | {pi}, t0)
+
+    def remove_event(self, road_id, x, y, o_d) -> None:
+        """
+        Remove an expired OD point from the network and update the detection
+        """
+        t0 = time.perf_counter()
+        pi = (x, y)
+        self.net.remove_matches(road_id, x, y, o_d)
+        self.net.build_kd_trees([road_id])
+        flags, weight = self.pi_type[pi], self.weights[pi]
+        flags.remove(bool(o_d))
+        old_w = tuple(weight)
+        weight[0 if o_d else 1] -= 1
+        if len(flags) == 0:
+            dirty = self.__shift(pi, old_w, None)
+            del self.pi_type[pi], self.weights[pi], self.neighbours[pi], self.counts[pi]
+            if self.significant.pop(pi, None) is not None:
+                self.__changed(pi)
+        else:
+            dirty = self.__shift(pi, old_w, tuple(weight)) | {pi}
+        self.__finish(dirty, t0)
+
+    def latency_summary(self) -> Dict[str, float]:
+        """
+        Summary (in milliseconds) of the per-event latency of the latest events
+        """
+        if len(self.latency) == 0:
+            return {}
+        lat = np.asarray(self.latency) * 1000
+        return {'mean': float(lat.mean()), 'p50': float(np.percentile(lat, 50)),
+                'p99': float(np.percentile(lat, 99)), 'max': float(lat.max())}
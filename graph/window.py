@@ -0,0 +1,214 @@
+from typing import Iterator, Set, Tuple
+import numpy as np
+from graph.roadnet import RoadNetWork
+from graph.kernel import Topology, Points
+
+
+class SlidingWindow:
+    """
+    Sliding time window over OD events on a single road network topology
+
+    The network is never rebuilt: when the window moves, the OD points leaving it
+    are removed and the OD points entering it are added, and only the kd trees of
+    the touched roads are rebuilt.
+    """
+
+    def __init__(self, net: RoadNetWork, times, road_ids, xs, ys, flags) -> None:
+        """
+        Parameters
+        ----------
+        net : RoadNetWork
+            a road network holding the topology only (edges and adjacency)
+        times : array-like of datetime64
+            timestamps of the OD events
+        road_ids, xs, ys, flags : array-like
+            road id, coordinates and od flag (origin 1, dest 0) of the OD events
+        """
+        assert net.od_count == 0, 'the network should not contain any od point'
+        order = np.argsort(np.asarray(times, dtype='datetime64[s]'), kind='stable')
+        self.times = np.asarray(times, dtype='datetime64[s]')[order]
+        self.road_ids = np.asarray(road_ids)[order]
+        self.xs, self.ys = np.asarray(xs)[order], np.asarray(ys)[order]
+        self.flags = np.asarray(flags, dtype=bool)[order]
+        self.net = net
+        self.lo, self.hi = 0, 0  # current window covers events[lo:hi]
+        self.start, self.end = None, None
+
+    def __apply(self, st, ed, add, dirty: Set[int]) -> None:
+        for i in range(st, ed):
+            road_id, x, y, o_d = self.road_ids[i], self.xs[i], self.ys[i], self.flags[i]
+            if add:
+                self.net.add_matches(road_id, x, y, o_d)
+            else:
+                self.net.remove_matches(road_id, x, y, o_d)
+            dirty.add(int(road_id))
+
+    def move_to(self, start, end) -> Set[int]:
+        """
+        Move the window to [start, end) and update the network incrementally
+
+        Parameters
+        ----------
+        start, end : datetime64 or str
+            bounds of the new window, both must not be earlier than the current ones
+
+        Returns
+        ----------
+        dirty : set
+            ids of the roads whose od points have changed
+        """
+        start, end = np.datetime64(start, 's'), np.datetime64(end, 's')
+        assert start <= end, 'window should not end before it starts'
+        assert self.start is None or (start >= self.start and end >= self.end), 'window can only slide forward'
+        new_lo = int(np.searchsorted(self.times, start, side='left'))
+        new_hi = int(np.searchsorted(self.times, end, side='left'))
+        dirty = set()
+        # events [lo, new_lo) leave the window and events [hi, new_hi) enter it
+        self.__apply(self.lo, min(new_lo, self.hi), False, dirty)
+        self.__apply(max(self.hi, new_lo), new_hi, True, dirty)
+        self.net.build_kd_trees(dirty)
+        self.lo, self.hi = new_lo, new_hi
+        self.start, self.end = start, end
+        return dirty
+
+    def windows(self, start, end, width, step) -> Iterator[Tuple[np.datetime64, np.datetime64, RoadNetWork]]:
+        """
+        Slide the window from 'start' to 'end' and yield (start, end, network) for each position
+
+        Parameters
+        ----------
+        start, end : datetime64 or str
+            the whole time range to be covered, e.g. '2014-05-07 00:00:00'
+        width : timedelta64
+            the width of each window, e.g. np.timedelta64(15, 'm')
+        step : timedelta64
+            the step between two successive windows, e.g. np.timedelta64(5, 'm')
+
+        NOTE: the yielded network is updated in place when the generator resumes
+        """
+        start, end = np.datetime64(start, 's'), np.datetime64(end, 's')
+        width, step = np.timedelta64(width, 's'), np.timedelta64(step, 's')
+        assert width > np.timedelta64(0, 's') and step > np.timedelta64(0, 's')
+        st = start
+        while st + width <= end:
+            self.move_to(st, st + width)
+            yield st, st + width, self.net
+            st += step
+
+
+class ArrayWindow:
+    """
+    Sliding time window over OD events on an array-backed topology (see graph.kernel.ArrayNetWork)
+
+    The od points are kept per edge: when the window moves, only the points of the edges with events
+    entering or leaving the window are counted again, and the od counts of the locations and the totals
+    are updated from these events, so a window costs the events it moves over (plus the concatenation
+    of the per-edge points into the Points of the window) instead of a full rebuild.
+    The locations are the ones of all the events (their ids do not change between windows).
+    """
+
+    def __init__(self, topology: Topology, times, road_ids, xs, ys, flags) -> None:
+        """
+        Parameters
+        ----------
+        topology : Topology
+            the road network
+        times : array-like of datetime64
+            timestamps of the OD events
+        road_ids, xs, ys, flags : array-like
+            road id, coordinates and od flag (origin 1, dest 0) of the OD events
+        """
+        order = np.argsort(np.asarray(times, dtype='datetime64[s]'), kind='stable')
+        self.times = np.asarray(times, dtype='datetime64[s]')[order]
+        self.topology = topology
+        road_ids = np.asarray(road_ids)[order]
+        by_road = np.argsort(topology.road_ids)
+        pos = np.searchsorted(topology.road_ids[by_road], road_ids)
+        self.edge = by_road[np.minimum(pos, len(by_road) - 1)].astype(np.int64)
+        assert np.all(topology.road_ids[self.edge] == road_ids), 'the od events should be matched to the roads'
+        xy = np.stack((np.asarray(xs)[order], np.asarray(ys)[order]), axis=1).astype(np.float64)
+        self.loc_xy, self.uid = np.unique(xy.reshape(-1, 2), axis=0, return_inverse=True)
+        self.uid = self.uid.reshape(-1)
+        self.flags = np.asarray(flags, dtype=bool)[order]
+        # events of each edge (CSR), in time order
+        self.edge_events = np.argsort(self.edge, kind='stable')
+        self.edge_indptr = np.concatenate(([0], np.cumsum(np.bincount(self.edge, minlength=len(topology.edge_len)))))
+        self.loc_o = np.zeros(len(self.loc_xy), dtype=np.int32)
+        self.loc_d = np.zeros(len(self.loc_xy), dtype=np.int32)
+        self.o_count, self.d_count = 0, 0
+        self.edge_points = {}  # edge -> (location ids, numbers of records) of its od points in the window
+        self.lo, self.hi = 0, 0  # current window covers events[lo:hi]
+        self.start, self.end = None, None
+
+    def __apply(self, st, ed, sign, dirty: Set[int]) -> None:
+        if st >= ed:
+            return
+        uid, flags = self.uid[st:ed], self.flags[st:ed]
+        np.add.at(self.loc_o, uid[flags], sign)
+        np.add.at(self.loc_d, uid[~flags], sign)
+        n_o = int(flags.sum())
+        self.o_count += sign * n_o
+        self.d_count += sign * (ed - st - n_o)
+        dirty.update(np.unique(self.edge[st:ed]).tolist())
+
+    def __count_edge(self, edge) -> None:
+        events = self.edge_events[self.edge_indptr[edge]:self.edge_indptr[edge + 1]]
+        # the events of an edge are in time order, so the ones in the window are contiguous
+        events = events[np.searchsorted(events, self.lo):np.searchsorted(events, self.hi)]
+        if len(events) == 0:
+            self.edge_points.pop(edge, None)
+        else:
+            self.edge_points[edge] = np.unique(self.uid[events], return_counts=True)
+
+    def move_to(self, start, end) -> Set[int]:
+        """
+        Move the window to [start, end) and update the od points incrementally (see SlidingWindow.move_to())
+
+        Returns
+        ----------
+        dirty : set
+            indices of the edges whose od points have changed
+        """
+        start, end = np.datetime64(start, 's'), np.datetime64(end, 's')
+        assert start <= end, 'window should not end before it starts'
+        assert self.start is None or (start >= self.start and end >= self.end), 'window can only slide forward'
+        new_lo = int(np.searchsorted(self.times, start, side='left'))
+        new_hi = int(np.searchsorted(self.times, end, side='left'))
+        dirty = set()
+        self.__apply(self.lo, min(new_lo, self.hi), -1, dirty)
+        self.__apply(max(self.hi, new_lo), new_hi, 1, dirty)
+        self.lo, self.hi = new_lo, new_hi
+        self.start, self.end = start, end
+        for edge in dirty:
+            self.__count_edge(edge)
+        return dirty
+
+    def points(self) -> Points:
+        """
+        The od points of the current window, grouped by edge
+        """
+        n_edge = len(self.topology.edge_len)
+        edges = np.asarray(sorted(self.edge_points), dtype=np.int64)
+        parts = [self.edge_points[e] for e in edges.tolist()]
+        sizes = np.asarray([len(uid) for uid, _ in parts], dtype=np.int64)
+        uid = np.concatenate([uid for uid, _ in parts]) if parts else np.zeros(0, dtype=np.int64)
+        cnt = np.concatenate([cnt for _, cnt in parts]) if parts else np.zeros(0, dtype=np.int64)
+        counts = np.zeros(n_edge, dtype=np.int64)
+        counts[edges] = sizes
+        return Points(np.concatenate(([0], np.cumsum(counts))).astype(np.int64), self.loc_xy[uid],
+                      np.repeat(edges, sizes).astype(np.int32), uid.astype(np.int32), cnt.astype(np.int32),
+                      self.loc_o.copy(), self.loc_d.copy())
+
+    def windows(self, start, end, width, step) -> Iterator[Tuple[np.datetime64, np.datetime64, Points]]:
+        """
+        Slide the window from 'start' to 'end' and yield (start, end, od points) for each position,
+        see SlidingWindow.windows()
+        """
+        start, end = np.datetime64(start, 's'), np.datetime64(end, 's')
+        width, step = np.timedelta64(width, 's'), np.timedelta64(step, 's')
+        assert width > np.timedelta64(0, 's') and step > np.timedelta64(0, 's')
+        st = start
+        while st + width <= end:
+            self.move_to(st, st + width)
+            yield st, st + width, self.points()
+            st += step
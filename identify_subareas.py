@@ -1,11 +1,363 @@
+import os
+import os.path as osp
+import random
 import multiprocessing as mp
-from utils.common import split_worker
+from utils.common import split_worker, simulations_path
 import numpy as np
 from tqdm import tqdm
-from graph.roadnet import identify_subareas
+from graph.roadnet import test_subarea
+from graph.kernel import ArrayNetWork, Topology, Points, build_topology, load_arrays, has_arrays, warm_up
+from graph.prune import prune_points
+from graph.lixel import is_lixel_label, lixel_length_of
+from graph.partition import NullPool, partition_network, load_tile, simulate_null_pool, remove_tiles
+from graph.approx import approximate_test
+from graph.layers import stack_layers, layered_test
+from graph.realizations import Realizations, RealizationNetWork
+from graph.contract import coarse_screen
+from utils.store import ResultStore
 
+arrays_dir = 'output/network_arrays'  # array snapshots of the networks (see preprocess.save_network_arrays)
 
-def combine_subareas(_st, _ed):
+
+def detect_subareas(net, ran_net, r_time, alpha, epsilon, sequential=False, n_sims=None, prune=False,
+                    point_range=None, points=None, stats=None, pruned=None):
+    """
+    Test every distinct OD location on 'net' (once, whatever the number of its records)
+    and yield (pi, flag, lambda_obs, neighbour, p_value, o_cnt, d_cnt) for the significant ones
+    the number of Monte Carlo simulations used for each tested point is recorded in 'n_sims' (a dict) if given
+    (pi, lambda_obs, p_value, o_cnt, d_cnt, n_sim) of every tested point is appended to 'stats' (a list) if given
+    the locations which cannot become subareas are skipped beforehand if 'prune', and the ones which are probably
+    not significant as well if prune == 'probabilistic' (see graph.prune.prune_points), the number of locations
+    skipped for each reason is recorded in 'pruned' (a dict) if given
+    only the given locations (default = all_matches()) are tested, or their [start, end) if 'point_range' is given
+    """
+    if points is None:
+        points = net.all_matches()
+    if point_range is not None:
+        points = points[point_range[0]:point_range[1]]
+    if prune:
+        points, skipped = prune_points(net, ran_net, r_time, alpha, epsilon, probabilistic=prune == 'probabilistic',
+                                       points=points)
+        if pruned is not None:
+            pruned.update(skipped)
+    for pi in tqdm(points, miniters=100, mininterval=30, maxinterval=300):
+        res = test_subarea(net, ran_net, pi, r_time=r_time, alpha=alpha, epsilon=epsilon, sequential=sequential)
+        if res is None:
+            continue
+        lambda_obs, o_cnt, d_cnt, neighbour, p_value, n_sim = res
+        if n_sims is not None:
+            n_sims[pi] = n_sim
+        if stats is not None:
+            stats.append((pi, lambda_obs, p_value, o_cnt, d_cnt, n_sim))
+        if not p_value <= alpha or o_cnt == d_cnt:
+            continue
+        yield pi, d_cnt > o_cnt, lambda_obs, neighbour, p_value, o_cnt, d_cnt
+
+
+def save_subareas(store: ResultStore, time_idx, epsilon, subareas):
+    """
+    Save the detected subareas {'hole' | 'volcano' => [(pi, lambda_obs, neighbour, p_value, o_cnt, d_cnt)]}
+    in the result store
+    """
+    for kind, records in subareas.items():
+        store.write(time_idx, epsilon, kind, [r[2] for r in records],
+                    seed_xy=np.asarray([r[0] for r in records], dtype=np.float64).reshape(-1, 2),
+                    lam=np.asarray([r[1] for r in records], dtype=np.float32),
+                    p_value=np.asarray([r[3] for r in records], dtype=np.float32),
+                    o_cnt=np.asarray([r[4] for r in records], dtype=np.int32),
+                    d_cnt=np.asarray([r[5] for r in records], dtype=np.int32))
+
+
+def p_value_bounds(p_value, n_sim, r_time, alpha, sequential):
+    """
+    Bounds of the p-values of all the r_time simulations from the ones of the tests (see monte_carlo_test()
+    in graph.roadnet), a sequential test stopped after n_sim simulations only knows its exceedances among them
+    """
+    p_value, n_sim = np.asarray(p_value, dtype=np.float64), np.asarray(n_sim, dtype=np.float64)
+    if not sequential:
+        return np.stack((p_value, p_value), axis=1)
+    # a complete run has p_value = exceed / (1 + r_time), an early stop is not significant
+    # (p_value = exceed / n_sim > alpha) or significant (exceed / (1 + r_time))
+    early_null = (n_sim < r_time) & (p_value > alpha)
+    exceed = np.round(np.where(early_null, p_value * n_sim, p_value * (1.0 + r_time)))
+    low, high = exceed / (1.0 + r_time), (exceed + r_time - n_sim) / (1.0 + r_time)
+    # the balanced neighbourhoods are not simulated (nan)
+    return np.stack((np.where(np.isnan(p_value), 0.0, low), np.where(np.isnan(p_value), 1.0, high)), axis=1)
+
+
+def save_point_stats(store: ResultStore, time_idx, epsilon, stats, r_time, alpha, sequential, prune):
+    """
+    Save the statistics of all the tested points [(pi, lambda_obs, p_value, o_cnt, d_cnt, n_sim)] (see detect_subareas)
+    as the table 'stats' of the result store, so that the subareas of any alpha are selected without simulating again
+    """
+    p_value = np.asarray([r[2] for r in stats], dtype=np.float64)
+    n_sim = np.asarray([r[5] for r in stats], dtype=np.int32)
+    store.write_table(time_idx, epsilon, 'stats',
+                      params={'r_time': r_time, 'alpha': alpha, 'sequential': sequential, 'prune': prune},
+                      seed_xy=np.asarray([r[0] for r in stats], dtype=np.float64).reshape(-1, 2),
+                      lam=np.asarray([r[1] for r in stats], dtype=np.float32), p_value=p_value.astype(np.float32),
+                      p_bounds=p_value_bounds(p_value, n_sim, r_time, alpha, sequential).astype(np.float32),
+                      o_cnt=np.asarray([r[3] for r in stats], dtype=np.int32),
+                      d_cnt=np.asarray([r[4] for r in stats], dtype=np.int32), n_sim=n_sim)
+
+
+def select_subareas(time_idx, epsilon, alpha, store=None):
+    """
+    Select the subareas of a significance level from the table of the tested points (see save_point_stats)
+
+    The p-values of a sequential run are only known up to bounds, so a point is selected if its upper bound
+    is below alpha and left undetermined if alpha lies within its bounds. The points pruned by the run (see
+    graph.prune.prune_points) are not in the table: they are not significant at any alpha, except the ones of
+    a probabilistic prune or a hierarchical run which are only known not to be significant at its alpha.
+
+    Returns
+    ----------
+    hole, volcano : np.ndarray
+        indices (in the table) of the seeds of the black holes and volcanoes
+    undetermined : np.ndarray
+        indices of the points whose test must be run again with this alpha
+    """
+    store = ResultStore() if store is None else store
+    table = store.read_summary(time_idx, epsilon, 'stats')
+    params = store.table_params(time_idx, epsilon)
+    if params.get('prune') in ('probabilistic', 'hierarchical') and alpha > params['alpha']:
+        print(f'{time_idx} (epsilon = {epsilon}): the points pruned with alpha = {params["alpha"]} '
+              f'may be significant with alpha = {alpha}')
+    o_cnt, d_cnt = table['o_cnt'], table['d_cnt']
+    low, high = table['p_bounds'][:, 0], table['p_bounds'][:, 1]
+    significant = (high <= alpha) & (o_cnt != d_cnt)
+    undetermined = (low <= alpha) & (high > alpha) & (o_cnt != d_cnt)
+    return (np.nonzero(significant & (d_cnt > o_cnt))[0], np.nonzero(significant & (d_cnt < o_cnt))[0],
+            np.nonzero(undetermined)[0])
+
+
+def reselect_partition(time_idx, epsilon, alpha, load_dir=None):
+    """
+    Replace the subareas of a time index (or label) in the result store with the ones of another significance
+    level, selected from the table of the tested points (no Monte Carlo simulation, see select_subareas())
+    the members of the selected subareas are searched again on the network
+    """
+    store = ResultStore()
+    hole, volcano, undetermined = select_subareas(time_idx, epsilon, alpha, store)
+    if len(undetermined) > 0:
+        print(f'{time_idx} (epsilon = {epsilon}): {len(undetermined)} points undetermined with alpha = {alpha}, '
+              f'run identify_partition() without sequential tests')
+    table = store.read_summary(time_idx, epsilon, 'stats')
+    net, _ = load_array_networks(time_idx, load_dir)
+    subareas = {'hole': [], 'volcano': []}
+    for kind, idx in (('hole', hole), ('volcano', volcano)):
+        for i in idx.tolist():
+            pi = tuple(table['seed_xy'][i].tolist())
+            members, _, _ = net.neighbor_indices(epsilon, pi)
+            subareas[kind].append((pi, table['lam'][i], net.points.pt_xy[members], table['p_value'][i],
+                                   table['o_cnt'][i], table['d_cnt'][i]))
+    save_subareas(store, time_idx, epsilon, subareas)
+    return subareas
+
+
+def load_array_networks(time_idx, load_dir=None, realizations=False, seed=None):
+    """
+    Map the array snapshots of the observed and random networks of the time index (in 'arrays_dir' by default)
+    the topology and the od points are shared (zero-copy) by all the workers mapping them
+    the random network is made of the saved random realizations if 'realizations' (see preprocess.save_realizations),
+    its draws are seeded by 'seed'
+    """
+    load_dir = arrays_dir if load_dir is None else load_dir
+    topology = load_arrays(osp.join(load_dir, 'topology'), Topology)
+    include_seed = is_lixel_label(time_idx)  # a seed lixel holds records of its own neighbourhood
+    net = ArrayNetWork(topology, load_arrays(osp.join(load_dir, f'network_{time_idx}'), Points),
+                       include_seed=include_seed)
+    if realizations:
+        # the realizations of a lixel network are aggregated into its lixels as well
+        ran_net = RealizationNetWork(topology, load_arrays(osp.join(load_dir, f'realizations_{time_idx}'),
+                                                           Realizations), include_seed=include_seed,
+                                     lixel_length=lixel_length_of(time_idx), seed=seed)
+    else:
+        ran_net = ArrayNetWork(topology, load_arrays(osp.join(load_dir, f'network_random_{time_idx}'), Points),
+                               include_seed=include_seed)
+    return net, ran_net
+
+
+def identify_partition(time_idx, epsilon, r_time, alpha, sequential=False, prune=False, seed=None, load_dir=None,
+                       realizations=False, hierarchical=False, screen_alpha=None):
+    """
+    Identify the subareas of a time index (or label) with the neighbourhood cutoff radius epsilon,
+    the results and the statistics of all the tested points (see save_point_stats) are saved in the result store
+    the Monte Carlo draws are seeded by 'seed' and the partition if given (the results are reproducible)
+    and spread over the saved random realizations if 'realizations' (see preprocess.save_realizations)
+    only the locations of the candidate regions detected on the contracted network are tested if 'hierarchical'
+    (coarse to fine, see graph.contract.coarse_screen)
+    """
+    if seed is not None:
+        seed = f'{seed}_{time_idx}_{epsilon}'
+        random.seed(seed)
+    net, ran_net = load_array_networks(time_idx, load_dir, realizations=realizations, seed=seed)
+    points = None
+    if hierarchical:
+        points, screened = coarse_screen(net, ran_net, alpha, epsilon, screen_alpha=screen_alpha)
+        print(f'{time_idx} (epsilon = {epsilon}): {len(points)} candidate points: {screened}')
+    subareas, n_sims, stats, pruned = {'hole': [], 'volcano': []}, {}, [], {}
+    for pi, flag, lambda_obs, neighbour, p_value, o_cnt, d_cnt in detect_subareas(
+            net, ran_net, r_time, alpha, epsilon, sequential=sequential, n_sims=n_sims, prune=prune, points=points,
+            stats=stats, pruned=pruned):
+        # keep the members as a compact coordinate array instead of a set of tuples
+        members = np.asarray(list(neighbour), dtype=np.float64).reshape(-1, 2)
+        subareas['hole' if flag else 'volcano'].append((pi, lambda_obs, members, p_value, o_cnt, d_cnt))
+    if prune:
+        print(f'{time_idx} (epsilon = {epsilon}): pruned {sum(pruned.values())} points: {pruned}')
+    store = ResultStore()
+    save_subareas(store, time_idx, epsilon, subareas)
+    # the points outside the candidate regions are pruned as well (not significant at this alpha)
+    save_point_stats(store, time_idx, epsilon, stats, r_time, alpha, sequential,
+                     'hierarchical' if hierarchical else prune)
+    # {pi => number of Monte Carlo simulations used}
+    np.save(simulations_path(time_idx, epsilon), [n_sims], allow_pickle=True)
+
+
+def detect_tile(tile_dir, null_lambdas, r_time, alpha, epsilon, sequential=False, prune=False, seed=None):
+    """
+    Detect the subareas seeded by the od locations owned by a tile (see graph.partition.partition_network),
+    the Monte Carlo tests draw from the simulated lambdas of the whole random network
+
+    Returns
+    ----------
+    records : list
+        (position in all_matches() of the whole network, flag, record of save_subareas()) of the subareas
+    n_sims : dict
+        {pi => number of Monte Carlo simulations used}
+    stats : list
+        (position in all_matches() of the whole network, statistics of detect_subareas()) of the tested points
+    pruned : dict
+        the number of locations skipped by the prune for each reason
+    """
+    net, _, index = load_tile(tile_dir)
+    points = [net.point(idx) for idx in index.owned.tolist()]
+    order = dict(zip(points, index.owned_order.tolist()))
+    records, n_sims, stats, pruned = [], {}, [], {}
+    for pi, flag, lambda_obs, neighbour, p_value, o_cnt, d_cnt in detect_subareas(
+            net, NullPool(null_lambdas, random.Random(seed)), r_time, alpha, epsilon, sequential=sequential,
+            n_sims=n_sims, prune=prune, points=points, stats=stats, pruned=pruned):
+        members = np.asarray(list(neighbour), dtype=np.float64).reshape(-1, 2)
+        records.append((order[pi], flag, (pi, lambda_obs, members, p_value, o_cnt, d_cnt)))
+    return records, n_sims, [(order[r[0]], r) for r in stats], pruned
+
+
+def identify_tiled_partition(time_idx, epsilon, r_time, alpha, tile_size, sequential=False, prune=False, seed=None,
+                             n_null=20000, worker=1, load_dir=None, tiles_dir=None):
+    """
+    Identify the subareas of a time index (or label) tile by tile, for networks too large for one process
+    (see identify_partition(), the results are saved in the result store in the same way)
+
+    The network is cut into square tiles of 'tile_size' with halos of network distance epsilon, saved as
+    array snapshots in 'tiles_dir' and processed independently by 'worker' processes, so a task only maps
+    its tile. The neighbourhoods are the same as on the whole network, but the Monte Carlo tests draw from
+    'n_null' lambdas simulated beforehand on the whole random network (see graph.partition.NullPool).
+    """
+    load_dir = arrays_dir if load_dir is None else load_dir
+    if tiles_dir is None:
+        tiles_dir = osp.join(load_dir, f'tiles_{time_idx}_{epsilon}')
+    net, ran_net = load_array_networks(time_idx, load_dir)
+    tile_dirs = partition_network(net, ran_net, epsilon, tile_size, tiles_dir)
+    del net
+    if seed is not None:
+        random.seed(f'{seed}_{time_idx}_{epsilon}')
+    tile_seeds = [f'{seed}_{time_idx}_{epsilon}_{osp.basename(d)}' if seed is not None else random.random()
+                  for d in tile_dirs]
+    if worker > 1:
+        warm_up()  # the forked workers inherit the compiled kernels
+    pool = mp.Pool(worker) if worker > 1 else None
+    try:
+        null_lambdas = simulate_null_pool(ran_net, tile_dirs, epsilon, n_null, pool=pool)
+        jobs = [(d, null_lambdas, r_time, alpha, epsilon, sequential, prune, s) for d, s in zip(tile_dirs, tile_seeds)]
+        results = pool.starmap(detect_tile, jobs) if pool is not None else [detect_tile(*job) for job in jobs]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    # stitch the tiles back in the order of the whole network
+    subareas, n_sims, pruned = {'hole': [], 'volcano': []}, {}, {}
+    for _, flag, record in sorted((r for records, _, _, _ in results for r in records), key=lambda r: r[0]):
+        subareas['hole' if flag else 'volcano'].append(record)
+    for _, sims, _, tile_pruned in results:
+        n_sims.update(sims)
+        for reason, n in tile_pruned.items():
+            pruned[reason] = pruned.get(reason, 0) + n
+    if prune:
+        print(f'{time_idx} (epsilon = {epsilon}): pruned {sum(pruned.values())} points: {pruned}')
+    stats = [r for _, r in sorted((r for _, _, tile_stats, _ in results for r in tile_stats), key=lambda r: r[0])]
+    store = ResultStore()
+    save_subareas(store, time_idx, epsilon, subareas)
+    save_point_stats(store, time_idx, epsilon, stats, r_time, alpha, sequential, prune)
+    np.save(simulations_path(time_idx, epsilon), [n_sims], allow_pickle=True)
+    remove_tiles(tile_dirs)
+    if osp.isdir(tiles_dir) and not os.listdir(tiles_dir):
+        os.rmdir(tiles_dir)
+
+
+def identify_layers(labels, epsilon, alpha, n_null=2000, seed=None, load_dir=None):
+    """
+    Identify the subareas of several time labels on the same roads at once (e.g. the 24 lixel networks
+    '{hour}_lixel{length}' of a day, see preprocess.save_lixel_network_arrays)
+
+    The networks are stacked into one (see graph.layers.stack_layers) and every location is searched once for
+    the od counts of all the labels, the lambdas of all the labels are scored together and their p-values are
+    estimated from 'n_null' lambdas simulated on the random network of each label (graph.layers.layered_test).
+    The statistics of the tested points of each label are saved as in identify_partition() (without sequential
+    tests, so any alpha can be selected later) and its subareas are selected with 'alpha' (see reselect_partition).
+    """
+    load_dir = arrays_dir if load_dir is None else load_dir
+    topology = load_arrays(osp.join(load_dir, 'topology'), Topology)
+    points, layers = stack_layers(topology, [load_arrays(osp.join(load_dir, f'network_{label}'), Points)
+                                             for label in labels])
+    net = ArrayNetWork(topology, points, include_seed=is_lixel_label(labels[0]))
+    ran_nets = [load_array_networks(label, load_dir)[1] for label in labels]
+    if seed is not None:
+        random.seed(f'{seed}_{"_".join(map(str, labels))}_{epsilon}')
+    seeds, tested, o_cnt, d_cnt, lam, p_value = layered_test(net, layers, ran_nets, epsilon, n_null=n_null)
+    store = ResultStore()
+    for h, label in enumerate(labels):
+        rows = np.nonzero(tested[:, h] & ~np.isnan(lam[:, h]))[0]
+        stats = [(net.point(seeds[i]), lam[i, h], p_value[i, h], o_cnt[i, h], d_cnt[i, h], n_null) for i in rows]
+        save_point_stats(store, label, epsilon, stats, n_null, alpha, sequential=False, prune=False)
+        subareas = reselect_partition(label, epsilon, alpha, load_dir)
+        print(f'{label} (epsilon = {epsilon}): tested {len(rows)} points, {len(subareas["hole"])} holes, '
+              f'{len(subareas["volcano"])} volcanoes')
+
+
+def approximate_partition(time_idx, epsilon, alpha, sample_rate=0.25, n_bins=16, n_null=2000, delta=0.05, seed=None,
+                          load_dir=None):
+    """
+    Identify the subareas of a time index (or label) approximately, for high volumes of od data
+    (see graph.approx.approximate_test), the results are saved in the result store as '{time_idx}_approx'
+
+    Only the significant seeds are searched exactly for their members (and their exact od counts),
+    the bounds of lambda and p-value and whether the classification is certain are saved with them.
+    """
+    net, ran_net = load_array_networks(time_idx, load_dir)
+    res = approximate_test(net, ran_net, alpha, epsilon, sample_rate=sample_rate, n_bins=n_bins, n_null=n_null,
+                           delta=delta,
+                           seed=None if seed is None else random.Random(f'{seed}_{time_idx}_{epsilon}').getrandbits(32))
+    store = ResultStore()
+    for kind, mask in (('hole', res.significant & res.flag), ('volcano', res.significant & ~res.flag)):
+        idx = np.nonzero(mask)[0]
+        members, o_cnt, d_cnt = [], [], []
+        for pi in res.seeds[idx].tolist():
+            member_idx, n_o, n_d = net.neighbor_indices(epsilon, pi)
+            members.append(net.points.pt_xy[member_idx])
+            o_cnt.append(n_o)
+            d_cnt.append(n_d)
+        store.write(f'{time_idx}_approx', epsilon, kind, members,
+                    seed_xy=net.points.pt_xy[res.seeds[idx]].astype(np.float64).reshape(-1, 2),
+                    lam=res.lam[idx].astype(np.float32), p_value=res.p_value[idx].astype(np.float32),
+                    o_cnt=np.asarray(o_cnt, dtype=np.int32), d_cnt=np.asarray(d_cnt, dtype=np.int32),
+                    lam_bounds=res.lam_bounds[idx].astype(np.float32), p_bounds=res.p_bounds[idx].astype(np.float32),
+                    certain=res.certain[idx])
+    print(f'{time_idx} (epsilon = {epsilon}): tested {len(res.seeds)} seeds, {int(res.significant.sum())} '
+          f'significant, {res.certain.mean():.1%} certain')
+    return res
+
+
+def combine_subareas(_st, _ed, epsilon, r_time, alpha, sequential=False, prune=False):
     """
     Identify the subarea of the time index from _st,to _ed
     time index:
@@ -13,44 +365,115 @@ def combine_subareas(_st, _ed):
         and the like
     """
     for i in range(_st, _ed):
-        net = np.load(f'output/network_split_time/network_{i}.npy', allow_pickle=True)[0]
-        ran_net = np.load(f'output/network_split_time/network_random_{i}.npy', allow_pickle=True)[0]
-        result_hole, result_volcano = {}, {}
-        _all, _cnt, add_end = 0, 0, False
-        all_matches = []
-        for val in net.matches.values():
-            all_matches.extend(val)
-        for pi in tqdm(all_matches, miniters=100, mininterval=30, maxinterval=300):
-            res = identify_subareas(net, ran_net, pi, r_time=r_time, alpha=alpha, epsilon=epsilon)
-            if res is None:
-                continue
-            flag, lambda_obs, neighbour = res
-            if flag:
-                result_hole[pi] = (lambda_obs, neighbour)
-            else:
-                result_volcano[pi] = (lambda_obs, neighbour)
-            _all += 1
-            add_end = True
-            if _all > 5000:
-                np.save(f'output/subareas_split_time/{i}_hole_{_cnt}.npy', [result_hole], allow_pickle=True)
-                np.save(f'output/subareas_split_time/{i}_volcano_{_cnt}.npy', [result_volcano], allow_pickle=True)
-                _cnt += 1
-                result_hole, result_volcano = {}, {}
-                _all, add_end = 0, False
-        if add_end:
-            np.save(f'output/subareas_split_time/{i}_hole_{_cnt}.npy', [result_hole], allow_pickle=True)
-            np.save(f'output/subareas_split_time/{i}_volcano_{_cnt}.npy', [result_volcano], allow_pickle=True)
+        identify_partition(i, epsilon, r_time, alpha, sequential=sequential, prune=prune)
+
+
+def combine_window_subareas(start, end, width, step, epsilon, r_time, alpha, sequential=False, prune=False,
+                            refresh=12, seed=2021):
+    """
+    Identify the subareas for sliding time windows of arbitrary width and step (possibly over several days),
+    e.g. 15-minute windows with 5-minute steps
+    results are saved in the result store with the time label `{window start}_{window end}`
+
+    The od points of the windows are updated from the events entering and leaving them (see
+    graph.window.ArrayWindow), and the random network of the Monte Carlo tests is drawn again every
+    'refresh' windows (with the od totals of the window, from a stream seeded by 'seed'), not per window.
+    """
+    import pandas as pd
+    from preprocess import get_road_topology, read_od_events
+    from graph.window import ArrayWindow
+    from graph.realizations import random_realization, realization_points
+    store = ResultStore()
+    topology = build_topology(get_road_topology('output/wuchangroad_network.csv'))
+    window = ArrayWindow(topology, *read_od_events('output/wuchangroad_od_cleaned.csv'))
+    seed_seqs = np.random.SeedSequence(seed)
+    ran_net, n_windows = None, 0
+    for st, ed, points in window.windows(start, end, width, step):
+        label = '{}_{}'.format(pd.Timestamp(st).strftime('%Y%m%d%H%M'), pd.Timestamp(ed).strftime('%Y%m%d%H%M'))
+        if window.o_count == 0 or window.d_count == 0:
+            continue
+        net = ArrayNetWork(topology, points, totals=(window.o_count, window.d_count))
+        if ran_net is None or n_windows % refresh == 0:
+            real = random_realization(np.unique(points.pt_edge).astype(np.int64), len(topology.edge_len),
+                                      window.o_count, window.d_count, seed_seqs.spawn(1)[0])
+            ran_net = ArrayNetWork(topology, realization_points(topology, Realizations(*(a[None] for a in real)), 0))
+        n_windows += 1
+        subareas, pruned = {'hole': [], 'volcano': []}, {}
+        for pi, flag, lambda_obs, neighbour, p_value, o_cnt, d_cnt in detect_subareas(
+                net, ran_net, r_time, alpha, epsilon, sequential=sequential, prune=prune, pruned=pruned):
+            subareas['hole' if flag else 'volcano'].append((pi, lambda_obs, neighbour, p_value, o_cnt, d_cnt))
+        if prune:
+            print(f'{label} (epsilon = {epsilon}): pruned {sum(pruned.values())} points: {pruned}')
+        save_subareas(store, label, epsilon, subareas)
 
 
 if __name__ == '__main__':
     """
     Identification of subareas of urban black holes and volcanoes
     based on a 1 hour division (total 24hours)
+        python identify_subareas.py hours --workers 8
+    other modes:
+        tiled         networks too large for one process: tiles with halos of epsilon processed one by one
+        lixel         the od records aggregated into lixels, the cost scales with the length of the network
+        layers        the lixels of the 24 hours searched together (one search per lixel for all the hours)
+        reselect      another significance level from the statistics of the tested points, without simulating
+                      again (exact for the runs without sequential tests, see select_subareas)
+        approx        months of od data: seeds sampled by road, counts estimated from the edges
+        hierarchical  coarse to fine: only the candidate regions of the contracted network are tested
+        windows       sliding windows (e.g. 15-minute windows with 5-minute steps) instead of the 1 hour division
     """
-    worker = 8  # Number of processes (recommended not to be larger than the number of cpu cores)
-    r_time = 99  # the number of repetitions of Monte Carlo simulation
-    alpha = 0.05  # significance level
-    epsilon = 1200  # the neighbourhood cutoff radius
-    split = split_worker(24, worker)
-    with mp.Pool() as pool:
-        pool.starmap(combine_subareas, split)
+    import argparse
+    parser = argparse.ArgumentParser(description='identification of urban black holes and volcanoes')
+    parser.add_argument('mode', nargs='?', default='hours',
+                        choices=('hours', 'tiled', 'lixel', 'layers', 'reselect', 'approx', 'hierarchical', 'windows'))
+    parser.add_argument('--hour', type=int, default=8, help='the hour of the single hour modes')
+    parser.add_argument('--epsilon', type=float, default=1200, help='the neighbourhood cutoff radius')
+    parser.add_argument('--r-time', type=int, default=99, help='the number of repetitions of Monte Carlo simulation')
+    parser.add_argument('--alpha', type=float, default=0.05, help='significance level')
+    parser.add_argument('--no-sequential', action='store_true', help='run all the Monte Carlo simulations')
+    parser.add_argument('--no-prune', action='store_true', help='test all the od locations')
+    parser.add_argument('--probabilistic-prune', action='store_true',
+                        help='skip the od locations which are probably not significant as well (see graph.prune)')
+    parser.add_argument('--workers', type=int, default=8, help='not to be larger than the number of cpu cores')
+    parser.add_argument('--tile-size', type=float, default=5000, help='tiled: the side of the square tiles')
+    parser.add_argument('--lixel-length', type=int, default=50, help='lixel, layers: the length of the lixels')
+    parser.add_argument('--sample-rate', type=float, default=0.25, help='approx: the rate of the sampled seeds')
+    parser.add_argument('--start', default='2014-05-07 00:00:00', help='windows: the start of the first window')
+    parser.add_argument('--end', default='2014-05-08 00:00:00', help='windows: the end of the last window')
+    parser.add_argument('--width', type=int, default=15, help='windows: the width of the windows (minutes)')
+    parser.add_argument('--step', type=int, default=5, help='windows: the step between the windows (minutes)')
+    args = parser.parse_args()
+    epsilon = int(args.epsilon) if args.epsilon.is_integer() else args.epsilon
+    sequential = not args.no_sequential  # stop the Monte Carlo simulation of a point once its significance is settled
+    # skip the points which cannot become subareas before their Monte Carlo simulation
+    prune = False if args.no_prune else 'probabilistic' if args.probabilistic_prune else True
+    if not has_arrays(osp.join(arrays_dir, 'network_0'), Points):
+        from preprocess import save_network_arrays
+        save_network_arrays('output/network_split_time', arrays_dir)
+    if args.mode == 'hours':
+        warm_up()  # the forked workers inherit the compiled kernels
+        with mp.Pool(args.workers) as pool:
+            pool.starmap(combine_subareas, [(st, ed, epsilon, args.r_time, args.alpha, sequential, prune)
+                                            for st, ed in split_worker(24, args.workers)])
+    elif args.mode == 'tiled':
+        identify_tiled_partition(args.hour, epsilon, args.r_time, args.alpha, tile_size=args.tile_size,
+                                 sequential=sequential, prune=prune, worker=args.workers)
+    elif args.mode == 'lixel':
+        from preprocess import save_lixel_network_arrays
+        identify_partition(save_lixel_network_arrays(args.hour, args.lixel_length, arrays_dir=arrays_dir), epsilon,
+                           args.r_time, args.alpha, sequential=sequential, prune=prune)
+    elif args.mode == 'layers':
+        from preprocess import save_lixel_network_arrays
+        identify_layers([save_lixel_network_arrays(_h, args.lixel_length, arrays_dir=arrays_dir) for _h in range(24)],
+                        epsilon, args.alpha)
+    elif args.mode == 'reselect':
+        reselect_partition(args.hour, epsilon, args.alpha)
+    elif args.mode == 'approx':
+        approximate_partition(args.hour, epsilon, args.alpha, sample_rate=args.sample_rate, seed=1)
+    elif args.mode == 'hierarchical':
+        identify_partition(args.hour, epsilon, args.r_time, args.alpha, sequential=sequential, prune=prune,
+                           hierarchical=True)
+    elif args.mode == 'windows':
+        combine_window_subareas(args.start, args.end, np.timedelta64(args.width, 'm'), np.timedelta64(args.step, 'm'),
+                                epsilon, args.r_time, args.alpha, sequential=sequential, prune=prune)
+    print(ResultStore().catalog())
@@ -0,0 +1,326 @@
+import os
+import os.path as osp
+import json
+import hashlib
+import argparse
+import multiprocessing as mp
+from functools import lru_cache
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+import numpy as np
+from graph.kernel import build_topology, save_arrays, warm_up
+from utils.store import ResultStore
+from utils.common import parse_hours, simulations_path
+
+manifest_path = 'output/pipeline_manifest.json'
+
+
+class Stage(NamedTuple):
+    """
+    A stage of the pipeline, run once per partition (key) and skipped while its partition is up to date
+    """
+    name: str
+    params: Tuple[str, ...]  # parameters of the config the outputs depend on
+    keys: Callable[[dict], list]  # config => partition keys
+    upstream: Callable[[object, dict], List[Tuple[str, object]]]  # (key, config) => (stage, key) of its inputs
+    sources: Optional[Callable[[object, dict], str]]  # (key, config) => digest of the external inputs
+    outputs: Callable[[object, dict], List[str]]  # (key, config) => files written by run
+    run: Callable[[object, dict], None]  # (key, config) => None
+    parallel: bool = False  # partitions are run in a pool of workers
+
+
+def partition_name(key) -> str:
+    return '_'.join(map(str, key)) if isinstance(key, tuple) else str(key)
+
+
+def hash_files(paths) -> str:
+    sha = hashlib.sha1()
+    for path in sorted(paths):
+        sha.update(path.encode())
+        with open(path, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(1 << 20), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_values(*values) -> str:
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def dir_files(path, prefixes=('',)) -> List[str]:
+    """
+    files in the directory 'path' whose names start with one of the prefixes
+    """
+    if not osp.isdir(path):
+        return []
+    return sorted(osp.join(path, f) for f in os.listdir(path) if f.startswith(tuple(prefixes)))
+
+
+@lru_cache(maxsize=1)
+def od_events(od_path):
+    from preprocess import read_od_events
+    return read_od_events(od_path)
+
+
+def label_digest(label, cfg) -> str:
+    """
+    digest of the od events of a time label (the rows of other hours or days do not change it)
+    """
+    from preprocess import label_events
+    times, road_ids, xs, ys, flags = od_events(cfg['od_path'])
+    mask = label_events(label, times)
+    sha = hashlib.sha1(str(label).encode())
+    for arr, dtype in ((times, 'datetime64[s]'), (road_ids, np.int64), (xs, np.float64), (ys, np.float64),
+                       (flags, np.bool_)):
+        sha.update(np.ascontiguousarray(arr[mask].astype(dtype)).tobytes())
+    return sha.hexdigest()
+
+
+def run_topology(key, cfg):
+    from preprocess import get_road_topology
+    save_arrays(osp.join(cfg['arrays_dir'], 'topology'), build_topology(get_road_topology(cfg['road_path'])))
+
+
+def run_networks(label, cfg):
+    from preprocess import save_label_network_arrays
+    save_label_network_arrays(label, od_events(cfg['od_path']), cfg['road_path'], cfg['arrays_dir'], seed=cfg['seed'])
+
+
+def run_subareas(key, cfg):
+    from identify_subareas import identify_partition
+    label, epsilon = key
+    identify_partition(label, epsilon, cfg['r_time'], cfg['alpha'], sequential=cfg['sequential'],
+                       prune=cfg['prune'], seed=cfg['seed'], load_dir=cfg['arrays_dir'])
+
+
+def run_merged(key, cfg):
+    from combine_subareas import multi_scale_hole_volcano, save_identified_result
+    label, epsilon = key
+    hole, volcano = multi_scale_hole_volcano(label, epsilon, arrays_dir=cfg['arrays_dir'], worker=cfg['workers'])
+    save_identified_result(label, hole, volcano, epsilon=epsilon)
+
+
+def run_figures(label, cfg):
+    from combine_subareas import load_identified_result, plot_determine_hole_volcano
+    plot_determine_hole_volcano(label, *load_identified_result(label, cfg['epsilon'][0]))
+
+
+def store_files(key, kinds) -> List[str]:
+    return dir_files(ResultStore().partition_dir(*key), [f'{kind}.' for kind in kinds])
+
+
+def label_eps(cfg) -> list:
+    return [(label, eps) for label in cfg['labels'] for eps in cfg['epsilon']]
+
+
+stages = (
+    Stage('topology', (), keys=lambda cfg: ['all'], upstream=lambda key, cfg: [],
+          sources=lambda key, cfg: hash_files([cfg['road_path']]),
+          outputs=lambda key, cfg: dir_files(osp.join(cfg['arrays_dir'], 'topology')), run=run_topology),
+    Stage('networks', ('seed',), keys=lambda cfg: cfg['labels'], upstream=lambda key, cfg: [('topology', 'all')],
+          sources=label_digest, run=run_networks,
+          outputs=lambda key, cfg: dir_files(osp.join(cfg['arrays_dir'], f'network_{key}')) +
+          dir_files(osp.join(cfg['arrays_dir'], f'network_random_{key}'))),
+    Stage('subareas', ('r_time', 'alpha', 'sequential', 'prune', 'seed'), keys=label_eps,
+          upstream=lambda key, cfg: [('networks', key[0])], sources=None,
+          outputs=lambda key, cfg: store_files(key, ('hole', 'volcano', 'stats')) + [simulations_path(*key)],
+          run=run_subareas,
+          parallel=True),
+    Stage('merged', (), keys=label_eps, upstream=lambda key, cfg: [('subareas', key), ('networks', key[0])],
+          sources=None, outputs=lambda key, cfg: store_files(key, ('hole_merged', 'volcano_merged')),
+          run=run_merged),
+    # the figures are drawn for the hours of the day with the first epsilon
+    Stage('figures', (), keys=lambda cfg: [lb for lb in cfg['labels'] if isinstance(lb, int)] if cfg['plot'] else [],
+          upstream=lambda key, cfg: [('merged', (key, cfg['epsilon'][0]))], sources=None,
+          outputs=lambda key, cfg: [f'output/results/{key}.png'], run=run_figures),
+)
+stage_map = {stage.name: stage for stage in stages}
+
+
+def run_job(job):
+    stage_name, key, cfg = job
+    stage_map[stage_name].run(key, cfg)
+    return stage_name, key
+
+
+def active_labels(labels, cfg) -> list:
+    """
+    the time labels with both origins and destinations (the others have no subareas)
+    """
+    from preprocess import label_events
+    times, _, _, _, flags = od_events(cfg['od_path'])
+    res = []
+    for label in labels:
+        label_flags = flags[label_events(label, times)]
+        if label_flags.any() and not label_flags.all():
+            res.append(label)
+    return res
+
+
+class Manifest:
+    """
+    Record of the partitions computed by the pipeline, in a json file
+        {stage: {partition: {'inputs': digest, 'outputs': [files], 'digest': digest of the outputs}}}
+    a partition is up to date while the digest of its inputs (external inputs, parameters and the output
+    digests of its upstream partitions) is unchanged and its output files are unmodified
+    """
+
+    def __init__(self, path=manifest_path) -> None:
+        self.path = path
+        self.records = {}
+        if osp.exists(path):
+            with open(path) as fd:
+                self.records = json.load(fd)
+
+    def get(self, stage, key) -> Optional[dict]:
+        return self.records.get(stage, {}).get(partition_name(key))
+
+    def fresh(self, stage, key, inputs) -> Tuple[bool, str]:
+        record = self.get(stage, key)
+        if record is None:
+            return False, 'new'
+        if record['inputs'] != inputs:
+            return False, 'inputs changed'
+        if not record['outputs'] or not all(osp.exists(p) for p in record['outputs']) or \
+                hash_files(record['outputs']) != record['digest']:
+            return False, 'outputs missing or modified'
+        return True, 'up to date'
+
+    def update(self, stage, key, inputs, outputs) -> None:
+        self.records.setdefault(stage, {})[partition_name(key)] = {
+            'inputs': inputs, 'outputs': outputs, 'digest': hash_files(outputs)}
+        os.makedirs(osp.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.tmp', 'w') as fd:
+            json.dump(self.records, fd, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class Pipeline:
+    """
+    Incremental runner of the stages
+        topology   road network csv                     => array snapshot of the topology
+        networks   od events of each time label          => array snapshots of the observed and random networks
+        subareas   networks, (label, epsilon)            => subareas and statistics in the result store,
+                                                            numbers of simulations (see utils.common.simulations_path)
+        merged     subareas and networks                 => combined holes and volcanoes in the result store
+        figures    combined results (hours of the day)   => output/results/{hour}.png
+    Only the stale partitions are recomputed, e.g. the hours of a new day or a new epsilon,
+    everything else is reused from the manifest (see Manifest).
+    """
+
+    def __init__(self, cfg: dict, manifest: Manifest) -> None:
+        self.cfg = cfg
+        self.manifest = manifest
+
+    def inputs(self, stage: Stage, key, stale_upstream=()) -> Optional[str]:
+        """
+        digest of the inputs of a partition (None if an upstream partition is stale or not computed yet)
+        """
+        upstream = []
+        for name, up_key in stage.upstream(key, self.cfg):
+            record = self.manifest.get(name, up_key)
+            if record is None or (name, partition_name(up_key)) in stale_upstream:
+                return None
+            upstream.append(record['digest'])
+        params = {p: self.cfg[p] for p in stage.params}
+        sources = stage.sources(key, self.cfg) if stage.sources is not None else None
+        return hash_values(stage.name, partition_name(key), params, sources, upstream)
+
+    def plan(self, stage: Stage, force=False, stale_upstream=()) -> Dict[object, Tuple[Optional[str], str]]:
+        """
+        {stale partition => (input digest, reason)}
+        """
+        stale = {}
+        for key in stage.keys(self.cfg):
+            inputs = self.inputs(stage, key, stale_upstream)
+            if inputs is None:
+                stale[key] = (None, 'upstream stale')
+                continue
+            fresh, reason = self.manifest.fresh(stage.name, key, inputs)
+            if force or not fresh:
+                stale[key] = (inputs, 'forced' if fresh else reason)
+        return stale
+
+    def run(self, force=(), workers=1, dry_run=False) -> Dict[str, Tuple[int, int]]:
+        """
+        Run the stale partitions of all the stages in order
+
+        Returns
+        ----------
+        summary : dict
+            {stage => (number of recomputed partitions, number of reused partitions)}
+        """
+        summary, not_run = {}, set()  # the stale partitions not recomputed in a dry run
+        for stage in stages:
+            keys = stage.keys(self.cfg)
+            stale = self.plan(stage, stage.name in force, not_run)
+            summary[stage.name] = (len(stale), len(keys) - len(stale))
+            print(f'[{stage.name}] {len(stale)} stale, {len(keys) - len(stale)} reused')
+            for key, (_, reason) in stale.items():
+                print(f'\t{partition_name(key)}: {reason}')
+            if dry_run:
+                not_run.update((stage.name, partition_name(key)) for key in stale)
+            if dry_run or not stale:
+                continue
+            jobs = [(stage.name, key, self.cfg) for key in stale]
+            if stage.parallel and workers > 1 and len(jobs) > 1:
+                warm_up()  # the forked workers inherit the compiled kernels
+                with mp.Pool(min(workers, len(jobs))) as pool:
+                    for _, key in pool.imap_unordered(run_job, jobs):
+                        self.commit(stage, key, stale[key][0])
+            else:
+                for job in jobs:
+                    self.commit(stage, run_job(job)[1], stale[job[1]][0])
+        if not dry_run:
+            ResultStore().catalog()
+        return summary
+
+    def commit(self, stage: Stage, key, inputs) -> None:
+        # recorded once the partition is done, so an interrupted run resumes from the stale ones
+        outputs = stage.outputs(key, self.cfg)
+        assert outputs, f'stage {stage.name} wrote nothing for {partition_name(key)}'
+        self.manifest.update(stage.name, key, inputs, outputs)
+
+
+if __name__ == '__main__':
+    """
+    Single entry point of preprocess => identify_subareas => combine_subareas (=> figures)
+        python pipeline.py --epsilon 1200                       the 24 hours of the day
+        python pipeline.py --epsilon 1200,1500                  only the new epsilon is computed
+        python pipeline.py --dates 2014-05-07,2014-05-08 --hours 7-9
+        python pipeline.py --dry-run                            print the stale partitions only
+    """
+    parser = argparse.ArgumentParser(description='incremental pipeline of the urban black holes and volcanoes')
+    parser.add_argument('--road-path', default='output/wuchangroad_network.csv')
+    parser.add_argument('--od-path', default='output/wuchangroad_od_cleaned.csv')
+    parser.add_argument('--arrays-dir', default='output/network_arrays')
+    parser.add_argument('--dates', default='', help='comma separated dates, default = hours of all the days')
+    parser.add_argument('--hours', default='0-23')
+    parser.add_argument('--epsilon', default='1200', help='comma separated neighbourhood cutoff radii')
+    parser.add_argument('--r-time', type=int, default=99)
+    parser.add_argument('--alpha', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=2021)
+    parser.add_argument('--no-sequential', action='store_true', help='run all the Monte Carlo simulations')
+    parser.add_argument('--no-prune', action='store_true', help='test all the od locations')
+    parser.add_argument('--probabilistic-prune', action='store_true',
+                        help='skip the od locations which are probably not significant as well (see graph.prune)')
+    parser.add_argument('--plot', action='store_true', help='draw the figures of the hours of the day')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--force', default='', help='comma separated stages to recompute')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    _hours = parse_hours(args.hours)
+    if args.dates:
+        import pandas as pd
+        _labels = ['{}_{}'.format(pd.Timestamp(d).strftime('%Y%m%d'), h) for d in args.dates.split(',') for h in _hours]
+    else:
+        _labels = _hours
+    _cfg = {'road_path': args.road_path, 'od_path': args.od_path, 'arrays_dir': args.arrays_dir,
+            'epsilon': [float(e) if '.' in e else int(e) for e in args.epsilon.split(',')],
+            'r_time': args.r_time, 'alpha': args.alpha, 'seed': args.seed, 'sequential': not args.no_sequential,
+            'prune': False if args.no_prune else 'probabilistic' if args.probabilistic_prune else True,
+            'plot': args.plot, 'workers': args.workers}
+    _cfg['labels'] = active_labels(_labels, _cfg)
+    for _d in ('output/subareas_split_time', 'output/hole_volcano', 'output/results'):
+        os.makedirs(_d, exist_ok=True)
+    Pipeline(_cfg, Manifest()).run(force=[s for s in args.force.split(',') if s], workers=args.workers,
+                                   dry_run=args.dry_run)
@@ -1,15 +1,21 @@
 import os
 import os.path as osp
+import zlib
 import numpy as np
 import pandas as pd
 import csv
-import shapefile
 from tqdm import tqdm
 from graph.roadnet import RoadNetWork, generate_random_network
+from graph.kernel import Topology, Points, build_topology, build_points, save_arrays, load_arrays, has_arrays
+from graph.window import SlidingWindow
+from graph.lixel import lixel_points, lixel_points_from_events, random_lixel_points
+from graph.realizations import generate_realizations
+from graph.matching import match_points
 from graph.linear import euclidean_distance
 
 
 def save_net_info_form_shapefile(file_path, save_path):
+    import shapefile
     os.makedirs(osp.dirname(save_path), exist_ok=True)
     name = ['roadID', 'XCoord_0', 'YCoord_0', 'XCoord_1', 'YCoord_1']
     with open(save_path, 'w+', newline='') as fd:
@@ -80,6 +86,29 @@ def clean_od_data(origin_path, save_path):
     return
 
 
+def match_od_data(raw_path, save_path, road_path='output/wuchangroad_network.csv', max_dist=200.0):
+    """
+    Map-match raw gps od data without road ids: every point is snapped onto its nearest road segment
+    (see graph.matching.match_points), its road id is saved as 'ROADID' and its coordinates are replaced by
+    its projection on the road (the raw ones are kept as 'RAW_XCoord' and 'RAW_YCoord', with 'MATCH_DIST')
+    the points farther than 'max_dist' from any road are dropped (their trips are then excluded by clean_od_data)
+    """
+    od = pd.read_csv(raw_path, index_col=None)
+    topology = build_topology(get_road_topology(road_path))
+    matches = match_points(topology, od[['XCoord', 'YCoord']].values, max_dist=max_dist)
+    od['RAW_XCoord'], od['RAW_YCoord'] = od['XCoord'], od['YCoord']
+    od['XCoord'], od['YCoord'] = matches.xy[:, 0], matches.xy[:, 1]
+    od['ROADID'] = topology.road_ids[np.maximum(matches.edge, 0)]
+    od['MATCH_DIST'] = matches.dist
+    matched = matches.edge >= 0
+    od[matched].to_csv(save_path, index=False)
+    # verify
+    print('lines of raw od data: ', len(od))
+    print(f'unmatched points (farther than {max_dist} from any road): ', int((~matched).sum()))
+    print('median distance to the road: ', float(np.median(matches.dist[matched])) if matched.any() else None)
+    return
+
+
 def get_road_net_from_time(road_path, od_path):
     road_net = [RoadNetWork() for _ in range(24)]
     road_data = pd.read_csv(road_path, index_col=None)
@@ -97,24 +126,170 @@ def get_road_net_from_time(road_path, od_path):
     return road_net
 
 
-def save_network_from_time(save_dir, road_path, od_cleaned_path):
+def get_road_topology(road_path):
+    """
+    Build a road network holding the topology only (without any od point)
+    """
+    net = RoadNetWork()
+    for _, data in pd.read_csv(road_path, index_col=None).iterrows():
+        net.add_edge(data['roadID'], data['XCoord_0'], data['YCoord_0'], data['XCoord_1'], data['YCoord_1'])
+    return net
+
+
+def read_od_events(od_path):
+    """
+    Read the cleaned od data as arrays of (time, road id, x, y, od flag)
+    """
+    od_data = pd.read_csv(od_path, index_col=None)
+    times = pd.to_datetime(od_data['LOC_TIME']).values
+    flags = (od_data.index.values & 1) == 0  # origin and destination records alternate
+    return times, od_data['ROADID'].values, od_data['XCoord'].values, od_data['YCoord'].values, flags
+
+
+def save_network_from_time(save_dir, road_path, od_cleaned_path, arrays_dir='output/network_arrays'):
     road_net_24 = get_road_net_from_time(road_path, od_cleaned_path)
+    topology = build_topology(road_net_24[0])
+    save_arrays(osp.join(arrays_dir, 'topology'), topology)
     for i, net in tqdm(enumerate(road_net_24), colour='green',
                        desc='save observed and random network(object:RoadNetwork) at different time periods'):
         np.save(osp.join(save_dir, f'network_{i}.npy'), [net], allow_pickle=True)
         ran_net_i = generate_random_network(net)
         np.save(osp.join(save_dir, f'network_random_{i}.npy'), [ran_net_i], allow_pickle=True)
+        save_arrays(osp.join(arrays_dir, f'network_{i}'), build_points(net, topology))
+        save_arrays(osp.join(arrays_dir, f'network_random_{i}'), build_points(ran_net_i, topology))
+    return
+
+
+def save_network_arrays(network_dir='output/network_split_time', arrays_dir='output/network_arrays'):
+    """
+    Convert the saved networks to array snapshots: the topology (the same in all hours) is saved once
+    and the od points of each observed and random network are saved as arrays on it
+    (see graph.kernel.load_arrays, workers map these files instead of unpickling the networks)
+    """
+    topology = None
+    for i in tqdm(range(24), desc='save array snapshots of the networks'):
+        net = np.load(osp.join(network_dir, f'network_{i}.npy'), allow_pickle=True)[0]
+        ran_net = np.load(osp.join(network_dir, f'network_random_{i}.npy'), allow_pickle=True)[0]
+        if topology is None:
+            topology = build_topology(net)
+            save_arrays(osp.join(arrays_dir, 'topology'), topology)
+        save_arrays(osp.join(arrays_dir, f'network_{i}'), build_points(net, topology))
+        save_arrays(osp.join(arrays_dir, f'network_random_{i}'), build_points(ran_net, topology))
     return
 
 
+def save_day_network_arrays(date, road_path='output/wuchangroad_network.csv',
+                            od_path='output/wuchangroad_od_cleaned.csv', arrays_dir='output/network_arrays'):
+    """
+    Save the array snapshots of the observed and random networks of each hour of one day,
+    as 'network_{%Y%m%d}_{hour}' and 'network_random_{%Y%m%d}_{hour}' (the existing ones are kept)
+
+    Returns
+    ----------
+    labels : list
+        the time labels '{%Y%m%d}_{hour}' of the hours with both origins and destinations
+    """
+    day = pd.Timestamp(date).normalize()
+    window = SlidingWindow(get_road_topology(road_path), *read_od_events(od_path))
+    topology = build_topology(window.net)
+    if not has_arrays(osp.join(arrays_dir, 'topology'), Topology):
+        save_arrays(osp.join(arrays_dir, 'topology'), topology)
+    labels = []
+    start, end = day.to_datetime64(), (day + pd.Timedelta(days=1)).to_datetime64()
+    for st, _, net in window.windows(start, end, np.timedelta64(1, 'h'), np.timedelta64(1, 'h')):
+        label = '{}_{}'.format(day.strftime('%Y%m%d'), pd.Timestamp(st).hour)
+        if net.o_count == 0 or net.d_count == 0:
+            continue
+        labels.append(label)
+        if has_arrays(osp.join(arrays_dir, f'network_random_{label}'), Points):
+            continue
+        ran_net = generate_random_network(net)
+        save_arrays(osp.join(arrays_dir, f'network_{label}'), build_points(net, topology))
+        save_arrays(osp.join(arrays_dir, f'network_random_{label}'), build_points(ran_net, topology))
+    return labels
+
+
+def label_events(label, times) -> np.ndarray:
+    """
+    Mask of the od events of a time label: an hour of the day (int, the events of all the days
+    as in get_road_net_from_time()) or '{%Y%m%d}_{hour}' (the events of one hour of one day)
+    """
+    times = pd.DatetimeIndex(times)
+    if isinstance(label, (int, np.integer)):
+        return np.asarray(times.hour == label)
+    day, hour = str(label).split('_')
+    start = pd.Timestamp(day) + pd.Timedelta(hours=int(hour))
+    return np.asarray((times >= start) & (times < start + pd.Timedelta(hours=1)))
+
+
+def save_label_network_arrays(label, events, road_path='output/wuchangroad_network.csv',
+                              arrays_dir='output/network_arrays', seed=2021):
+    """
+    Build the observed and random networks of a time label (see label_events()) from the od events
+    (see read_od_events()) and save their array snapshots as 'network_{label}' and 'network_random_{label}'
+    """
+    times, road_ids, xs, ys, flags = events
+    mask = label_events(label, times)
+    net = get_road_topology(road_path)
+    for road_id, x, y, o_d in zip(road_ids[mask], xs[mask], ys[mask], flags[mask]):
+        net.add_matches(road_id, x, y, o_d)
+    topology = build_topology(net)
+    save_arrays(osp.join(arrays_dir, f'network_{label}'), build_points(net, topology))
+    save_arrays(osp.join(arrays_dir, f'network_random_{label}'),
+                build_points(generate_random_network(net, seed=seed), topology))
+    return
+
+
+def save_lixel_network_arrays(label, lixel_length, events=None, arrays_dir='output/network_arrays', seed=2021):
+    """
+    Save the array snapshots of the observed and random networks of a time label with the od points
+    aggregated into lixels of 'lixel_length' (see graph.lixel), as the time label '{label}_lixel{lixel_length}'
+    the lixels are aggregated from the saved network of the label, or from the od events if given
+    (see read_od_events(), e.g. all the events of a month, whose points are never built as a network)
+
+    Returns
+    ----------
+    label : str
+        the time label of the lixel networks, e.g. for identify_subareas.identify_partition()
+    """
+    topology = load_arrays(osp.join(arrays_dir, 'topology'), Topology)
+    if events is None:
+        lixels = lixel_points(topology, load_arrays(osp.join(arrays_dir, f'network_{label}'), Points), lixel_length)
+    else:
+        lixels = lixel_points_from_events(topology, *events[1:], lixel_length)
+    lixel_label = f'{label}_lixel{lixel_length}'
+    save_arrays(osp.join(arrays_dir, f'network_{lixel_label}'), lixels)
+    save_arrays(osp.join(arrays_dir, f'network_random_{lixel_label}'),
+                random_lixel_points(topology, lixels, lixel_length, seed=seed))
+    return lixel_label
+
+
+def save_realizations(label, n_real, arrays_dir='output/network_arrays', seed=2021, worker=1):
+    """
+    Save 'n_real' independent random realizations of the observed network of a time label as 'realizations_{label}'
+    (see graph.realizations), the Monte Carlo tests draw from all of them instead of the single random network
+    the streams of the realizations are spawned from 'seed' and the label, so every label has its own
+    """
+    topology = load_arrays(osp.join(arrays_dir, 'topology'), Topology)
+    points = load_arrays(osp.join(arrays_dir, f'network_{label}'), Points)
+    realizations = generate_realizations(topology, points, n_real, seed=[seed, zlib.crc32(str(label).encode())],
+                                         worker=worker)
+    save_arrays(osp.join(arrays_dir, f'realizations_{label}'), realizations)
+    return realizations
+
+
 if __name__ == '__main__':
     # load and save network data from shape file
     save_net_info_form_shapefile('data/wuchangroad_1', 'output/wuchangroad_network.csv')
+    # raw gps od data without road ids: match them to the roads first
+    # match_od_data('data/WUCHANG0_raw.csv', 'data/WUCHANG0.csv')
     # clean and verify od data
     clean_od_data('data/WUCHANG0.csv', 'output/wuchangroad_od_cleaned.csv')
     # save all network data (in form of npy file) defined in graph.roadnet.RoadNetwork
     save_network_from_time('output/network_split_time', 'output/wuchangroad_network.csv',
                            'output/wuchangroad_od_cleaned.csv')
+    # independent random realizations of an hour for the Monte Carlo tests (see identify_subareas.identify_partition)
+    # save_realizations(8, 99, worker=8)
     # calculate
     calc_average_road_length()
     # calc_average_velocity()
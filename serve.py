@@ -0,0 +1,126 @@
+import os.path as osp
+import json
+import threading
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from graph.kernel import ArrayNetWork, Topology, Points, load_arrays
+from utils.store import ResultStore
+from utils.query import HotspotIndex
+
+arrays_dir = 'output/network_arrays'  # array snapshots of the networks (see preprocess.save_network_arrays)
+
+
+routes = ('/neighbors', '/lambda', '/hotspots', '/stats')
+
+
+class QueryService:
+    """
+    Warm in-process state of the query service: the hourly networks (memory-mapped array snapshots),
+    the hotspot index over the result store and an LRU cache of the neighbourhood queries
+    """
+
+    def __init__(self, cache_size=4096) -> None:
+        topology = load_arrays(osp.join(arrays_dir, 'topology'), Topology)
+        self.nets = {}
+        for i in range(24):
+            if osp.exists(osp.join(arrays_dir, f'network_{i}')):
+                self.nets[i] = ArrayNetWork(topology, load_arrays(osp.join(arrays_dir, f'network_{i}'), Points))
+        self.lock = threading.Lock()  # guards the (lazily built) point index of the networks
+        self.index = HotspotIndex(ResultStore(), arrays_dir=arrays_dir)
+        self.neighbors = lru_cache(maxsize=cache_size)(self.__neighbors)
+        for net in self.nets.values():  # compile (or load) the kernel before the first request
+            net.neighbor_indices(1.0, 0)
+            break
+
+    def __point_index(self, net: ArrayNetWork, x, y) -> int:
+        with self.lock:
+            try:
+                return net.index_of((x, y))
+            except (KeyError, AssertionError):  # the assertion of index_of is gone under python -O
+                raise ValueError(f'({x}, {y}) is not an od point of the network') from None
+
+    def __neighbors(self, hour, epsilon, x, y) -> dict:
+        """
+        neighbourhood of an od point, cached by (hour, epsilon, point)
+        """
+        if hour not in self.nets:
+            raise ValueError(f'no network of hour {hour}')
+        net = self.nets[hour]
+        members, o_cnt, d_cnt = net.neighbor_indices(epsilon, self.__point_index(net, x, y))
+        lam = net.lambda_from_counts(o_cnt, d_cnt)
+        return {'hour': hour, 'epsilon': epsilon, 'point': [x, y], 'o_cnt': o_cnt, 'd_cnt': d_cnt,
+                'o_all': net.o_count, 'd_all': net.d_count, 'lambda': None if lam is None else float(lam),
+                'members': net.points.pt_xy[members].tolist()}
+
+    def handle(self, path, query) -> dict:
+        """
+        Dispatch a request
+
+        /neighbors?hour=&epsilon=&x=&y=       the network constrained neighbourhood of an od point
+        /lambda?hour=&epsilon=&x=&y=          lambda and od counts of the neighbourhood (without members)
+        /hotspots?bbox=xmin,ymin,xmax,ymax    hotspots touching the bounding box
+        /hotspots?x=&y=&r=                    hotspots within distance r of a point
+        /hotspots?road=                       hotspots touching a road
+            (optional filters of /hotspots: hour, epsilon, kind=hole|volcano)
+        """
+        arg = {k: v[0] for k, v in query.items()}
+        if path in ('/neighbors', '/lambda'):
+            res = self.neighbors(int(arg['hour']), float(arg['epsilon']), float(arg['x']), float(arg['y']))
+            if path == '/lambda':
+                res = {k: v for k, v in res.items() if k != 'members'}
+            return res
+        if path == '/hotspots':
+            filters = {'time_idx': arg.get('hour'), 'kind': arg.get('kind'),
+                       'epsilon': float(arg['epsilon']) if 'epsilon' in arg else None}
+            if 'bbox' in arg:
+                hotspots = self.index.bbox(*map(float, arg['bbox'].split(',')), **filters)
+            elif 'road' in arg:
+                hotspots = self.index.road(int(arg['road']), **filters)
+            else:
+                hotspots = self.index.radius(float(arg['x']), float(arg['y']), float(arg['r']), **filters)
+            return {'hotspots': [{'time': t, 'epsilon': e, 'kind': k, 'index': int(i), 'ratio': r}
+                                 for t, e, k, i, r in hotspots]}
+        if path == '/stats':
+            return {'hours': sorted(self.nets.keys()), 'hotspots': len(self.index.keys),
+                    'cache': self.neighbors.cache_info()._asdict()}
+        raise ValueError(f'unknown path {path}')
+
+
+def make_handler(service: QueryService):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            try:
+                if url.path not in routes:
+                    body, code = {'error': f'unknown path {url.path}'}, 404
+                else:
+                    body, code = service.handle(url.path, parse_qs(url.query)), 200
+            except KeyError as e:
+                body, code = {'error': f'missing parameter {e}'}, 400
+            except (ValueError, AssertionError) as e:
+                body, code = {'error': str(e)}, 400
+            except Exception as e:  # the client always gets a response
+                body, code = {'error': f'internal error: {e!r}'}, 500
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+    """
+    Long-running local query service keeping the hourly networks and results in memory
+    e.g. curl 'http://127.0.0.1:8765/lambda?hour=8&epsilon=1200&x=819992.4935&y=3382574.117'
+    """
+    host, port = '127.0.0.1', 8765
+    _service = QueryService()
+    print(f'serving on http://{host}:{port} (hours={sorted(_service.nets)}, hotspots={len(_service.index.keys)})')
+    ThreadingHTTPServer((host, port), make_handler(_service)).serve_forever()
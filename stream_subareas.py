@@ -0,0 +1,143 @@
+from collections import deque
+import numpy as np
+from graph.stream import StreamingDetector
+from preprocess import get_road_topology, read_od_events
+from combine_subareas import combine_component
+
+
+def simulate_feed(od_path='output/wuchangroad_od_cleaned.csv'):
+    """
+    Simulate a live feed of trip starts and ends from the cleaned od data
+    yield (time, road id, x, y, od flag) in the order of time
+    """
+    times, road_ids, xs, ys, flags = read_od_events(od_path)
+    for i in np.argsort(times, kind='stable'):
+        yield times[i], road_ids[i], xs[i], ys[i], flags[i]
+
+
+class IncrementalMerge:
+    """
+    Combined urban black holes and volcanoes of a StreamingDetector kept up to date event by event
+
+    The significant subareas are split into the components of their overlap graph (see
+    combine_subareas.overlap_components), and only the components holding a subarea changed by the event
+    (added, removed, or changed flag or neighbourhood, see StreamingDetector.changed) are combined again,
+    with the lambda values and od totals of that time, inside the event (counted in its latency).
+    """
+
+    def __init__(self, detector: StreamingDetector) -> None:
+        self.detector = detector
+        self.subareas = {True: {}, False: {}}  # flag -> {seed => (lambda, neighbour)}
+        self.holders = {True: {}, False: {}}  # flag -> {point => seeds of the subareas holding it}
+        self.component = {True: {}, False: {}}  # flag -> {seed => id of its component}
+        self.merged = {True: {}, False: {}}  # flag -> {component id => (seeds, combined results)}
+        self.__next_id = 0
+        detector.on_change = self.update
+        self.update(set(detector.significant) | detector.changed)
+        detector.changed = set()
+
+    def __remove(self, flag, pi) -> None:
+        _, nb = self.subareas[flag].pop(pi)
+        for p in nb:
+            seeds = self.holders[flag][p]
+            seeds.discard(pi)
+            if not seeds:
+                del self.holders[flag][p]
+
+    def __add(self, flag, pi, lam, nb) -> None:
+        nb = frozenset(nb)  # the detector updates its neighbourhoods in place
+        self.subareas[flag][pi] = (lam, nb)
+        for p in nb:
+            self.holders[flag].setdefault(p, set()).add(pi)
+
+    def __combine(self, flag, seeds) -> None:
+        """
+        Combine again the components of the given seeds
+        """
+        subareas, holders, component = self.subareas[flag], self.holders[flag], self.component[flag]
+        seeds = {pi for pi in seeds if pi in subareas}
+        while seeds:
+            # the component of a seed (its subareas may join components combined before)
+            stack, group = [seeds.pop()], set()
+            while stack:
+                pi = stack.pop()
+                if pi in group or pi not in subareas:
+                    continue
+                group.add(pi)
+                old = self.merged[flag].pop(component.get(pi), None)
+                if old is not None:
+                    stack.extend(old[0])
+                stack.extend(q for p in subareas[pi][1] for q in holders[p])
+            seeds -= group
+            cid, self.__next_id = self.__next_id, self.__next_id + 1
+            for pi in group:
+                component[pi] = cid
+            self.merged[flag][cid] = (group, combine_component({pi: subareas[pi] for pi in group},
+                                                              self.detector.pi_type, self.detector.net.o_count,
+                                                              self.detector.net.d_count))
+
+    def update(self, changed) -> None:
+        """
+        Combine again the components of the changed significant locations
+        """
+        touched = {True: set(), False: set()}
+        for pi in changed:
+            for flag in (True, False):
+                if pi in self.subareas[flag]:
+                    # the rest of its old component may split
+                    old = self.merged[flag].pop(self.component[flag].pop(pi, None), None)
+                    if old is not None:
+                        touched[flag] |= old[0]
+                    self.__remove(flag, pi)
+            entry = self.detector.significant.get(pi)
+            if entry is not None:
+                flag, lam, nb = entry
+                self.__add(flag, pi, lam, nb)
+                touched[flag].add(pi)
+        for flag, seeds in touched.items():
+            self.__combine(flag, seeds)
+
+    def results(self):
+        """
+        The combined holes and volcanoes (see combine_subareas.identify_hole_volcano)
+        """
+        hole, volcano = ([res for _, results in self.merged[flag].values() for res in results]
+                         for flag in (True, False))
+        hole.sort(key=lambda _x: (_x[0], -_x[2]))
+        volcano.sort(key=lambda _x: (_x[0], -_x[2]))
+        return hole, volcano
+
+
+def stream_hole_volcano(horizon=np.timedelta64(1, 'h'), report=1000):
+    """
+    Track urban black holes and volcanoes online over the OD points of the latest 'horizon'
+    the combined results are updated within the events (see IncrementalMerge), the drift of the cached
+    counts is measured on a sample of the locations at each report (see StreamingDetector.count_drift)
+    """
+    detector = StreamingDetector(get_road_topology('output/wuchangroad_network.csv'), epsilon,
+                                 alpha=alpha, r_time=r_time, refresh=refresh)
+    merge = IncrementalMerge(detector)
+    live = deque()
+    for cnt, (loc_time, road_id, x, y, o_d) in enumerate(simulate_feed()):
+        # expire the OD points which are out of the horizon
+        while live and live[0][0] <= loc_time - horizon:
+            detector.remove_event(*live.popleft()[1:])
+        detector.add_event(road_id, x, y, o_d)
+        live.append((loc_time, road_id, x, y, o_d))
+        if cnt % report == 0:
+            merged = merge.results()
+            print(f'[{loc_time}] hole={len(merged[0])} volcano={len(merged[1])} '
+                  f'subareas={len(detector.significant)} latency(ms)={detector.latency_summary()} '
+                  f'drift={detector.count_drift(100)}')
+    return merge.results()
+
+
+if __name__ == '__main__':
+    """
+    Online detection of urban black holes and volcanoes for a (simulated) stream of OD events
+    """
+    r_time = 99  # the number of repetitions of Monte Carlo simulation
+    alpha = 0.05  # significance level
+    epsilon = 1200  # the neighbourhood cutoff radius
+    refresh = 500  # the number of events between two refreshes of the null distribution
+    stream_hole_volcano()
@@ -0,0 +1,54 @@
+import os.path as osp
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+from graph.roadnet import RoadNetWork  # noqa: E402
+
+
+def grid_network(n=5, spacing=100.0, n_points=300, seed=0, duplicates=0) -> RoadNetWork:
+    """
+    A small road network: a grid of n x n nodes with a diagonal, a dead end, a loop and a closed ring,
+    with od points at random positions on the roads ('duplicates' more records on existing locations)
+    """
+    rng = np.random.default_rng(seed)
+    net = RoadNetWork()
+    road_id = 0
+    for i in range(n):
+        for j in range(n):
+            x, y = i * spacing, j * spacing
+            if i + 1 < n:
+                net.add_edge(road_id, x, y, x + spacing, y)
+                road_id += 1
+            if j + 1 < n:
+                net.add_edge(road_id, x, y, x, y + spacing)
+                road_id += 1
+    top = (n - 1) * spacing
+    for x1, y1, x2, y2 in ((0.0, 0.0, spacing, spacing),  # diagonal
+                           (top, top, top + 70.0, top + 30.0),  # dead end
+                           (top + 70.0, top + 30.0, top + 140.0, top + 30.0),
+                           (top + 140.0, top + 30.0, top + 140.0, top + 90.0),  # closed chain back to the dead end
+                           (top + 140.0, top + 90.0, top + 70.0, top + 30.0)):
+        net.add_edge(road_id, x1, y1, x2, y2)
+        road_id += 1
+    roads = list(net.edges.keys())
+    points = []
+    for __ in range(n_points):
+        road = roads[rng.integers(len(roads))]
+        (x1, y1), (x2, y2) = net.edges[road]
+        t = rng.random()
+        points.append((road, x1 + t * (x2 - x1), y1 + t * (y2 - y1), bool(rng.random() < 0.5)))
+    for k in rng.integers(len(points), size=duplicates):
+        road, x, y, _ = points[k]
+        points.append((road, x, y, bool(rng.random() < 0.5)))
+    for road, x, y, o_d in points:
+        net.add_matches(road, x, y, o_d)
+    net.build_kd_trees()
+    return net
+
+
+@pytest.fixture
+def network() -> RoadNetWork:
+    return grid_network()
@@ -0,0 +1,60 @@
+import random
+import numpy as np
+import pytest
+from conftest import grid_network
+from graph.kernel import ArrayNetWork, build_topology
+from graph.approx import ApproxResult, approximate_test, classification_agreement
+from graph import roadnet
+from graph.realizations import RealizationNetWork, generate_realizations
+
+
+def clustered_network():
+    """
+    The grid network with a cluster of destinations on one road and of origins on another
+    """
+    net = grid_network(n_points=400, seed=2)
+    rng = np.random.default_rng(0)
+    for road, o_d in ((0, False), (30, True)):
+        (x1, y1), (x2, y2) = net.edges[road]
+        for t in rng.random(60):
+            net.add_matches(road, x1 + t * (x2 - x1), y1 + t * (y2 - y1), o_d)
+    net.build_kd_trees()
+    return net
+
+
+def test_classification_agreement_counts():
+    n = 5
+    flag = np.asarray([True, False, True, False, True])
+    significant = np.asarray([True, True, False, False, True])
+    certain = np.asarray([True, False, True, True, False])
+    result = ApproxResult(np.arange(n), *(np.zeros(n) for __ in range(2)), *(np.zeros((n, 2)) for __ in range(2)),
+                          np.zeros(n), np.zeros((n, 2)), np.zeros(n), np.zeros((n, 2)), flag, significant, certain)
+    # approximate: hole, volcano, none, none, hole
+    exact = {0: True, 1: True, 2: None, 3: False}
+    agreement = classification_agreement(result, exact)
+    assert agreement['accuracy'] == pytest.approx(2 / 5)
+    assert agreement['precision'] == pytest.approx(1 / 3) and agreement['recall'] == pytest.approx(1 / 3)
+    assert agreement['certain'] == pytest.approx(3 / 5) and agreement['certain_accuracy'] == pytest.approx(2 / 3)
+
+
+@pytest.mark.parametrize('epsilon', [120.0, 250.0])
+def test_approximate_test_agrees_with_the_exact_path(epsilon):
+    net = clustered_network()
+    topology = build_topology(net)
+    array_net = ArrayNetWork.from_network(net, topology)
+    ran_net = RealizationNetWork(topology, generate_realizations(topology, array_net.points, 20, seed=1), seed=1)
+    result = approximate_test(array_net, ran_net.network(0), 0.05, epsilon, sample_rate=1.0, seed=0)
+    # the exact counts are within the bounds
+    o_cnt, d_cnt = array_net.neighbor_counts(epsilon, result.seeds)
+    assert ((result.o_bounds[:, 0] <= o_cnt) & (o_cnt <= result.o_bounds[:, 1])).all()
+    assert ((result.d_bounds[:, 0] <= d_cnt) & (d_cnt <= result.d_bounds[:, 1])).all()
+    random.seed(0)
+    exact = {}
+    for seed in result.seeds.tolist():
+        res = roadnet.test_subarea(array_net, ran_net, seed, 99, 0.05, epsilon)
+        exact[seed] = None if res is None or res[4] > 0.05 or res[1] == res[2] else res[2] > res[1]
+    assert sum(v is not None for v in exact.values()) > 100
+    agreement = classification_agreement(result, exact)
+    assert agreement['accuracy'] > 0.95 and agreement['precision'] > 0.95 and agreement['recall'] > 0.95
+    # the certain classifications hold with confidence 1 - delta (up to the Monte Carlo error of the exact path)
+    assert agreement['certain'] > 0.8 and agreement['certain_accuracy'] > 0.99
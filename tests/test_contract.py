@@ -0,0 +1,67 @@
+import numpy as np
+from graph.roadnet import RoadNetWork
+from graph.kernel import build_topology
+from graph.contract import contract_chains
+
+
+def chains_network() -> RoadNetWork:
+    """
+    A junction A with a chain A-B-C-D to a dead end, two short dead ends, a self-loop on A,
+    a ring P-Q-R (no junction), and a node G holding only a self-loop
+    """
+    net = RoadNetWork()
+    edges = [((0, 0), (1, 0)), ((1, 0), (2, 0)), ((2, 0), (3, 0)),  # A-B-C-D
+             ((0, 0), (0, 1)), ((0, 0), (0, -1)),  # A-E, A-F
+             ((0, 0), (0, 0)),  # self-loop on A
+             ((10, 0), (11, 0)), ((11, 0), (10, 1)), ((10, 1), (10, 0)),  # ring P-Q-R
+             ((20, 0), (20, 0))]  # lone self-loop on G
+    for road_id, ((x1, y1), (x2, y2)) in enumerate(edges):
+        net.add_edge(road_id, float(x1), float(y1), float(x2), float(y2))
+    return net
+
+
+def check_tiling(topology, contracted, contraction):
+    """
+    The edges of every super-edge tile it: consecutive, from 0 to its length, and joined by their nodes
+    """
+    edge_len = topology.edge_len
+    assert np.isclose(contracted.edge_len.sum(), edge_len.sum())
+    for k in range(len(contracted.edge_len)):
+        edges = np.nonzero(contraction.edge_super == k)[0]
+        edges = edges[np.argsort(contraction.edge_start[edges])]
+        starts = contraction.edge_start[edges]
+        assert np.isclose(starts[0], 0.0)
+        np.testing.assert_allclose(starts[1:], np.cumsum(edge_len[edges])[:-1])
+        assert np.isclose(contracted.edge_len[k], edge_len[edges].sum())
+        # the far node of each edge is the near node of the next one
+        ends = topology.edge_nodes[edges]
+        near = np.where(contraction.edge_flip[edges], ends[:, 1], ends[:, 0])
+        far = np.where(contraction.edge_flip[edges], ends[:, 0], ends[:, 1])
+        np.testing.assert_array_equal(far[:-1], near[1:])
+
+
+def test_walk_chains_closed_chains_and_self_loops():
+    topology = build_topology(chains_network())
+    contracted, contraction = contract_chains(topology)
+    assert (contraction.edge_super >= 0).all()
+    super_of = {road_id: int(k) for road_id, k in zip(topology.road_ids.tolist(), contraction.edge_super)}
+    # the chain A-B-C-D is one super-edge, the dead ends and loops are their own
+    assert super_of[0] == super_of[1] == super_of[2]
+    assert len({super_of[r] for r in (0, 3, 4, 5, 6, 9)}) == 6
+    # the ring is one closed super-edge
+    assert super_of[6] == super_of[7] == super_of[8]
+    assert len(contracted.edge_len) == 6
+    for road_id in (5, 6, 9):
+        n1, n2 = contracted.edge_nodes[super_of[road_id]]
+        assert n1 == n2  # closed: both ends on the same node
+    assert np.isclose(contracted.edge_len[super_of[6]], 2 + np.sqrt(2))
+    check_tiling(topology, contracted, contraction)
+
+
+def test_walk_chains_grid(network):
+    topology = build_topology(network)
+    contracted, contraction = contract_chains(topology)
+    check_tiling(topology, contracted, contraction)
+    # only junctions and dead ends are kept as nodes
+    degree = np.diff(contracted.node_indptr)
+    assert len(contracted.node_xy) < len(topology.node_xy) and (degree != 2).any()
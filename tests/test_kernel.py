@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from graph.kernel import ArrayNetWork
+from conftest import grid_network
+
+
+@pytest.mark.parametrize('epsilon', [30.0, 120.0, 250.0, 600.0])
+def test_expand_neighbors_matches_roadnet(network, epsilon):
+    array_net = ArrayNetWork.from_network(network)
+    for pi in network.all_matches():
+        expected = network.network_constrained_neighbors(epsilon, pi)
+        assert array_net.network_constrained_neighbors(epsilon, pi) == expected
+
+
+def test_neighbor_counts_match_indices(network):
+    array_net = ArrayNetWork.from_network(network)
+    seeds = np.arange(len(array_net.points.pt_xy))
+    o_cnt, d_cnt = array_net.neighbor_counts(250.0, seeds)
+    for seed in seeds.tolist():
+        _, o, d = array_net.neighbor_indices(250.0, seed)
+        assert (o_cnt[seed], d_cnt[seed]) == (o, d)
+
+
+@pytest.mark.parametrize('epsilon', [120.0, 600.0])
+def test_repeated_records_are_counted_alike(epsilon):
+    # several records on the same locations: both networks count their multiplicities, cleaned or not
+    network = grid_network(duplicates=150, seed=3)
+    array_net = ArrayNetWork.from_network(network)
+    assert array_net.points.loc_o.sum() + array_net.points.loc_d.sum() == network.od_count
+    expected = {pi: network.network_constrained_neighbors(epsilon, pi) for pi in network.all_matches()}
+    for pi, result in expected.items():
+        assert array_net.network_constrained_neighbors(epsilon, pi) == result
+    network.clean_matches()
+    for pi, result in expected.items():
+        assert network.network_constrained_neighbors(epsilon, pi) == result
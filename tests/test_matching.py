@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from graph.kernel import build_topology
+from graph.matching import build_segment_grid, match_points
+
+
+def brute_force(topology, xy, max_dist):
+    """
+    Nearest segment of each point over all the segments (ties go to the lowest edge index)
+    """
+    a = topology.node_xy[topology.edge_nodes[:, 0]]
+    b = topology.node_xy[topology.edge_nodes[:, 1]]
+    ab = b - a
+    length2 = (ab ** 2).sum(axis=1)
+    t = np.clip(np.divide(((xy[:, None, :] - a[None]) * ab[None]).sum(axis=2), length2[None],
+                          out=np.zeros((len(xy), len(a))), where=length2[None] > 0), 0.0, 1.0)
+    dist = np.sqrt(((a[None] + t[..., None] * ab[None] - xy[:, None, :]) ** 2).sum(axis=2))
+    edge = dist.argmin(axis=1)
+    best = dist[np.arange(len(xy)), edge]
+    edge[best > max_dist] = -1
+    return edge, best
+
+
+@pytest.mark.parametrize('cell_size, max_dist', [(None, np.inf), (30.0, np.inf), (500.0, 40.0), (None, 15.0)])
+def test_nearest_segments_match_brute_force(network, cell_size, max_dist):
+    topology = build_topology(network)
+    rng = np.random.default_rng(1)
+    # points around and outside of the network
+    xy = rng.uniform(-150.0, 700.0, size=(2000, 2))
+    grid = build_segment_grid(topology, cell_size=cell_size)
+    matches = match_points(topology, xy, grid=grid, max_dist=max_dist, batch_size=700)
+    edge, dist = brute_force(topology, xy, max_dist)
+    matched = edge >= 0
+    np.testing.assert_array_equal(matches.edge >= 0, matched)
+    np.testing.assert_allclose(matches.dist[matched], dist[matched], rtol=0, atol=1e-9)
+    np.testing.assert_array_equal(matches.edge, edge)
+    # the points are moved onto their segments
+    assert np.allclose(np.sqrt(((matches.xy[matched] - xy[matched]) ** 2).sum(axis=1)), dist[matched])
+    assert np.isinf(matches.dist[~matched]).all() and np.isnan(matches.xy[~matched]).all()
+
+
+def test_nan_points_are_unmatched(network):
+    topology = build_topology(network)
+    matches = match_points(topology, np.asarray([[np.nan, 0.0], [10.0, 0.0]]))
+    assert matches.edge[0] == -1 and matches.edge[1] >= 0 and matches.dist[1] == 0.0
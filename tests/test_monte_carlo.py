@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+from graph.roadnet import monte_carlo_test
+
+
+class ScriptedNetwork:
+    """
+    A random network whose simulated lambdas are given in advance (one per draw)
+    """
+
+    def __init__(self, lambdas) -> None:
+        self.lambdas = list(lambdas)
+        self.n_drawn = 0
+
+    def random_match(self):
+        self.n_drawn += 1
+        return self.n_drawn - 1
+
+    def calc_lambda(self, epsilon, pi):
+        return self.lambdas[pi]
+
+
+@pytest.mark.parametrize('r_time, alpha', [(19, 0.05), (99, 0.05), (99, 0.01), (39, 0.1)])
+def test_sequential_decision_matches_full_run(r_time, alpha):
+    rng = np.random.default_rng(r_time)
+    for __ in range(300):
+        # observed lambdas from clearly significant to clearly not
+        lambdas = rng.random(r_time)
+        lambda_obs = rng.random() ** rng.choice([0.05, 1.0, 20.0])
+        p_full, n_full = monte_carlo_test(ScriptedNetwork(lambdas), lambda_obs, r_time, 1.0)
+        net = ScriptedNetwork(lambdas)
+        p_seq, n_seq = monte_carlo_test(net, lambda_obs, r_time, 1.0, alpha=alpha)
+        assert n_full == r_time
+        assert n_seq == net.n_drawn <= r_time
+        assert (p_seq <= alpha) == (p_full <= alpha)
+        if p_seq <= alpha:
+            # the exceedances drawn before a significant stop: a lower bound of the full p-value
+            assert p_seq <= p_full
+
+
+def test_sequential_stops_early():
+    r_time, alpha = 99, 0.05
+    # every simulated lambda beats the observed one: not significant after (1 + r) * alpha exceedances
+    net = ScriptedNetwork(np.ones(r_time))
+    p_value, n_sim = monte_carlo_test(net, 0.0, r_time, 1.0, alpha=alpha)
+    assert n_sim == int(alpha * (1 + r_time)) + 1
+    assert p_value == 1.0
+    # none beats it: significant once the remaining simulations cannot change the decision
+    net = ScriptedNetwork(np.zeros(r_time))
+    p_value, n_sim = monte_carlo_test(net, 1.0, r_time, 1.0, alpha=alpha)
+    assert n_sim == r_time - int(alpha * (1 + r_time))
+    assert p_value == 0.0
+
+
+def test_undefined_lambdas_never_exceed():
+    net = ScriptedNetwork([None] * 19)
+    assert monte_carlo_test(net, 0.0, 19, 1.0) == (0.0, 19)
+
+
+def test_p_value_bounds_hold_the_full_p_value():
+    from identify_subareas import p_value_bounds
+    rng = np.random.default_rng(5)
+    for r_time, alpha in ((19, 0.05), (99, 0.05), (99, 0.01)):
+        for __ in range(300):
+            lambdas = rng.random(r_time)
+            lambda_obs = rng.random() ** rng.choice([0.05, 1.0, 20.0])
+            p_full, _ = monte_carlo_test(ScriptedNetwork(lambdas), lambda_obs, r_time, 1.0)
+            p_seq, n_seq = monte_carlo_test(ScriptedNetwork(lambdas), lambda_obs, r_time, 1.0, alpha=alpha)
+            (low, high), = p_value_bounds([p_seq], [n_seq], r_time, alpha, sequential=True)
+            assert low - 1e-12 <= p_full <= high + 1e-12
+            if n_seq == r_time:
+                assert np.isclose(low, p_full) and np.isclose(high, p_full)
+
+
+def test_p_value_bounds_of_a_complete_run():
+    from identify_subareas import p_value_bounds
+    # 80 exceedances in all the 99 simulations: p = 80 / 100, not 79 exceedances
+    bounds = p_value_bounds([80 / 100.0], [99], 99, 0.05, sequential=True)
+    np.testing.assert_allclose(bounds, [[0.8, 0.8]])
+    # the last simulation settles a non-significant test: the p-value of the complete run is returned
+    net = ScriptedNetwork([0.0] * 93 + [1.0] * 6)
+    assert monte_carlo_test(net, 0.5, 99, 1.0, alpha=0.05) == (6 / 100.0, 99)
@@ -0,0 +1,23 @@
+from graph.kernel import ArrayNetWork
+from graph.prune import prune_points
+
+
+def test_exact_prune_by_default(network):
+    net = ArrayNetWork.from_network(network)
+    points = net.all_matches()
+    # the exact prune does not simulate anything
+    kept, pruned = prune_points(net, None, 99, 0.05, 120.0)
+    assert set(pruned) == {'empty', 'balanced'} and len(kept) + sum(pruned.values()) == len(points)
+    kept = set(kept)
+    for pi in points:
+        _, o_cnt, d_cnt = net.network_constrained_neighbors(120.0, pi)
+        undefined = o_cnt + d_cnt in (0, net.od_count)
+        assert (pi in kept) == (not undefined and o_cnt != d_cnt)
+
+
+def test_probabilistic_prune_is_opt_in(network):
+    net = ArrayNetWork.from_network(network)
+    kept, pruned = prune_points(net, net, 99, 0.05, 120.0)
+    kept_p, pruned_p = prune_points(net, net, 99, 0.05, 120.0, probabilistic=True, n_null=500)
+    assert set(pruned_p) == {'empty', 'balanced', 'probably_null'}
+    assert set(kept_p) <= set(kept) and len(kept) - len(kept_p) == pruned_p['probably_null']
@@ -0,0 +1,18 @@
+from graph.kernel import build_topology, build_points
+from graph.realizations import RealizationNetWork, generate_realizations
+
+
+def test_realization_draws_are_seeded_and_cached(network):
+    topology = build_topology(network)
+    realizations = generate_realizations(topology, build_points(network, topology), 10, seed=7)
+    draws = []
+    for __ in range(2):
+        ran_net = RealizationNetWork(topology, realizations, seed='8_600', cache_size=3)
+        draws.append([ran_net.random_match() for __ in range(200)])
+        # only the most recently used networks are kept
+        info = ran_net.network.cache_info()
+        assert info.currsize == 3 and info.misses > 10
+    assert draws[0] == draws[1]
+    assert len({r for r, _ in draws[0]}) == 10
+    r, idx = draws[0][-1]
+    assert ran_net.calc_lambda(250.0, (r, idx)) == ran_net.network(r).calc_lambda(250.0, idx)
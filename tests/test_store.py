@@ -0,0 +1,81 @@
+import os.path as osp
+import numpy as np
+import pytest
+from graph.kernel import build_topology, build_points, save_arrays
+from utils.store import ResultStore
+from utils.query import HotspotIndex
+
+
+def test_result_store_round_trip(tmp_path):
+    store = ResultStore(str(tmp_path / 'store'))
+    members = [{(0.0, 0.0), (1.0, 2.0)}, {(1.0, 2.0), (5.5, 3.0), (7.0, 7.0)}, set()]
+    store.write(8, 1200, 'hole', members, seed_xy=np.asarray([(0.0, 0.0), (5.5, 3.0), (9.0, 9.0)]),
+                lam=np.asarray([3.0, 2.0, 1.0], dtype=np.float32), p_value=np.asarray([0.01, 0.02, 0.03]),
+                o_cnt=np.asarray([1, 2, 0]), d_cnt=np.asarray([4, 5, 0]))
+    result = store.read(8, 1200, 'hole')
+    assert store.member_sets(result) == members
+    assert {tuple(p) for p in store.members(result, 1).tolist()} == members[1]
+    np.testing.assert_array_equal(result['o_cnt'], [1, 2, 0])
+    summary = store.read_summary(8, 1200, 'hole')
+    assert 'member_idx' not in summary and set(summary) == {'seed_xy', 'lam', 'p_value', 'o_cnt', 'd_cnt'}
+    assert store.has(8, 1200, 'hole') and not store.has(8, 1200, 'volcano') and not store.has(9, 1200, 'hole')
+    assert store.catalog() == {(8, 1200): {'hole': 3}}
+
+
+def test_result_store_table(tmp_path):
+    store = ResultStore(str(tmp_path / 'store'))
+    assert not store.has_table('8_lixel50', 600)
+    fields = {name: np.arange(4) for name in ('lam', 'p_value', 'o_cnt', 'd_cnt', 'n_sim')}
+    store.write_table('8_lixel50', 600, 'stats', params={'r_time': 99}, seed_xy=np.zeros((4, 2)),
+                      p_bounds=np.zeros((4, 2)), **fields)
+    assert store.has_table('8_lixel50', 600)
+    assert store.table_params('8_lixel50', 600) == {'r_time': 99}
+    np.testing.assert_array_equal(store.read_summary('8_lixel50', 600, 'stats')['n_sim'], np.arange(4))
+    store.remove('8_lixel50', 600)
+    assert store.catalog() == {}
+
+
+@pytest.fixture
+def hotspot_store(tmp_path, network):
+    """
+    A store with two combined holes and one volcano, and the array snapshot of their network
+    """
+    arrays_dir = str(tmp_path / 'arrays')
+    topology = build_topology(network)
+    save_arrays(osp.join(arrays_dir, 'topology'), topology)
+    save_arrays(osp.join(arrays_dir, 'network_8'), build_points(network, topology))
+    points = network.all_matches()
+    store = ResultStore(str(tmp_path / 'store'))
+    holes = [set(points[:5]), set(points[5:8])]
+    store.write(8, 1200, 'hole_merged', holes, ratio=[0.1, 0.2], lam=[5.0, 4.0], o_cnt=[1, 1], d_cnt=[9, 4])
+    store.write(8, 1200, 'volcano_merged', [set(points[8:10])], ratio=[0.9], lam=[3.0], o_cnt=[9], d_cnt=[1])
+    return store, arrays_dir, holes, points
+
+
+def test_hotspot_index_queries(hotspot_store, network):
+    store, arrays_dir, holes, points = hotspot_store
+    index = HotspotIndex(store, cell=50.0, arrays_dir=arrays_dir)
+    everything = index.bbox(-1e12, -1e12, 1e12, 1e12)
+    assert sorted((k, i) for _, _, k, i, _ in everything) == [('hole_merged', 0), ('hole_merged', 1),
+                                                              ('volcano_merged', 0)]
+    x, y = points[0]
+    near = index.radius(x, y, 1e-6)
+    assert ('hole_merged', 0) in [(k, i) for _, _, k, i, _ in near]
+    inside = index.bbox(x - 1e-6, y - 1e-6, x + 1e-6, y + 1e-6, kind='hole')
+    assert all(k == 'hole_merged' for _, _, k, _, _ in inside) and len(inside) >= 1
+    assert index.bbox(x - 1e-6, y - 1e-6, x + 1e-6, y + 1e-6, epsilon=600) == []
+    road = network.road_mark[points[5]]
+    assert ('hole_merged', 1) in [(k, i) for _, _, k, i, _ in index.road(int(road))]
+    # brute force over the members of each hotspot
+    xmin, ymin, xmax, ymax = 50.0, 50.0, 250.0, 180.0
+    expected = sorted(i for i, members in enumerate(holes)
+                      if any(xmin <= px <= xmax and ymin <= py <= ymax for px, py in members))
+    got = sorted(i for _, _, k, i, _ in index.bbox(xmin, ymin, xmax, ymax, kind='hole'))
+    assert got == expected
+
+
+def test_hotspot_index_empty(tmp_path):
+    index = HotspotIndex(ResultStore(str(tmp_path / 'store')), arrays_dir=str(tmp_path / 'arrays'))
+    assert index.bbox(0.0, 0.0, 1e9, 1e9) == []
+    assert index.radius(0.0, 0.0, 10.0) == []
+    assert index.road(3) == []
@@ -0,0 +1,74 @@
+import os
+import os.path as osp
+import time
+from utils.taskqueue import TaskQueue
+
+
+def expire(queue: TaskQueue, task_id) -> None:
+    """
+    Age the lease of a task beyond the lease duration
+    """
+    path = osp.join(queue.root, 'leased', f'{task_id}.json')
+    past = time.time() - queue.lease_seconds - 10
+    os.utime(path, (past, past))
+
+
+def write_result(text):
+    def commit(result_dir):
+        with open(osp.join(result_dir, 'result.txt'), 'w') as fd:
+            fd.write(text)
+    return commit
+
+
+def test_submit_is_idempotent(tmp_path):
+    queue = TaskQueue(str(tmp_path))
+    assert queue.submit('a', {'x': 1})
+    assert not queue.submit('a', {'x': 2})
+    assert queue.status() == {'pending': 1, 'leased': 0, 'done': 0, 'failed': 0}
+
+
+def test_lease_expiry_and_reclaim(tmp_path):
+    queue = TaskQueue(str(tmp_path), lease_seconds=60)
+    queue.submit('a', {})
+    task = queue.lease('w1')
+    assert task['attempts'] == 1 and task['worker'] == 'w1'
+    assert queue.lease('w2') is None
+    # a live lease is kept, an expired one goes back to pending
+    assert queue.reclaim() == 0
+    expire(queue, 'a')
+    assert queue.reclaim() == 1
+    assert queue.tasks()['a']['state'] == 'pending'
+    assert queue.tasks()['a']['errors'] == ['lease expired']
+    # the lost worker cannot renew, the next one leases it again
+    assert not queue.renew('a')
+    task = queue.lease('w2')
+    assert task['attempts'] == 2 and queue.renew('a')
+
+
+def test_failed_after_max_attempts(tmp_path):
+    queue = TaskQueue(str(tmp_path), lease_seconds=60, max_attempts=2)
+    queue.submit('a', {})
+    queue.fail(queue.lease('w1'), 'boom')
+    assert queue.tasks()['a']['state'] == 'pending'
+    queue.lease('w1')
+    expire(queue, 'a')
+    assert queue.reclaim() == 1
+    assert queue.tasks()['a']['state'] == 'failed'
+    assert queue.tasks()['a']['errors'] == ['boom', 'lease expired']
+    assert queue.lease('w1') is None
+
+
+def test_double_complete_keeps_the_first_result(tmp_path):
+    queue = TaskQueue(str(tmp_path), lease_seconds=60)
+    queue.submit('a', {})
+    lost = queue.lease('w1')
+    expire(queue, 'a')
+    queue.reclaim()
+    retry = queue.lease('w2')
+    assert queue.complete(retry, write_result('second'))
+    # the lost worker finishes later: its result is dropped
+    assert not queue.complete(lost, write_result('first'))
+    with open(osp.join(queue.results_dir('a'), 'result.txt')) as fd:
+        assert fd.read() == 'second'
+    assert queue.status() == {'pending': 0, 'leased': 0, 'done': 1, 'failed': 0}
+    assert [name for name in os.listdir(osp.join(queue.root, 'results')) if name.endswith('.tmp')] == []
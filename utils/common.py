@@ -1,5 +1,8 @@
+from typing import TYPE_CHECKING
 import numpy as np
-from matplotlib.axes import Axes
+
+if TYPE_CHECKING:
+    from matplotlib.axes import Axes
 
 
 def split_worker(iter_size: int, worker: int):
@@ -20,7 +23,25 @@ def split_worker(iter_size: int, worker: int):
     return split
 
 
-def set_axes_equal_2d(ax: Axes):
+def parse_hours(hours):
+    """
+    '0-23' or '7,8,17-19' => list of hours
+    """
+    res = []
+    for part in hours.split(','):
+        st, _, ed = part.partition('-')
+        res.extend(range(int(st), int(ed or st) + 1))
+    return res
+
+
+def simulations_path(time_idx, epsilon) -> str:
+    """
+    File of the numbers of Monte Carlo simulations {pi => n_sim} of a time index (or label) and epsilon
+    """
+    return f'output/subareas_split_time/{time_idx}_{epsilon}_simulations.npy'
+
+
+def set_axes_equal_2d(ax: 'Axes'):
     """
     Make axes of 2D plot have equal scale so that spheres appear as spheres,
     cubes as cubes, etc..  This is one possible solution to Matplotlib's
@@ -0,0 +1,161 @@
+import os
+import os.path as osp
+from typing import List, Optional, Tuple
+import numpy as np
+from utils.store import ResultStore
+from graph.kernel import Topology, Points, load_arrays
+
+
+def location_roads(arrays_dir='output/network_arrays'):
+    """
+    Map the od locations of all the saved observed networks to the set of their road ids
+    (a location may be matched to several roads, see preprocess.clean_od_data)
+    """
+    loc2road = {}
+    if not osp.exists(osp.join(arrays_dir, 'topology')):
+        return loc2road
+    road_ids = load_arrays(osp.join(arrays_dir, 'topology'), Topology).road_ids
+    for name in os.listdir(arrays_dir):
+        if not name.startswith('network_') or name.startswith('network_random_'):
+            continue
+        points = load_arrays(osp.join(arrays_dir, name), Points)
+        for pi, road_id in zip(map(tuple, points.pt_xy.tolist()), road_ids[points.pt_edge].tolist()):
+            loc2road.setdefault(pi, set()).add(road_id)
+    return loc2road
+
+
+class HotspotIndex:
+    """
+    Spatial query index over the urban black holes and volcanoes of all the partitions in a result store
+
+    The member locations of all the hotspots are bucketed in a uniform grid (cell -> members, CSR),
+    and the roads of the members are indexed as well (road id -> hotspots, CSR), so bounding box,
+    point-radius and road queries only touch the members in a few cells (or of one road).
+    """
+
+    def __init__(self, store: ResultStore, cell=500.0, kinds=('hole_merged', 'volcano_merged'),
+                 arrays_dir='output/network_arrays') -> None:
+        """
+        Parameters
+        ----------
+        store : ResultStore
+            the result store to be indexed (all its partitions are loaded)
+        cell : float
+            the size of the grid cells
+        kinds : tuple
+            the kinds of results to be indexed, see ResultStore.write()
+        arrays_dir : str
+            the directory of the network snapshots (used to map members to roads)
+        """
+        self.cell = float(cell)
+        self.keys: List[Tuple] = []  # hotspot id -> (time, epsilon, kind, index in the partition)
+        ratio, member_xy, member_hot = [], [], []
+        for (time_idx, epsilon), counts in store.catalog().items():
+            for kind in kinds:
+                if counts.get(kind, 0) == 0:
+                    continue
+                result = store.read(time_idx, epsilon, kind)
+                first = len(self.keys)
+                self.keys.extend((time_idx, epsilon, kind, i) for i in range(counts[kind]))
+                ratio.append(result['ratio'] if 'ratio' in result else result['lam'])
+                member_xy.append(result['location_xy'][result['member_idx']])
+                member_hot.append(first + np.repeat(np.arange(counts[kind]), np.diff(result['member_indptr'])))
+        self.ratio = np.concatenate(ratio) if ratio else np.zeros(0)
+        self.member_xy = np.concatenate(member_xy) if member_xy else np.zeros((0, 2))
+        self.member_hot = np.concatenate(member_hot).astype(np.int64) if member_hot else np.zeros(0, np.int64)
+        self.hot_time = np.asarray([str(k[0]) for k in self.keys])
+        self.hot_epsilon = np.asarray([float(k[1]) for k in self.keys])
+        self.hot_kind = np.asarray([k[2] for k in self.keys])
+        # grid: cell -> members
+        self.origin = self.member_xy.min(axis=0) if len(self.member_xy) > 0 else np.zeros(2)
+        cxy = self.__cells(self.member_xy)
+        self.n_col = int(cxy[:, 1].max()) + 1 if len(cxy) > 0 else 1
+        self.n_row = int(cxy[:, 0].max()) + 1 if len(cxy) > 0 else 1
+        cell_id = cxy[:, 0] * self.n_col + cxy[:, 1]
+        self.cell_order = np.argsort(cell_id, kind='stable')
+        self.cell_keys, self.cell_start = np.unique(cell_id[self.cell_order], return_index=True)
+        self.cell_end = np.append(self.cell_start[1:], len(cell_id))
+        # road -> hotspots
+        loc2road = location_roads(arrays_dir)
+        pairs = [(road_id, hot) for p, hot in zip(map(tuple, self.member_xy.tolist()), self.member_hot.tolist())
+                 for road_id in loc2road.get(p, ())]
+        pairs = np.unique(np.asarray(pairs, dtype=np.int64).reshape(-1, 2), axis=0).reshape(-1, 2)
+        self.road_keys, road_start = np.unique(pairs[:, 0], return_index=True)
+        self.road_hot = pairs[:, 1]
+        self.road_start, self.road_end = road_start, np.append(road_start[1:], len(pairs))
+
+    def __cells(self, xy) -> np.ndarray:
+        return np.floor((np.asarray(xy).reshape(-1, 2) - self.origin) / self.cell).astype(np.int64)
+
+    def __members_in(self, xmin, ymin, xmax, ymax) -> np.ndarray:
+        """
+        candidate members in the cells overlapping the bounding box
+        """
+        if len(self.cell_keys) == 0:
+            return np.zeros(0, dtype=np.int64)
+        (c0, r0), (c1, r1) = self.__cells([(xmin, ymin), (xmax, ymax)])
+        c0, r0 = max(c0, 0), max(r0, 0)
+        # only the cells of the grid are enumerated (however large the bounding box)
+        c1, r1 = min(c1, self.n_row - 1), min(r1, self.n_col - 1)
+        if c1 < c0 or r1 < r0:
+            return np.zeros(0, dtype=np.int64)
+        cells = (np.arange(c0, c1 + 1)[:, None] * self.n_col + np.arange(r0, r1 + 1)[None, :]).ravel()
+        pos = np.searchsorted(self.cell_keys, cells)
+        pos = pos[(pos < len(self.cell_keys)) & (self.cell_keys[np.minimum(pos, len(self.cell_keys) - 1)] == cells)]
+        if len(pos) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([self.cell_order[s:e] for s, e in zip(self.cell_start[pos], self.cell_end[pos])])
+
+    def __select(self, hot_ids, time_idx, epsilon, kind) -> List[Tuple]:
+        hot_ids = np.unique(hot_ids)
+        keep = np.ones(len(hot_ids), dtype=bool)
+        if time_idx is not None:
+            keep &= self.hot_time[hot_ids] == str(time_idx)
+        if epsilon is not None:
+            keep &= self.hot_epsilon[hot_ids] == float(epsilon)
+        if kind is not None:
+            keep &= np.char.startswith(self.hot_kind[hot_ids], kind)
+        return [self.keys[h] + (float(self.ratio[h]),) for h in hot_ids[keep]]
+
+    def bbox(self, xmin, ymin, xmax, ymax, time_idx=None, epsilon=None, kind: Optional[str] = None) -> List[Tuple]:
+        """
+        Hotspots with at least one member inside the bounding box
+
+        Parameters
+        ----------
+        xmin, ymin, xmax, ymax : float
+            the bounding box
+        time_idx : int or str, optional
+            only the hotspots of the time index (hour or window label), default = all
+        epsilon : int or float, optional
+            only the hotspots of the neighbourhood cutoff radius, default = all
+        kind : str, optional
+            'hole' or 'volcano', default = both
+
+        Returns
+        ----------
+        hotspots : list
+            (time, epsilon, kind, index in the partition, ratio) of the hotspots
+        """
+        members = self.__members_in(xmin, ymin, xmax, ymax)
+        xy = self.member_xy[members]
+        inside = (xy[:, 0] >= xmin) & (xy[:, 0] <= xmax) & (xy[:, 1] >= ymin) & (xy[:, 1] <= ymax)
+        return self.__select(self.member_hot[members[inside]], time_idx, epsilon, kind)
+
+    def radius(self, x, y, r, time_idx=None, epsilon=None, kind: Optional[str] = None) -> List[Tuple]:
+        """
+        Hotspots with at least one member within distance r of the point (x, y), see bbox()
+        """
+        members = self.__members_in(x - r, y - r, x + r, y + r)
+        xy = self.member_xy[members]
+        inside = (xy[:, 0] - x) ** 2 + (xy[:, 1] - y) ** 2 <= r * r
+        return self.__select(self.member_hot[members[inside]], time_idx, epsilon, kind)
+
+    def road(self, road_id, time_idx=None, epsilon=None, kind: Optional[str] = None) -> List[Tuple]:
+        """
+        Hotspots with at least one member on the road, see bbox()
+        """
+        pos = np.searchsorted(self.road_keys, road_id)
+        if pos >= len(self.road_keys) or self.road_keys[pos] != road_id:
+            return []
+        return self.__select(self.road_hot[self.road_start[pos]:self.road_end[pos]], time_idx, epsilon, kind)
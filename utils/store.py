@@ -0,0 +1,175 @@
+import os
+import os.path as osp
+import json
+import shutil
+import numpy as np
+
+# fields of each kind of partition (the members are stored separately as flat arrays with offsets)
+summary_fields = {
+    'subarea': ('seed_xy', 'lam', 'p_value', 'o_cnt', 'd_cnt'),  # subareas of holes or volcanoes
+    'merged': ('ratio', 'lam', 'o_cnt', 'd_cnt'),  # combined holes or volcanoes
+    'stats': ('seed_xy', 'lam', 'p_value', 'p_bounds', 'o_cnt', 'd_cnt', 'n_sim'),  # all the tested points
+}
+member_fields = ('member_indptr', 'member_idx', 'location_xy')
+
+
+def flatten_members(members):
+    """
+    Flatten a list of point sets into (offsets, location indices, coordinates of the unique locations)
+    """
+    sizes = np.asarray([len(m) for m in members], dtype=np.int64)
+    indptr = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+    xy = [np.asarray(list(m) if isinstance(m, (set, frozenset)) else m, dtype=np.float64).reshape(-1, 2)
+          for m in members if len(m) > 0]
+    xy = np.concatenate(xy) if xy else np.zeros((0, 2), dtype=np.float64)
+    # the members of overlapping results are shared, so only the indices of the locations are repeated
+    location_xy, member_idx = np.unique(xy, axis=0, return_inverse=True)
+    return indptr, member_idx.reshape(-1).astype(np.int32), location_xy
+
+
+class ResultStore:
+    """
+    Indexed columnar store of the detected subareas and combined urban black holes and volcanoes
+
+    Results are partitioned by (time, epsilon), each partition is a directory holding one npy file
+    per field and per kind ('hole', 'volcano', 'hole_merged', 'volcano_merged'), e.g.
+        {root}/{time}_{epsilon}/hole.lam.npy
+        {root}/{time}_{epsilon}/hole.member_indptr.npy
+        {root}/{time}_{epsilon}/meta.json
+    The member sets are flat arrays of location indices with offsets, so a summary is read without them,
+    and a partition is only visible in the catalog once its 'meta.json' is written.
+    A partition can also hold tables without member sets, e.g. 'stats' (see write_table()).
+    """
+
+    def __init__(self, root='output/result_store') -> None:
+        self.root = root
+
+    def partition_dir(self, time_idx, epsilon) -> str:
+        return osp.join(self.root, f'{time_idx}_{epsilon}')
+
+    def __path(self, time_idx, epsilon, kind, field) -> str:
+        return osp.join(self.partition_dir(time_idx, epsilon), f'{kind}.{field}.npy')
+
+    def __update_meta(self, time_idx, epsilon, kind, count, params=None) -> None:
+        meta_path = osp.join(self.partition_dir(time_idx, epsilon), 'meta.json')
+        meta = {'time': time_idx, 'epsilon': epsilon, 'kinds': {}}
+        if osp.exists(meta_path):
+            with open(meta_path) as fd:
+                meta = json.load(fd)
+        meta['kinds'][kind] = count
+        if params is not None:
+            meta.setdefault('params', {})[kind] = params
+        with open(meta_path + '.tmp', 'w') as fd:
+            json.dump(meta, fd)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def write(self, time_idx, epsilon, kind, members, **fields) -> None:
+        """
+        Write (or overwrite) a kind of result in the partition of (time_idx, epsilon)
+
+        Parameters
+        ----------
+        time_idx : int or str
+            the time index (hour) or the label of a time window
+        epsilon : int or float
+            the neighbourhood cutoff radius
+        kind : str
+            'hole', 'volcano' (subareas) or 'hole_merged', 'volcano_merged' (combined results)
+        members : list
+            a point set (or an array of coordinates) for each result
+        fields : array-like
+            the summary fields of the kind, see 'summary_fields'
+        """
+        names = summary_fields['merged' if kind.endswith('_merged') else 'subarea']
+        assert set(names) <= set(fields), f'fields {names} are required'
+        os.makedirs(self.partition_dir(time_idx, epsilon), exist_ok=True)
+        for name, value in fields.items():
+            np.save(self.__path(time_idx, epsilon, kind, name), np.asarray(value))
+        for name, value in zip(member_fields, flatten_members(members)):
+            np.save(self.__path(time_idx, epsilon, kind, name), value)
+        self.__update_meta(time_idx, epsilon, kind, len(members))
+
+    def write_table(self, time_idx, epsilon, kind, params=None, **fields) -> None:
+        """
+        Write (or overwrite) a table of per-point fields without member sets, e.g. 'stats' (the test statistics
+        of all the tested points), the parameters of the run producing it ('params', a dict) are kept in the meta
+        """
+        names = summary_fields[kind]
+        assert set(names) <= set(fields), f'fields {names} are required'
+        os.makedirs(self.partition_dir(time_idx, epsilon), exist_ok=True)
+        for name, value in fields.items():
+            np.save(self.__path(time_idx, epsilon, kind, name), np.asarray(value))
+        self.__update_meta(time_idx, epsilon, kind, len(fields[names[0]]), params=params)
+
+    def has_table(self, time_idx, epsilon, kind='stats') -> bool:
+        return osp.exists(self.__path(time_idx, epsilon, kind, summary_fields[kind][0]))
+
+    def table_params(self, time_idx, epsilon, kind='stats') -> dict:
+        """
+        Parameters of the run which wrote a table (see write_table())
+        """
+        with open(osp.join(self.partition_dir(time_idx, epsilon), 'meta.json')) as fd:
+            return json.load(fd).get('params', {}).get(kind, {})
+
+    def has(self, time_idx, epsilon, kind) -> bool:
+        return osp.exists(self.__path(time_idx, epsilon, kind, 'member_indptr'))
+
+    def read_summary(self, time_idx, epsilon, kind, mmap_mode=None) -> dict:
+        """
+        Read the summary fields of a kind of result (without the member sets)
+        """
+        part_dir = self.partition_dir(time_idx, epsilon)
+        prefix = f'{kind}.'
+        summary = {}
+        for fname in os.listdir(part_dir):
+            field = fname[len(prefix):-len('.npy')]
+            if fname.startswith(prefix) and field not in member_fields:
+                summary[field] = np.load(osp.join(part_dir, fname), mmap_mode=mmap_mode)
+        return summary
+
+    def read(self, time_idx, epsilon, kind, mmap_mode=None) -> dict:
+        """
+        Read all the fields of a kind of result, including the member sets (see 'member_fields')
+        """
+        result = self.read_summary(time_idx, epsilon, kind, mmap_mode=mmap_mode)
+        for field in member_fields:
+            result[field] = np.load(self.__path(time_idx, epsilon, kind, field), mmap_mode=mmap_mode)
+        return result
+
+    def members(self, result: dict, i):
+        """
+        Coordinates of the members of the i-th result (returned by read())
+        """
+        return result['location_xy'][result['member_idx'][result['member_indptr'][i]:result['member_indptr'][i + 1]]]
+
+    def member_sets(self, result: dict):
+        """
+        Member sets of all the results (returned by read())
+        """
+        indptr, idx = result['member_indptr'], result['member_idx'].tolist()
+        locations = list(map(tuple, result['location_xy'].tolist()))
+        return [{locations[j] for j in idx[indptr[i]:indptr[i + 1]]} for i in range(len(indptr) - 1)]
+
+    def catalog(self) -> dict:
+        """
+        Returns the catalog {(time, epsilon) => {kind => number of results}} and saves it in 'catalog.json'
+        """
+        catalog = {}
+        if not osp.exists(self.root):
+            return catalog
+        for part in sorted(os.listdir(self.root)):
+            meta_path = osp.join(self.root, part, 'meta.json')
+            if not osp.exists(meta_path):
+                continue
+            with open(meta_path) as fd:
+                meta = json.load(fd)
+            catalog[(meta['time'], meta['epsilon'])] = meta['kinds']
+        with open(osp.join(self.root, 'catalog.json'), 'w') as fd:
+            json.dump([{'time': t, 'epsilon': e, 'kinds': k} for (t, e), k in catalog.items()], fd, indent=1)
+        return catalog
+
+    def remove(self, time_idx, epsilon) -> None:
+        """
+        Remove the partition of (time_idx, epsilon)
+        """
+        shutil.rmtree(self.partition_dir(time_idx, epsilon), ignore_errors=True)
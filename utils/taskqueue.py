@@ -0,0 +1,198 @@
+import os
+import os.path as osp
+import json
+import time
+import uuid
+import shutil
+from typing import Callable, Dict, List, Optional
+
+states = ('pending', 'leased', 'done', 'failed')
+
+
+class TaskQueue:
+    """
+    File-based task queue on a directory shared by all the nodes (or a local directory as a stand-in)
+
+    Each task is a json file moved between the state directories with atomic renames, e.g.
+        {root}/pending/{task_id}.json   waiting to be leased
+        {root}/leased/{task_id}.json    leased by a worker, the lease expires 'lease_seconds' after
+                                        the last modification time of the file (renewed by renew())
+        {root}/done/{task_id}.json      the result is committed in {root}/results/{task_id}
+        {root}/failed/{task_id}.json    failed (or lost) 'max_attempts' times
+    A task whose lease expires (e.g. its worker is lost) goes back to 'pending' and is retried.
+    A task may then run more than once, but its result is committed with a single atomic rename,
+    so only the first result is kept (idempotent commits).
+    """
+
+    def __init__(self, root, lease_seconds=600, max_attempts=3) -> None:
+        self.root = root
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        for state in states + ('results',):
+            os.makedirs(osp.join(root, state), exist_ok=True)
+
+    def __path(self, state, task_id) -> str:
+        return osp.join(self.root, state, f'{task_id}.json')
+
+    def results_dir(self, task_id) -> str:
+        return osp.join(self.root, 'results', task_id)
+
+    @staticmethod
+    def __write(path, task) -> None:
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'w') as fd:
+            json.dump(task, fd)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def __read(path) -> Optional[dict]:
+        try:
+            with open(path) as fd:
+                return json.load(fd)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def __task_ids(self, state) -> List[str]:
+        return sorted(name[:-len('.json')] for name in os.listdir(osp.join(self.root, state)) if name.endswith('.json'))
+
+    def submit(self, task_id, payload: dict) -> bool:
+        """
+        Add a task (ignored if a task with the same id is already in the queue or done)
+        """
+        if any(osp.exists(self.__path(state, task_id)) for state in states):
+            return False
+        self.__write(self.__path('pending', task_id), {'id': task_id, 'payload': payload, 'attempts': 0, 'errors': []})
+        return True
+
+    def lease(self, worker) -> Optional[dict]:
+        """
+        Lease a pending task for 'worker' (None if there is no pending task)
+        """
+        self.reclaim()
+        for task_id in self.__task_ids('pending'):
+            src, dst = self.__path('pending', task_id), self.__path('leased', task_id)
+            try:
+                os.utime(src)  # the lease starts now (a rename keeps the modification time)
+                os.rename(src, dst)
+            except FileNotFoundError:
+                continue  # leased by another worker
+            task = self.__read(dst)
+            if task is None:
+                continue
+            if osp.exists(self.__path('done', task_id)):
+                # a duplicate of a task committed by a lost lease
+                self.__remove(dst)
+                continue
+            task['attempts'] += 1
+            task['worker'] = worker
+            self.__write(dst, task)
+            return task
+        return None
+
+    def renew(self, task_id) -> bool:
+        """
+        Renew the lease of a task (False if the lease is lost)
+        """
+        try:
+            os.utime(self.__path('leased', task_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def reclaim(self) -> int:
+        """
+        Move the tasks whose leases expired back to 'pending' (or to 'failed' after 'max_attempts')
+        """
+        n_reclaimed = 0
+        for task_id in self.__task_ids('leased'):
+            path = self.__path('leased', task_id)
+            try:
+                expired = time.time() - osp.getmtime(path) > self.lease_seconds
+            except FileNotFoundError:
+                continue
+            if expired and self.__retry(task_id, 'lease expired'):
+                n_reclaimed += 1
+        return n_reclaimed
+
+    def __retry(self, task_id, error) -> bool:
+        claim = self.__path('leased', task_id) + f'.{uuid.uuid4().hex}.claim'
+        try:
+            os.rename(self.__path('leased', task_id), claim)
+        except FileNotFoundError:
+            return False  # reclaimed or completed by another worker
+        task = self.__read(claim)
+        task['errors'].append(error)
+        task.pop('worker', None)
+        state = 'failed' if task['attempts'] >= self.max_attempts else 'pending'
+        self.__write(self.__path(state, task_id), task)
+        self.__remove(claim)
+        return True
+
+    def fail(self, task: dict, error) -> None:
+        """
+        Give a leased task back after an error, it is retried until it failed 'max_attempts' times
+        """
+        self.__retry(task['id'], str(error))
+
+    def complete(self, task: dict, commit: Callable[[str], None]) -> bool:
+        """
+        Commit the result of a leased task
+
+        Parameters
+        ----------
+        task : dict
+            the task returned by lease()
+        commit : callable
+            writes the result of the task in the given (new) directory
+
+        Returns
+        ----------
+        committed : bool
+            False if the result of the task was already committed (the new result is dropped)
+        """
+        task_id = task['id']
+        tmp_dir = f'{self.results_dir(task_id)}.{uuid.uuid4().hex}.tmp'
+        os.makedirs(tmp_dir)
+        try:
+            commit(tmp_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        self.__write(osp.join(tmp_dir, 'task.json'), task)
+        try:
+            os.rename(tmp_dir, self.results_dir(task_id))
+            committed = True
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            committed = False
+        if committed or not osp.exists(self.__path('done', task_id)):
+            self.__write(self.__path('done', task_id), task)
+        self.__remove(self.__path('leased', task_id))
+        self.__remove(self.__path('pending', task_id))
+        return committed
+
+    @staticmethod
+    def __remove(path) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def tasks(self, state=None) -> Dict[str, dict]:
+        """
+        Returns {task id => task} of all the tasks (or of the tasks in the given state)
+        """
+        tasks = {}
+        # a committed task may leave a duplicate behind (after a lost lease), its final state wins
+        for st in (('done', 'failed', 'leased', 'pending') if state is None else (state,)):
+            for task_id in self.__task_ids(st):
+                task = self.__read(self.__path(st, task_id))
+                if task is not None:
+                    tasks.setdefault(task_id, dict(task, state=st))
+        return tasks
+
+    def status(self) -> Dict[str, int]:
+        """
+        Returns the number of tasks in each state
+        """
+        return {state: len(self.__task_ids(state)) for state in states}
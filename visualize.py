@@ -1,4 +1,3 @@
-import os
 import os.path as osp
 import numpy as np
 import pandas as pd
@@ -7,6 +6,7 @@ import time
 import matplotlib.pyplot as plt
 from matplotlib.pyplot import MultipleLocator
 from utils import common
+from utils.store import ResultStore
 
 plt.rcParams['figure.constrained_layout.use'] = True
 
@@ -17,8 +17,12 @@ plt.rcParams['figure.constrained_layout.use'] = True
 # plt.rcParams['axes.unicode_minus'] = False
 
 
-def save_subareas_fig_from_time():
-    subareas_dir = 'output/subareas_split_time'
+def save_subareas_fig_from_time(epsilon=1200):
+    """
+    Plot the subareas of holes and volcanoes of each hour saved in the result store with the neighbourhood
+    cutoff radius epsilon (see identify_subareas.save_subareas)
+    """
+    store = ResultStore()
     fig, axes = plt.subplots(1, 2, sharey='all', figsize=(10, 5))
     for i in range(24):
         print(f'reading the {i} time partition of subarea ...')
@@ -28,23 +32,10 @@ def save_subareas_fig_from_time():
             x1, y1, x2, y2 = data['XCoord_0'], data['YCoord_0'], data['XCoord_1'], data['YCoord_1']
             axes[0].plot((x1, x2), (y1, y2), color='C9')
             axes[1].plot((x1, x2), (y1, y2), color='C9')
-        subareas_path_hole = [osp.join(subareas_dir, fname) for fname in os.listdir(subareas_dir) if
-                              fname.startswith(f'{i}_hole')]
-        subareas_path_volcano = [osp.join(subareas_dir, fname) for fname in os.listdir(subareas_dir) if
-                                 fname.startswith(f'{i}_volcano')]
-        all_hole, all_volcano = [], []
-        hole_cnt, volcano_cnt = 0, 0
-        for path in subareas_path_hole:
-            result = np.load(path, allow_pickle=True)[0]
-            hole_cnt += len(result.keys())
-            for h in result.values():
-                all_hole.extend(h[1])
-        for path in subareas_path_volcano:
-            result = np.load(path, allow_pickle=True)[0]
-            volcano_cnt += len(result.keys())
-            for v in result.values():
-                all_volcano.extend(v[1])
-        all_hole, all_volcano = np.asarray(all_hole), np.asarray(all_volcano)
+        hole, volcano = store.read(i, epsilon, 'hole'), store.read(i, epsilon, 'volcano')
+        hole_cnt, volcano_cnt = len(hole['lam']), len(volcano['lam'])
+        # the members of all the subareas (as many times as they are shared)
+        all_hole, all_volcano = hole['location_xy'][hole['member_idx']], volcano['location_xy'][volcano['member_idx']]
         if len(all_hole) > 0:
             axes[0].scatter(all_hole[:, 0], all_hole[:, 1], s=10, c='g', alpha=0.5)
         if len(all_volcano) > 0: